@@ -4,17 +4,47 @@
 Object calibration methods.
 """
 
+from __future__ import annotations
+
+import order as od
+
 from columnflow.calibration import Calibrator, calibrator
 from columnflow.util import maybe_import
 from columnflow.columnar_util import set_ak_column, layout_ak_array
 
+from agc.util import counter_normal
+from agc.columnar_util import virtual_column
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+# relative jet energy scale uncertainty
+jes_uncertainty = 0.03
+
+# name of the collection of jets that pass the jet selection of the nominal or any jet energy shift,
+# created by selectors that keep events of all these shifts (see agc.selection.default)
+any_shift_jet_collection = "AnyShiftJet"
+
+
+def jer_smearing(events: ak.Array, width: float = 0.05, seed: int = 0) -> ak.Array:
+    """
+    Returns a jagged array of normally distributed, relative jet energy resolution smearing values
+    with a certain *width* for all jets in *events*. Values are drawn from a counter-based random
+    number generator keyed on run, luminosity block, event number and jet index, as well as the
+    *seed*, so that they are identical for every evaluation, independent of chunking and the order
+    of processing.
+    """
+    counts = ak.to_numpy(ak.num(events.Jet.pt, axis=1))
+    keys = [np.repeat(ak.to_numpy(events[field]), counts) for field in ["run", "luminosityBlock", "event"]]
+    jet_index = ak.to_numpy(ak.flatten(ak.local_index(events.Jet.pt, axis=1), axis=1))
+    smearing = width * counter_normal(*keys, jet_index, seed=seed)
+    return layout_ak_array(smearing, events.Jet.pt)
+
+
 @calibrator(
     uses={
-        "Jet.pt", "Jet.mass",
+        "run", "luminosityBlock", "event", "Jet.pt", "Jet.mass",
     },
     produces={
         "Jet.pt_jes_up", "Jet.pt_jes_down", "Jet.mass_jes_up", "Jet.mass_jes_down",
@@ -24,6 +54,11 @@ ak = maybe_import("awkward")
     mc_only=True,
     # special agc case: there is no nominal calibration, so skip on all other shifts
     shifts_only={"nominal", "jes_up", "jes_down", "jer_up", "jer_down"},
+    # seed of the deterministic jer smearing
+    smearing_seed=2015,
+    # whether to only store the per-jet jer smearing, and to provide the shifted jet columns as
+    # virtual columns that are computed on demand
+    virtual_shifts=False,
 )
 def jec(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     """
@@ -32,12 +67,14 @@ def jec(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     The fake AGC implementation is very trivial though and could therefore be implemented, for
     instance, in the selection itself, but we use a proper calibrator instead to showcase cf.
     """
-    flat_pt = ak.flatten(events.Jet.pt, axis=1)
-    smearing = layout_ak_array(np.random.normal(np.zeros_like(flat_pt), 0.05), events.Jet.pt)
+    smearing = jer_smearing(events, width=0.05, seed=self.smearing_seed)
+
+    if self.virtual_shifts:
+        return set_ak_column(events, "Jet.jer_smearing", smearing, value_type=np.float32)
 
     for direction, sign in [("up", 1.0), ("down", -1.0)]:
         # jes
-        jes_factor = 1 + sign * 0.03
+        jes_factor = 1 + sign * jes_uncertainty
         events = set_ak_column(events, f"Jet.pt_jes_{direction}", events.Jet.pt * jes_factor)
         events = set_ak_column(events, f"Jet.mass_jes_{direction}", events.Jet.mass * jes_factor)
 
@@ -49,6 +86,37 @@ def jec(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     return events
 
 
+@jec.init
+def jec_init(self: Calibrator) -> None:
+    if self.virtual_shifts:
+        self.produces = {"Jet.jer_smearing"}
+
+
+# version of the calibrator that stores the jer smearing instead of shifted jet columns
+jec_virtual = jec.derive("jec_virtual", cls_dict={"virtual_shifts": True})
+
+
+def register_virtual_jec_columns(collection: str = "Jet") -> None:
+    """
+    Registers the shifted jet columns produced by :py:class:`jec` as virtual columns of a jet
+    *collection*, computed from nominal columns and, for jer shifts, the stored smearing of
+    :py:class:`jec_virtual`.
+    """
+    c = collection
+    for direction, sign in [("up", 1.0), ("down", -1.0)]:
+        for field in ["pt", "mass"]:
+            virtual_column(f"{c}.{field}_jes_{direction}", inputs={f"{c}.{field}"})(
+                lambda events, field=field, sign=sign: events[c][field] * (1 + sign * jes_uncertainty),
+            )
+            virtual_column(f"{c}.{field}_jer_{direction}", inputs={f"{c}.{field}", f"{c}.jer_smearing"})(
+                lambda events, field=field, sign=sign: events[c][field] * (1 + sign * events[c].jer_smearing),
+            )
+
+
+register_virtual_jec_columns("Jet")
+register_virtual_jec_columns(any_shift_jet_collection)
+
+
 @calibrator(
     shifts=jec.shifts_only,
 )
@@ -60,15 +128,43 @@ def jec_shifts(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     return events
 
 
+def get_jec_shift_jet_aliases(config_inst: od.Config, collection: str = "Jet") -> dict[str, dict[str, str]]:
+    """
+    Returns the column aliases of all jet energy shifts in *config_inst* that refer to fields of the
+    Jet collection, mapped to shift names. Alias targets are stored relative to the collection, and
+    sources refer to the same fields of another jet *collection* when set.
+    """
+    return {
+        shift_name: {
+            dst[len("Jet."):]: f"{collection}.{src[len('Jet.'):]}"
+            for dst, src in config_inst.get_shift(shift_name).x("column_aliases", {}).items()
+            if dst.startswith("Jet.") and src.startswith("Jet.")
+        }
+        for shift_name in sorted(jec.shifts_only - {"nominal"})
+        if config_inst.has_shift(shift_name)
+    }
+
+
 @calibrator(
-    uses={jec},
-    produces={jec},
+    # calibrator of jet energies
+    jec_calibrator=jec,
 )
 def default(self: Calibrator, events: ak.Array, **kwargs) -> ak.Array:
     """
     Default calibrator.
     """
     if self.dataset_inst.is_mc:
-        events = self[jec](events, **kwargs)
+        events = self[self.jec_calibrator](events, **kwargs)
 
     return events
+
+
+@default.init
+def default_init(self: Calibrator) -> None:
+    # add the jec calibrator to the dependency sets
+    self.uses.add(self.jec_calibrator)
+    self.produces.add(self.jec_calibrator)
+
+
+# version of the default calibrator with virtual shifted jet columns
+default_virtual = default.derive("default_virtual", cls_dict={"jec_calibrator": jec_virtual})
@@ -0,0 +1,108 @@
+# coding: utf-8
+
+"""
+Helpers for building catalogs of ROOT files and for planning work units that are balanced by the
+number of events and aligned to cluster boundaries.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+from typing import Iterable
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+uproot = maybe_import("uproot")
+
+
+def scan_file(
+    path: str,
+    tree_name: str = "Events",
+    branches: Iterable[str] | None = None,
+) -> dict:
+    """
+    Reads the header of a ROOT file at *path* and returns a catalog entry with the number of
+    ``entries`` of the tree *tree_name*, the entry offsets of its ``clusters``, i.e., the entries at
+    which all considered branches start new baskets, and the ``compressed_bytes`` and
+    ``uncompressed_bytes`` per branch. When *branches* are given, only branches matching any of the
+    patterns are considered. No event data is read.
+    """
+    with uproot.open(path) as f:
+        tree = f[tree_name]
+
+        names = [
+            name for name in tree.keys(recursive=True)
+            if branches is None or any(fnmatch.fnmatch(name, pattern) for pattern in branches)
+        ]
+
+        return {
+            "entries": int(tree.num_entries),
+            "clusters": [int(offset) for offset in tree.common_entry_offsets(filter_name=names)],
+            "compressed_bytes": {name: int(tree[name].compressed_bytes) for name in names},
+            "uncompressed_bytes": {name: int(tree[name].uncompressed_bytes) for name in names},
+        }
+
+
+def plan_work_units(catalog: list[dict], target_events: int) -> list[list[tuple[int, int, int]]]:
+    """
+    Splits the files described by a *catalog*, a list of entries as returned by :py:func:`scan_file`
+    in the order of files, into work units of approximately *target_events* events each. Units are
+    lists of segments ``(file_index, entry_start, entry_stop)``. Files are split only at cluster
+    boundaries, and consecutive small files are grouped into the same unit, so that units are
+    balanced by the number of events rather than by the number of files.
+    """
+    if target_events <= 0:
+        raise ValueError(f"target_events must be positive, got {target_events}")
+
+    units = []
+    unit = []
+    n_unit = 0
+
+    def close_unit():
+        nonlocal unit, n_unit
+        if unit:
+            units.append(unit)
+        unit = []
+        n_unit = 0
+
+    for file_index, entry in enumerate(catalog):
+        # cluster boundaries, always including the first and last entry
+        offsets = np.union1d(entry["clusters"] or [0], [0, entry["entries"]])
+        offsets = offsets[offsets <= entry["entries"]]
+
+        start = 0
+        for stop in offsets[1:].tolist():
+            n = stop - start
+            # close the unit before this cluster if it is closer to the target without it
+            if unit and abs(target_events - n_unit) < abs(target_events - n_unit - n):
+                close_unit()
+            # extend the last segment when it belongs to the same file, otherwise add a new one
+            if unit and unit[-1][0] == file_index and unit[-1][2] == start:
+                unit[-1] = (file_index, unit[-1][1], stop)
+            else:
+                unit.append((file_index, start, stop))
+            n_unit += n
+            start = stop
+
+    close_unit()
+
+    return units
+
+
+def summarize_work_units(units: list[list[tuple[int, int, int]]]) -> dict[str, float]:
+    """
+    Returns the number of work *units*, the minimum, maximum and mean number of events per unit, and
+    the imbalance, defined as the ratio between the maximum and the mean number of events.
+    """
+    n_events = np.array([sum(stop - start for _, start, stop in unit) for unit in units], dtype=np.int64)
+    if not len(n_events):
+        return {"n_units": 0, "min_events": 0, "max_events": 0, "mean_events": 0.0, "imbalance": 1.0}
+    mean = float(n_events.mean())
+    return {
+        "n_units": len(n_events),
+        "min_events": int(n_events.min()),
+        "max_events": int(n_events.max()),
+        "mean_events": mean,
+        "imbalance": float(n_events.max() / mean) if mean else 1.0,
+    }
@@ -4,12 +4,31 @@
 Categorizations.
 """
 
+from __future__ import annotations
+
 from columnflow.categorization import Categorizer, categorizer
 from columnflow.util import maybe_import
 
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def num_objects(events: ak.Array, collection: str, cache: dict | None = None) -> np.ndarray:
+    """
+    Returns the number of objects in a *collection* of *events*. When a *cache* is given, the
+    numbers are stored in it and reused by subsequent calls.
+    """
+    key = f"num_{collection}"
+    if cache is not None and key in cache:
+        return cache[key]
+
+    num = ak.to_numpy(ak.num(events[collection].pt, axis=1))
+    if cache is not None:
+        cache[key] = num
+
+    return num
+
+
 @categorizer(uses={"event"})
 def cat_pre(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
     # fully inclusive selection
@@ -17,16 +36,26 @@ def cat_pre(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak
 
 
 @categorizer(uses={"Jet.pt", "BJet.pt"})
-def cat_ge4j_eq1b(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
+def cat_ge4j_eq1b(
+    self: Categorizer,
+    events: ak.Array,
+    cache: dict | None = None,
+    **kwargs,
+) -> tuple[ak.Array, ak.Array]:
     return events, (
-        (ak.num(events.Jet.pt, axis=1) >= 4) &
-        (ak.num(events.BJet.pt, axis=1) == 1)
+        (num_objects(events, "Jet", cache) >= 4) &
+        (num_objects(events, "BJet", cache) == 1)
     )
 
 
 @categorizer(uses={"Jet.pt", "BJet.pt"})
-def cat_ge4j_ge2b(self: Categorizer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
+def cat_ge4j_ge2b(
+    self: Categorizer,
+    events: ak.Array,
+    cache: dict | None = None,
+    **kwargs,
+) -> tuple[ak.Array, ak.Array]:
     return events, (
-        (ak.num(events.Jet.pt, axis=1) >= 4) &
-        (ak.num(events.BJet.pt, axis=1) >= 2)
+        (num_objects(events, "Jet", cache) >= 4) &
+        (num_objects(events, "BJet", cache) >= 2)
     )
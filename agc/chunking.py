@@ -0,0 +1,412 @@
+# coding: utf-8
+
+"""
+Chunked reading with chunk sizes adapted to a memory budget.
+"""
+
+from __future__ import annotations
+
+import os
+import gc
+import math
+import time
+import resource
+from functools import partial
+
+import law
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import ChunkedIOHandler
+
+from agc.config.agc_files import get_cache_dir, read_cache_file, write_cache_file
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+logger = law.logger.get_logger(__name__)
+logger_perf = law.logger.get_logger(f"{__name__}-perf")
+
+
+def get_rss(peak: bool = False) -> int:
+    """
+    Returns the current resident set size of the process in bytes, or its peak since the last call
+    to :py:func:`reset_peak_rss` when *peak* is *True*. On systems without ``/proc``, the peak
+    resident set size over the lifetime of the process is returned in both cases.
+    """
+    key = "VmHWM:" if peak else "VmRSS:"
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    # ru_maxrss is in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak resident set size of the process and returns whether this was possible.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def get_chunk_nbytes(chunk: ak.Array | list[ak.Array]) -> int:
+    """
+    Returns the number of bytes of the buffers of a *chunk*, or of a list of chunks of multiple
+    sources, with objects that do not expose their size being counted as zero.
+    """
+    n = 0
+    for _chunk in law.util.make_list(chunk):
+        try:
+            n += int(_chunk.nbytes)
+        except Exception:
+            pass
+    return n
+
+
+def get_mean_combinations(chunk: ak.Array | list[ak.Array], collection: str, k: int) -> float:
+    """
+    Returns the mean number of combinations of *k* objects of a *collection* per event in a *chunk*,
+    or of the first chunk of multiple sources containing the collection, and zero when the
+    collection is not contained.
+    """
+    for _chunk in law.util.make_list(chunk):
+        fields = getattr(_chunk, "fields", None) or []
+        if collection in fields:
+            n = ak.to_numpy(ak.num(_chunk[collection], axis=1))
+        elif f"n{collection}" in fields:
+            n = ak.to_numpy(_chunk[f"n{collection}"])
+        else:
+            continue
+        if not len(n):
+            return 0.0
+        # binomial coefficients per event
+        comb = np.ones(len(n), dtype=np.float64)
+        for i in range(k):
+            comb *= np.maximum(n - i, 0) / (i + 1)
+        return float(comb.mean())
+
+    return 0.0
+
+
+class AdaptiveChunkedIOHandler(ChunkedIOHandler):
+    """
+    Chunked IO handler whose chunk size is adapted to a *memory_budget* in bytes that the resident
+    set size of the process should not exceed.
+
+    The initial chunk size is estimated on a prefix of *probe_size* events, read with the same read
+    options, from the number of bytes per event and the mean number of combinations of
+    :py:attr:`combination_size` objects of the :py:attr:`multiplicity_collection`, such that
+    ``pool_size`` chunks being read and one chunk being processed fit into the budget that is left
+    when opening the sources. Chunk sizes are clamped to ``[min_chunk_size, max_chunk_size]``.
+
+    During iteration, when the resident set size exceeds the budget after a chunk was read, the
+    chunk size is halved and the chunk is read again, and when its peak exceeded the budget while a
+    chunk was processed, the chunk size is halved for all subsequent chunks. Chunks are yielded in the
+    order of their entries with consecutive indices, so that outputs sorted by chunk index are
+    unaffected. Reads of subsequent chunks that were already submitted are awaited and discarded
+    before reading again. :py:attr:`n_chunks` refers to the initial chunk size and is not updated,
+    so more chunks can be yielded when the chunk size is halved. Since chunk sizes vary, this
+    handler only supports root sources which are read by entry ranges, see
+    :py:attr:`supports_sources`.
+
+    When a *history_key* is given, the final chunk size is recorded in a history file in the cache
+    directory and used instead of the estimate when the same key is opened again, scaled by the
+    available memory.
+    """
+
+    # factor between the bytes of events when read, and the bytes they occupy during processing
+    processing_factor = 4.0
+
+    # source types that are read by entry ranges and therefore support varying chunk sizes
+    supported_source_types = {"coffea_root", "uproot_root"}
+
+    # collection whose combinations are the dominating memory consumers, and bytes per combination
+    multiplicity_collection = "Jet"
+    combination_size = 3
+    combination_bytes = 256
+
+    def __init__(
+        self,
+        *args,
+        memory_budget: int,
+        min_chunk_size: int = 1000,
+        max_chunk_size: int = 1000000,
+        probe_size: int = 1000,
+        history_key: str | None = None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+
+        self.memory_budget = int(memory_budget)
+        self.min_chunk_size = max(int(min_chunk_size), 1)
+        self.max_chunk_size = max(int(max_chunk_size), self.min_chunk_size)
+        self.probe_size = max(int(probe_size), 1)
+        self.history_key = history_key
+
+        # attributes set in open() and during iteration
+        self.base_rss = None
+        self.settled_rss = None
+        self.peak_rss = None
+        self.chunk_sizes = []
+        self._n_chunks = None
+        self._warned_settled = False
+
+    @classmethod
+    def get_history_path(cls) -> str:
+        return os.path.join(get_cache_dir(), "chunk_sizes.json")
+
+    @property
+    def supports_sources(self) -> bool:
+        """
+        Whether all sources are of a :py:attr:`supported_source_types`.
+        """
+        return all(handler.type in self.supported_source_types for handler in self.source_handlers)
+
+    @property
+    def available_memory(self) -> int:
+        return max(self.memory_budget - (self.base_rss or 0), 0)
+
+    def clamp_chunk_size(self, chunk_size: float) -> int:
+        return int(min(max(chunk_size, self.min_chunk_size), self.max_chunk_size))
+
+    def _create_read_func(self):
+        read_funcs = [
+            partial(source_handler.read, obj, read_options=read_options, read_columns=read_columns)
+            for obj, source_handler, read_options, read_columns in zip(
+                self.source_objects,
+                self.source_handlers,
+                self.read_options_list,
+                self.read_columns_list,
+            )
+        ]
+
+        def read(chunk_pos):
+            t1 = time.perf_counter()
+            chunks = [read_func(chunk_pos) for read_func in read_funcs]
+            logger_perf.debug(
+                f"reading of chunk {chunk_pos.index} with {chunk_pos.entry_stop - chunk_pos.entry_start} "
+                f"entries took {law.util.human_duration(seconds=time.perf_counter() - t1)}",
+            )
+            return self.ReadResult((chunks if self.is_multi else chunks[0]), chunk_pos)
+
+        return read
+
+    def estimate_chunk_size(self) -> int:
+        """
+        Reads a prefix of events and returns the estimated chunk size.
+        """
+        n = min(self.probe_size, self.n_entries)
+        if not n:
+            return self.clamp_chunk_size(self.chunk_size)
+
+        chunk_pos = self.ChunkPosition(0, 0, n, n)
+        chunk = self._create_read_func()(chunk_pos).chunk
+
+        # bytes per event during processing
+        read_bytes = get_chunk_nbytes(chunk) / n
+        n_comb = get_mean_combinations(chunk, self.multiplicity_collection, self.combination_size)
+        event_bytes = read_bytes * self.processing_factor + n_comb * self.combination_bytes
+        del chunk
+        gc.collect()
+
+        chunk_size = self.available_memory / max(event_bytes * (self.pool_size + 1), 1.0)
+        logger.debug(
+            f"estimated {event_bytes:.0f} bytes per event ({read_bytes:.0f} read, {n_comb:.1f} "
+            f"combinations) from {n} events, chunk size {chunk_size:.0f}",
+        )
+
+        return self.clamp_chunk_size(chunk_size)
+
+    def get_history_chunk_size(self) -> int | None:
+        """
+        Returns the chunk size recorded for the :py:attr:`history_key`, scaled by the ratio of the
+        currently available memory to that at the time of recording, or *None* if no entry exists.
+        """
+        if not self.history_key:
+            return None
+        entry = (read_cache_file(self.get_history_path()) or {}).get(self.history_key)
+        if not entry or not entry.get("available"):
+            return None
+        return self.clamp_chunk_size(entry["chunk_size"] * self.available_memory / entry["available"])
+
+    def record_history(self) -> None:
+        """
+        Records the last chunk size in the history file when a :py:attr:`history_key` is set.
+        """
+        if not self.history_key or not self.chunk_sizes:
+            return
+        path = self.get_history_path()
+        history = read_cache_file(path) or {}
+        history[self.history_key] = {
+            "chunk_size": self.chunk_size,
+            "available": self.available_memory,
+            "memory_budget": self.memory_budget,
+            "peak_rss": self.peak_rss,
+            "n_chunks": len(self.chunk_sizes),
+        }
+        write_cache_file(path, history)
+
+    @property
+    def n_chunks(self) -> int:
+        # number of chunks with the initial chunk size, which does not change during iteration
+        if self._n_chunks is None:
+            raise AttributeError("cannot determine number of chunks before open()")
+        return self._n_chunks
+
+    def open(self) -> None:
+        if not self.closed:
+            return
+
+        if not self.supports_sources:
+            types = ", ".join(handler.type for handler in self.source_handlers)
+            raise Exception(f"{self.__class__.__name__} does not support sources of types {types}")
+
+        super().open()
+
+        # determine the initial chunk size
+        self.base_rss = self.settled_rss = self.peak_rss = get_rss()
+        del self.chunk_sizes[:]
+        chunk_size = self.get_history_chunk_size()
+        if chunk_size is None:
+            chunk_size = self.estimate_chunk_size()
+        else:
+            logger.debug(f"using chunk size {chunk_size} from history for {self.history_key}")
+        self.chunk_size = chunk_size
+        self._n_chunks = int(math.ceil(self.n_entries / self.chunk_size))
+
+    def _exceeds_budget(self, rss: int) -> bool:
+        self.peak_rss = max(self.peak_rss, rss)
+        if rss <= self.memory_budget:
+            return False
+        # smaller chunks cannot help when the memory retained after processing exceeds the budget
+        if self.settled_rss > self.memory_budget:
+            if not self._warned_settled:
+                logger.warning(
+                    f"resident set size of {law.util.human_bytes(self.settled_rss, fmt=True)} "
+                    f"retained after processing exceeds memory budget of "
+                    f"{law.util.human_bytes(self.memory_budget, fmt=True)}, chunk size is not reduced",
+                )
+                self._warned_settled = True
+            return False
+        return True
+
+    def _halve_chunk_size(self, chunk_pos: ChunkedIOHandler.ChunkPosition, reason: str) -> bool:
+        # halve the size of the chunk that exceeded the budget, which might be smaller than the
+        # chunk size at the end of the entries
+        size = min(chunk_pos.entry_stop - chunk_pos.entry_start, self.chunk_size)
+        if size <= self.min_chunk_size:
+            return False
+        self.chunk_size = self.clamp_chunk_size(size // 2)
+        logger.info(
+            f"resident set size exceeds memory budget of "
+            f"{law.util.human_bytes(self.memory_budget, fmt=True)} {reason}, halved chunk size to "
+            f"{self.chunk_size}",
+        )
+        return True
+
+    def _iter_impl(self):
+        if self.closed:
+            raise Exception(f"cannot iterate through closed {self.__class__.__name__}")
+
+        read = self._create_read_func()
+        n_entries = self.n_entries
+
+        # reads are submitted in order of their entries, starting at the next chunk to be yielded
+        reads = []
+        tasks = []
+        next_start = 0
+        next_index = 0
+        yield_start = 0
+        yield_index = 0
+
+        self.pool = self.pool_cls(self.pool_size)
+        try:
+            while True:
+                # remove done tasks, raising their exceptions
+                for result in list(tasks):
+                    if result.ready():
+                        result.get()
+                        tasks.remove(result)
+
+                # fill up the pool, prioritizing queued tasks over reads
+                while len(tasks) + len(reads) < self.pool_size:
+                    if self.task_queue:
+                        task = self.task_queue.get_next()
+                        tasks.append(self.pool.apply_async(task.func, task.args, task.kwargs))
+                    elif next_start < n_entries or (next_index == 0 and n_entries == 0):
+                        entry_stop = min(next_start + self.chunk_size, n_entries)
+                        chunk_pos = self.ChunkPosition(next_index, next_start, entry_stop, self.chunk_size)
+                        reads.append(self.pool.apply_async(read, (chunk_pos,)))
+                        next_start = entry_stop
+                        next_index += 1
+                    else:
+                        break
+
+                # stop when all chunks were yielded and all tasks are done
+                if not reads:
+                    if not tasks:
+                        break
+                    time.sleep(0.05)
+                    continue
+
+                # wait for the next chunk
+                if not reads[0].ready():
+                    time.sleep(0.05)
+                    continue
+                result_obj = reads.pop(0).get()
+
+                # when the budget is exceeded, halve the chunk size and read again, discarding all
+                # subsequent reads as well after waiting for them to finish, so that they do not
+                # overlap with reads of smaller chunks
+                if self._exceeds_budget(get_rss()) and self._halve_chunk_size(result_obj.chunk_pos, "after reading"):
+                    del result_obj
+                    for discarded in reads:
+                        discarded.wait()
+                    del reads[:]
+                    gc.collect()
+                    next_start = yield_start
+                    next_index = yield_index
+                    continue
+
+                chunk_pos = result_obj.chunk_pos
+                self.chunk_sizes.append(chunk_pos.entry_stop - chunk_pos.entry_start)
+                yield_start = chunk_pos.entry_stop
+                yield_index += 1
+
+                if self.iter_message:
+                    print(self.iter_message.format(pos=chunk_pos))
+
+                gc.collect()
+                has_peak = reset_peak_rss()
+                t1 = time.perf_counter()
+                try:
+                    yield (result_obj.chunk, chunk_pos)
+                finally:
+                    logger_perf.debug(
+                        f"processing of chunk {chunk_pos.index} took " +
+                        law.util.human_duration(seconds=time.perf_counter() - t1),
+                    )
+                del result_obj
+                gc.collect()
+
+                # halve the chunk size for subsequent chunks when the budget was exceeded during
+                # processing
+                self.settled_rss = get_rss()
+                if self._exceeds_budget(get_rss(peak=has_peak)):
+                    self._halve_chunk_size(chunk_pos, "after processing")
+
+            self.record_history()
+        finally:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
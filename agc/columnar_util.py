@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""
+Helpers for virtual columns, i.e., columns that are not stored on disk but computed on demand from
+other columns.
+"""
+
+from __future__ import annotations
+
+import fnmatch
+from typing import Callable, Iterable
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, has_ak_column, set_ak_column
+
+ak = maybe_import("awkward")
+
+
+#: Registered virtual columns, mapping column names to 2-tuples containing the names of the columns
+#: they are computed from, and the function performing the computation given an awkward array.
+virtual_columns: dict[str, tuple[set[str], Callable[[ak.Array], ak.Array]]] = {}
+
+#: Names of virtual columns that are resolved automatically whenever their inputs are present.
+auto_virtual_columns: set[str] = set()
+
+
+def virtual_column(column: str, inputs: Iterable[str], auto: bool = False) -> Callable:
+    """
+    Decorator that registers the decorated function as the implementation of a virtual *column*
+    that is computed from a set of *inputs* columns. The function should accept an awkward array
+    containing the inputs and return the values of the column. When *auto* is *True*, the column is
+    resolved whenever aliases are added to an array containing its inputs. Example:
+
+    .. code-block:: python
+
+        @virtual_column("Jet.pt_jes_up", inputs={"Jet.pt"})
+        def jet_pt_jes_up(events):
+            return events.Jet.pt * 1.03
+    """
+    def decorator(func: Callable[[ak.Array], ak.Array]) -> Callable[[ak.Array], ak.Array]:
+        virtual_columns[Route(column).column] = ({Route(c).column for c in inputs}, func)
+        if auto:
+            auto_virtual_columns.add(Route(column).column)
+        return func
+
+    return decorator
+
+
+def matching_virtual_columns(column: str | Route) -> list[str]:
+    """
+    Returns the names of all registered virtual columns that match a *column*, which is allowed to
+    contain wildcard patterns.
+    """
+    pattern = Route(column).column
+    return [name for name in virtual_columns if fnmatch.fnmatch(name, pattern)]
+
+
+def expand_virtual_inputs(columns: Iterable[str | Route]) -> set[str]:
+    """
+    Returns the names of all *columns* extended by the inputs of the virtual columns they refer to.
+    """
+    expanded = set()
+    for column in columns:
+        expanded.add(Route(column).column)
+        for name in matching_virtual_columns(column):
+            expanded |= virtual_columns[name][0]
+    return expanded
+
+
+def resolve_virtual_columns(ak_array: ak.Array, columns: Iterable[str | Route]) -> ak.Array:
+    """
+    Adds all virtual *columns* to an awkward array *ak_array* that are not existing yet but whose
+    inputs are available, and returns a new view. Other columns are ignored.
+    """
+    for column in columns:
+        for name in matching_virtual_columns(column):
+            inputs, func = virtual_columns[name]
+            if has_ak_column(ak_array, name) or not all(has_ak_column(ak_array, c) for c in inputs):
+                continue
+            ak_array = set_ak_column(ak_array, name, func(ak_array))
+    return ak_array
@@ -34,6 +34,308 @@ def patch_bundle_repo_exclude_files() -> None:
     logger.debug("patched exclude_files of cf.BundleRepo")
 
 
+@memoize
+def patch_virtual_columns() -> None:
+    import columnflow.columnar_util as cf_columnar_util
+    from agc.columnar_util import expand_virtual_inputs, resolve_virtual_columns, auto_virtual_columns
+
+    # resolve virtual columns that are used as sources of aliases, or that are resolved
+    # automatically, before adding aliases
+    add_ak_aliases_orig = cf_columnar_util.add_ak_aliases
+
+    def add_ak_aliases(ak_array, aliases, **kwargs):
+        ak_array = resolve_virtual_columns(ak_array, [*aliases.values(), *sorted(auto_virtual_columns)])
+        return add_ak_aliases_orig(ak_array, aliases, **kwargs)
+
+    cf_columnar_util.add_ak_aliases = add_ak_aliases
+
+    # read the inputs of virtual columns when the columns themselves are requested
+    ChunkedIOHandler = cf_columnar_util.ChunkedIOHandler
+    init_orig = ChunkedIOHandler.__init__
+
+    def __init__(self, *args, **kwargs):
+        init_orig(self, *args, **kwargs)
+        self.read_columns_list = [
+            (read_columns if not read_columns else type(read_columns)(expand_virtual_inputs(read_columns)))
+            for read_columns in self.read_columns_list
+        ]
+
+    ChunkedIOHandler.__init__ = __init__
+
+    logger.debug("patched add_ak_aliases and cf.ChunkedIOHandler to support virtual columns")
+
+
+@memoize
+def patch_entry_ranges() -> None:
+    from columnflow.columnar_util import ChunkedIOHandler
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from columnflow.util import maybe_import
+    from agc.sampling import (
+        get_sampling_open_options, sampled_entry_ranges, map_entry_range, intersect_entry_ranges,
+    )
+
+    ak = maybe_import("awkward")
+
+    # pass the sampling settings of the config to root sources via their open options
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        sampling_options = get_sampling_open_options(getattr(self, "config_inst", None))
+        if sampling_options and not (len(args) == 1 and isinstance(args[0], ChunkedIOHandler)):
+            source = args[0] if args else kwargs["source"]
+            is_multi = isinstance(source, (list, tuple))
+            sources = list(source) if is_multi else [source]
+            expand = lambda value: list(value) if isinstance(value, (list, tuple)) else len(sources) * [value]
+            open_options = [
+                (
+                    dict(opts or {}, **sampling_options)
+                    if src_type == "coffea_root" or (
+                        src_type is None and isinstance(src, str) and src.endswith(".root")
+                    )
+                    else opts
+                )
+                for src, src_type, opts in zip(
+                    sources,
+                    expand(kwargs.get("source_type")),
+                    expand(kwargs.get("open_options")),
+                )
+            ]
+            kwargs["open_options"] = open_options if is_multi else open_options[0]
+
+        yield from iter_chunked_io_orig(self, *args, **kwargs)
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    # only expose entries of requested ranges and sampled clusters of root files, concatenated to a
+    # virtual sequence
+    open_coffea_root_orig = ChunkedIOHandler.open_coffea_root.__func__
+    read_coffea_root_orig = ChunkedIOHandler.read_coffea_root.__func__
+
+    def open_coffea_root(cls, source, open_options=None, read_columns=None):
+        open_options = dict(open_options or {})
+        entry_ranges = open_options.pop("agc_entry_ranges", None)
+        fraction = open_options.pop("agc_sample_fraction", None)
+        seed = open_options.pop("agc_sample_seed", 0)
+
+        (source_object, tree_name), n = open_coffea_root_orig(
+            cls,
+            source,
+            open_options=open_options,
+            read_columns=read_columns,
+        )
+        if entry_ranges is None and fraction is None:
+            return (source_object, tree_name), n
+
+        ranges = [(0, n)] if entry_ranges is None else [(int(start), int(stop)) for start, stop in entry_ranges]
+        if fraction is not None:
+            ranges = intersect_entry_ranges(
+                ranges,
+                sampled_entry_ranges(source_object[tree_name], fraction, seed=seed),
+            )
+        n_selected = sum(stop - start for start, stop in ranges)
+        logger.debug(f"selected {n_selected} of {n} entries in {len(ranges)} ranges")
+
+        return (source_object, tree_name, ranges), n_selected
+
+    def read_coffea_root(cls, source_object, chunk_pos, read_options=None, read_columns=None):
+        if len(source_object) == 2:
+            return read_coffea_root_orig(cls, source_object, chunk_pos, read_options, read_columns)
+
+        # read all original ranges covered by the chunk and concatenate them
+        _source_object, tree_name, ranges = source_object
+        chunks = [
+            read_coffea_root_orig(
+                cls,
+                (_source_object, tree_name),
+                chunk_pos._replace(entry_start=start, entry_stop=stop),
+                read_options,
+                read_columns,
+            )
+            for start, stop in (map_entry_range(ranges, chunk_pos.entry_start, chunk_pos.entry_stop) or [(0, 0)])
+        ]
+
+        return chunks[0] if len(chunks) == 1 else ak.concatenate(chunks)
+
+    ChunkedIOHandler.open_coffea_root = classmethod(open_coffea_root)
+    ChunkedIOHandler.read_coffea_root = classmethod(read_coffea_root)
+
+    logger.debug("patched cf.ChunkedIOMixin and cf.ChunkedIOHandler to support entry ranges and event sampling")
+
+
+@memoize
+def patch_keep_columns() -> None:
+    from columnflow.tasks.framework.base import ConfigTask
+    from agc.keep_columns import DownstreamColumns
+
+    # expand placeholders for columns required downstream
+    expand_keep_column_orig = ConfigTask._expand_keep_column
+
+    def _expand_keep_column(self, column):
+        if isinstance(column, DownstreamColumns):
+            return column.get_columns(self)
+        return expand_keep_column_orig(self, column)
+
+    ConfigTask._expand_keep_column = _expand_keep_column
+
+    logger.debug("patched cf.ConfigTask to expand derived keep_columns")
+
+
+@memoize
+def patch_adaptive_chunking() -> None:
+    from columnflow.columnar_util import ChunkedIOHandler
+    from columnflow.tasks.framework.mixins import ChunkedIOMixin
+    from agc.chunking import AdaptiveChunkedIOHandler
+
+    # create adaptive handlers when a memory budget is configured for the task family
+    iter_chunked_io_orig = ChunkedIOMixin.iter_chunked_io
+
+    def iter_chunked_io(self, *args, **kwargs):
+        get = lambda key, default=None: law.config.get_expanded(
+            "analysis",
+            f"{self.task_family}__chunked_io_{key}",
+            law.config.get_expanded("analysis", f"chunked_io_{key}", default),
+        )
+        budget = get("memory_budget")
+        if budget and not (len(args) == 1 and isinstance(args[0], ChunkedIOHandler)):
+            # same defaults as in the original implementation
+            for key in ["chunk_size", "pool_size"]:
+                if kwargs.get(key) is None:
+                    kwargs[key] = int(get(key, getattr(self, f"default_{key}", None) or 0)) or None
+                if kwargs.get(key) is None:
+                    kwargs.pop(key, None)
+
+            # record chunk sizes per task family, dataset and shift
+            history_key = "__".join(
+                str(part) for part in [
+                    self.task_family,
+                    getattr(self, "config", None),
+                    getattr(self, "dataset", None),
+                    getattr(self, "shift", None),
+                ]
+                if part
+            )
+
+            handler = AdaptiveChunkedIOHandler(
+                *args,
+                memory_budget=law.util.parse_bytes(budget, input_unit="MB", unit="bytes"),
+                min_chunk_size=int(get("min_chunk_size", 1000)),
+                max_chunk_size=int(get("max_chunk_size", 1000000)),
+                history_key=history_key,
+                **kwargs,
+            )
+            # fall back to the default handler for sources that are not read by entry ranges
+            if handler.supports_sources:
+                args, kwargs = (handler,), {}
+            else:
+                logger.debug(f"sources of {self.task_family} do not support adaptive chunk sizes")
+
+        yield from iter_chunked_io_orig(self, *args, **kwargs)
+
+    ChunkedIOMixin.iter_chunked_io = iter_chunked_io
+
+    logger.debug("patched cf.ChunkedIOMixin to support adaptive chunk sizes")
+
+
+@memoize
+def patch_nano_prefetch() -> None:
+    from columnflow.columnar_util import ChunkedIOHandler
+    from columnflow.tasks.external import GetDatasetLFNs
+    from agc.prefetch import (
+        Replica, ReplicaSource, get_nano_store, get_http_url, get_branch_patterns, get_task_branch_patterns,
+    )
+
+    # replace remote nano files by local replicas containing only branches used by the task, and
+    # prefetch the files of subsequent branches in the background
+    iter_nano_files_orig = GetDatasetLFNs.iter_nano_files
+
+    def iter_nano_files(self, task, *args, **kwargs):
+        store = get_nano_store()
+        if store is None:
+            yield from iter_nano_files_orig(self, task, *args, **kwargs)
+            return
+
+        patterns = get_task_branch_patterns(task)
+        ahead = law.config.get_expanded_int("analysis", "prefetch_nano_ahead", 1)
+        lfns = None
+
+        for lfn_index, input_file in iter_nano_files_orig(self, task, *args, **kwargs):
+            url = get_http_url(input_file)
+            if not url:
+                yield lfn_index, input_file
+                continue
+
+            try:
+                path = store.fetch(url, patterns)
+            except Exception as e:
+                logger.warning(f"fetching branches of {url} failed, falling back to full copy: {e}")
+                yield lfn_index, input_file
+                continue
+
+            # prefetch files of the next branches at the same fs
+            if ahead > 0 and isinstance(task, law.BaseWorkflow) and task.is_branch():
+                if lfns is None:
+                    output = self.output()
+                    target = output.random_target() if isinstance(output, law.TargetCollection) else output
+                    lfns = target.load(formatter="json")
+                for branch in range(task.branch + 1, task.branch + 1 + ahead):
+                    # branches of work units contain segments starting with the lfn index
+                    next_indices = law.util.make_unique(
+                        data[0] if isinstance(data, (list, tuple)) else data
+                        for data in task.branch_map.get(branch, [])
+                    )
+                    for next_index in next_indices:
+                        next_url = get_http_url(input_file.__class__(lfns[next_index], fs=input_file.fs))
+                        if next_url:
+                            store.prefetch(next_url, patterns)
+
+            yield lfn_index, law.LocalFileTarget(path)
+
+    GetDatasetLFNs.iter_nano_files = iter_nano_files
+
+    # before opening replicas, make sure that all columns to read are fetched, and open them with a
+    # source that fetches missing ranges on demand
+    open_coffea_root_orig = ChunkedIOHandler.open_coffea_root.__func__
+
+    def open_coffea_root(cls, source, open_options=None, read_columns=None):
+        store = get_nano_store()
+        path = source[0] if isinstance(source, tuple) else source
+        replica = Replica.load(path) if store and isinstance(path, str) and store.contains(path) else None
+        if replica is not None:
+            replica.fill_branches(get_branch_patterns(read_columns) if read_columns else {"*"})
+            open_options = dict(open_options or {}, handler=ReplicaSource)
+
+        return open_coffea_root_orig(cls, source, open_options=open_options, read_columns=read_columns)
+
+    ChunkedIOHandler.open_coffea_root = classmethod(open_coffea_root)
+
+    logger.debug("patched cf.GetDatasetLFNs and cf.ChunkedIOHandler to prefetch remote nano files")
+
+
+@memoize
+def patch_read_stats() -> None:
+    from columnflow.columnar_util import ChunkedIOHandler
+    from agc.read_stats import track_source
+
+    # track the bytes read from opened root files
+    open_coffea_root_orig = ChunkedIOHandler.open_coffea_root.__func__
+
+    def open_coffea_root(cls, source, open_options=None, read_columns=None):
+        source_object, n = open_coffea_root_orig(cls, source, open_options=open_options, read_columns=read_columns)
+        track_source(source_object[0].file.source)
+        return source_object, n
+
+    ChunkedIOHandler.open_coffea_root = classmethod(open_coffea_root)
+
+    logger.debug("patched cf.ChunkedIOHandler to track bytes read from root files")
+
+
 @memoize
 def patch_all() -> None:
     patch_bundle_repo_exclude_files()
+    patch_virtual_columns()
+    # must be applied before patch_entry_ranges which adds open options when creating handlers
+    patch_adaptive_chunking()
+    patch_entry_ranges()
+    patch_keep_columns()
+    patch_nano_prefetch()
+    patch_read_stats()
@@ -0,0 +1,193 @@
+# coding: utf-8
+
+"""
+Helpers for working with the AGC file list, with a persistent, per-dataset index of file names and
+metadata that is required when building configs and when retrieving LFNs.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import json
+import hashlib
+import tempfile
+import functools
+
+import law
+
+
+logger = law.logger.get_logger(__name__)
+
+# location of the agc file list
+agc_files_path = "$AGC_SRC_BASE/analyses/cms-open-data-ttbar/nanoaod_inputs.json"
+
+
+def get_cache_dir() -> str:
+    """
+    Returns the directory in which derived information of the agc file list is cached, configurable
+    through the ``AGC_CACHE_DIR`` variable and defaulting to ``$CF_DATA/agc_cache``.
+    """
+    default = os.path.join(os.getenv("CF_DATA", tempfile.gettempdir()), "agc_cache")
+    return os.path.expandvars(os.path.expanduser(os.getenv("AGC_CACHE_DIR", default)))
+
+
+@functools.lru_cache(maxsize=None)
+def get_agc_files_hash() -> str:
+    """
+    Returns a hash of the path, modification time and size of the agc file list and of the source of
+    this module, which is used to invalidate cached information whenever either of them changes
+    without having to read the file list.
+    """
+    h = hashlib.sha256()
+    for path in [os.path.expandvars(agc_files_path), __file__]:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        h.update(f"{path}:{stat.st_mtime_ns}:{stat.st_size};".encode("utf-8"))
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def load_agc_files() -> dict:
+    """
+    Loads and returns the full agc file list.
+    """
+    with open(os.path.expandvars(agc_files_path), "r") as f:
+        return json.load(f)
+
+
+def build_agc_files_index(agc_files: dict) -> dict[str, dict[str, dict[str, list]]]:
+    """
+    Builds an index of the *agc_files* containing the LFNs, the number of events and the sizes of all
+    files per process and systematic. Sizes are set to -1 when not contained in the file list.
+    """
+    index = {}
+    for process, systs in agc_files.items():
+        index[process] = {}
+        for syst, data in systs.items():
+            index[process][syst] = {
+                "lfns": [re.match(r"^https?://.*(/store/.+)$", f["path"]).group(1) for f in data["files"]],
+                "n_events": [f.get("nevts", -1) for f in data["files"]],
+                "sizes": [f.get("size", -1) for f in data["files"]],
+                "n_events_total": data["nevts_total"],
+            }
+    return index
+
+
+def build_agc_files_summary(index: dict[str, dict[str, dict[str, list]]]) -> dict[str, dict[str, dict]]:
+    """
+    Builds a compact summary of the file *index* created by :py:func:`build_agc_files_index`
+    containing the dataset info per process and systematic, i.e., the dataset keys, the number of
+    files and the total number of events.
+    """
+    return {
+        process: {
+            # interpret the dataset "key" as the fragment after "/store/user/AGC/nanoAOD" of the
+            # first file
+            syst: {
+                "keys": [entry["lfns"][0].split("/")[5]],
+                "n_files": len(entry["lfns"]),
+                "n_events": entry["n_events_total"],
+            }
+            for syst, entry in systs.items()
+        }
+        for process, systs in index.items()
+    }
+
+
+def write_cache_file(path: str, data: dict) -> None:
+    """
+    Writes *data* as json to a cache file at *path*. The file is written atomically so that
+    concurrent processes never read partially written files. Errors, for instance due to missing
+    write permissions, are logged but not raised.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), delete=False) as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(f.name, path)
+    except OSError as e:
+        logger.debug(f"could not write agc cache file {path}: {e}")
+
+
+def read_cache_file(path: str) -> dict | None:
+    """
+    Reads and returns the json content of a cache file at *path*, or *None* if it does not exist
+    or cannot be read.
+    """
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def get_index_dir() -> str:
+    """
+    Returns the directory containing the cached summary and file index of the current agc file list.
+    """
+    return os.path.join(get_cache_dir(), f"agc_files_{get_agc_files_hash()[:16]}")
+
+
+def get_index_path(process: str, syst: str) -> str:
+    """
+    Returns the path of the cached file index of an agc *process* and systematic *syst*.
+    """
+    return os.path.join(get_index_dir(), f"index_{process}_{syst}.json")
+
+
+@functools.lru_cache(maxsize=1)
+def build_agc_files_cache() -> tuple[dict, dict]:
+    """
+    Builds the summary and the file index from the full agc file list, writes them to the cache
+    directory, and returns them in a 2-tuple. The summary is written last as it marks the cache as
+    complete.
+    """
+    index = build_agc_files_index(load_agc_files())
+    summary = build_agc_files_summary(index)
+
+    for process, systs in index.items():
+        for syst, entry in systs.items():
+            write_cache_file(get_index_path(process, syst), entry)
+    write_cache_file(os.path.join(get_index_dir(), "summary.json"), summary)
+
+    return summary, index
+
+
+@functools.lru_cache(maxsize=None)
+def get_agc_files_summary() -> dict[str, dict[str, dict]]:
+    """
+    Returns the summary of the agc file list created by :py:func:`build_agc_files_summary`. It is
+    read from the cache if existing and otherwise built from the full file list and cached.
+    """
+    summary = read_cache_file(os.path.join(get_index_dir(), "summary.json"))
+    if summary is None:
+        summary = build_agc_files_cache()[0]
+    return summary
+
+
+@functools.lru_cache(maxsize=None)
+def get_file_index(process: str, syst: str) -> dict[str, list]:
+    """
+    Returns the file index of an agc *process* and systematic *syst*, containing the lists of
+    ``lfns``, ``n_events`` and ``sizes`` per file, as well as ``n_events_total``. It is read from
+    the cache if existing and otherwise built from the full file list and cached.
+    """
+    entry = read_cache_file(get_index_path(process, syst))
+    if entry is None:
+        entry = build_agc_files_cache()[1][process][syst]
+    return entry
+
+
+def get_dataset_info(process: str, syst: str) -> dict[str, list[str] | int]:
+    """
+    Returns the dataset info of an agc *process* and systematic *syst*.
+    """
+    return dict(get_agc_files_summary()[process][syst])
+
+
+def get_dataset_lfns(process: str, syst: str) -> list[str]:
+    """
+    Returns the list of LFNs of an agc *process* and systematic *syst*.
+    """
+    return list(get_file_index(process, syst)["lfns"])
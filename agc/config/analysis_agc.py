@@ -7,7 +7,6 @@ Configuration of the analysis.
 from __future__ import annotations
 
 import os
-import re
 
 import law
 import order as od
@@ -56,7 +55,11 @@ ana.x.config_groups = {}
 # setup configs
 #
 
-from agc.config.cms_open_data_2015 import campaign_cms_opendata_2015_agc, agc_files
+from agc.config.cms_open_data_2015 import campaign_cms_opendata_2015_agc
+from agc.config.agc_files import get_dataset_lfns as get_agc_dataset_lfns
+from agc.histogramming.expressions import expression_engine
+from agc.production.categories import register_category_ids_column
+from agc.keep_columns import DownstreamColumns
 
 
 def add_config(
@@ -64,9 +67,27 @@ def add_config(
     config_name: str | None = None,
     config_id: int | None = None,
     limit_dataset_files: int | None = None,
+    multi_shift_production: bool = False,
+    virtual_jec_shifts: bool = False,
+    category_mask: bool = False,
+    sample_fraction: float | None = None,
+    compile_expressions: bool = True,
+    derive_keep_columns: bool = False,
 ) -> od.Config:
     """
-    Factory function for creating a config.
+    Factory function for creating a config from a *campaign*.
+
+    :param config_name: Name of the config, defaults to the campaign name.
+    :param config_id: Id of the config, defaults to the campaign id.
+    :param limit_dataset_files: Maximum number of files per dataset.
+    :param multi_shift_production: Select and produce all jet energy shifts at once, so that only
+        histograms are created per shift.
+    :param virtual_jec_shifts: Compute shifted jet columns on demand from the stored jer smearing.
+    :param category_mask: Store categories as a bit mask per event instead of a list of ids.
+    :param sample_fraction: Fraction of events to process, see :py:mod:`agc.sampling`.
+    :param compile_expressions: Compile variable expressions to share columns between variables.
+    :param derive_keep_columns: Derive the kept and united columns from downstream usage.
+    :return: The config.
     """
     # get all root processes
     procs = get_root_processes_from_campaign(campaign)
@@ -99,13 +120,24 @@ def add_config(
             for info in dataset.info.values():
                 info.n_files = min(info.n_files, limit_dataset_files)
 
+    # sampling of event clusters, considered when reading root files
+    # (used in columnflow_patches.patch_entry_ranges)
+    if sample_fraction is not None and not 0.0 < sample_fraction <= 1.0:
+        raise ValueError(f"sample_fraction must be in (0, 1], got {sample_fraction}")
+    cfg.x.sample_fraction = sample_fraction
+    cfg.x.sample_seed = 0
+
     # verify that the root process of all datasets is part of any of the registered processes
     verify_config_processes(cfg, warn=True)
 
     # default objects, such as calibrator, selector, producer, ml model, inference model, etc
-    cfg.x.default_calibrator = "default"
-    cfg.x.default_selector = "default"
-    cfg.x.default_producer = "default"
+    cfg.x.default_calibrator = "default_virtual" if virtual_jec_shifts else "default"
+    cfg.x.default_selector = "default_shift_union" if multi_shift_production else "default"
+    cfg.x.default_producer = "default" + (
+        ("_multi_shift" if multi_shift_production else "") +
+        ("_category_mask" if category_mask else "")
+    )
+    cfg.x.default_weight_producer = "default_multi_shift" if multi_shift_production else "default"
     cfg.x.default_ml_model = None
     cfg.x.default_inference_model = "ttbar_model"
     cfg.x.default_categories = ("preselection",)
@@ -147,12 +179,24 @@ def add_config(
     cfg.add_shift(name="nominal", id=0)
     cfg.add_shift(name="scale_up", id=1, type="shape", tags={"disjoint_from_nominal"})
     cfg.add_shift(name="scale_down", id=2, type="shape", tags={"disjoint_from_nominal"})
+    jec_aliases = {"Jet.pt": "Jet.pt_{name}"}
+    if multi_shift_production:
+        jec_aliases.update({
+            "ht": "ht_{name}",
+            "n_jet": "n_jet_{name}",
+            "trijet_mass": "trijet_mass_{name}",
+            "category_ids": "category_ids_{name}",
+        })
+        if category_mask:
+            jec_aliases["category_mask"] = "category_mask_{name}"
+            for shift_name in ["jes_up", "jes_down", "jer_up", "jer_down"]:
+                register_category_ids_column(postfix=f"_{shift_name}")
     cfg.add_shift(name="jes_up", id=3, type="shape")
     cfg.add_shift(name="jes_down", id=4, type="shape")
-    add_shift_aliases(cfg, "jes", {"Jet.pt": "Jet.pt_{name}"})
+    add_shift_aliases(cfg, "jes", jec_aliases)
     cfg.add_shift(name="jer_up", id=5, type="shape")
     cfg.add_shift(name="jer_down", id=6, type="shape")
-    add_shift_aliases(cfg, "jer", {"Jet.pt": "Jet.pt_{name}"})
+    add_shift_aliases(cfg, "jer", jec_aliases)
 
     # external files
     # (none yet)
@@ -183,6 +227,25 @@ def add_config(
             "*",
         },
     })
+    # jets selected in any shift, their shifted columns and the event selection per shift are
+    # required on nominal events for producing features and categories of all shifts
+    if multi_shift_production:
+        cfg.x.keep_columns["cf.ReduceEvents"] |= {
+            "Jet.pt_jes_*", "Jet.pt_jer_*",
+            "AnyShiftJet.pt", "AnyShiftJet.eta", "AnyShiftJet.phi", "AnyShiftJet.mass",
+            "AnyShiftJet.btagCSVV2", "AnyShiftJet.pt_jes_*", "AnyShiftJet.pt_jer_*",
+            "shift_selected.*",
+        }
+    # the jer smearing is required to compute virtual shifted jet columns after the reduction
+    if virtual_jec_shifts:
+        cfg.x.keep_columns["cf.ReduceEvents"].add("Jet.jer_smearing")
+        if multi_shift_production:
+            cfg.x.keep_columns["cf.ReduceEvents"].add("AnyShiftJet.jer_smearing")
+    # derive the minimal sets of columns from their downstream usage
+    # (this also covers shifted and virtual jet columns, so it overwrites the settings above)
+    if derive_keep_columns:
+        cfg.x.keep_columns["cf.ReduceEvents"] = {DownstreamColumns()}
+        cfg.x.keep_columns["cf.UniteColumns"] = {DownstreamColumns(before_production=False)}
 
     # event weight columns as keys in an OrderedDict, mapped to shift instances they depend on
     # (none yet)
@@ -204,11 +267,8 @@ def add_config(
         # get process and systematic names as used by the agc
         agc_process = dataset_inst.x.agc_process
         agc_syst = dataset_inst.x("agc_shifts", {}).get(shift_inst.name, shift_inst.name)
-        # retrieve and return data
-        return [
-            re.match("^https?://.*(/store/.+)$", data["path"]).group(1)
-            for data in agc_files[agc_process][agc_syst]["files"]
-        ]
+        # retrieve and return data from the file index
+        return get_agc_dataset_lfns(agc_process, agc_syst)
 
     cfg.x.get_dataset_lfns = get_dataset_lfns
     cfg.x.get_dataset_lfns_sandbox = ""
@@ -301,18 +361,44 @@ def add_config(
         x_title=r"Jet 1 $p_{T}$",
     )
 
+    # compile variable expressions
+    if compile_expressions:
+        expression_engine.compile_variables(list(cfg.variables))
+
+    return cfg
+
+
+# configs are registered as lazy factories and only built when accessed by name
+# (or when iterating over all configs), which keeps the import of the analysis fast
 
 # default config
-add_config(
-    campaign=campaign_cms_opendata_2015_agc.copy(),
-    config_name=campaign_cms_opendata_2015_agc.name,
-    config_id=1,
+ana.configs.add_lazy_factory(
+    campaign_cms_opendata_2015_agc.name,
+    lambda configs: add_config(
+        campaign=campaign_cms_opendata_2015_agc.copy(),
+        config_name=campaign_cms_opendata_2015_agc.name,
+        config_id=1,
+    ),
 )
 
 # limited test config with just 2 files per dataset
-add_config(
-    campaign=campaign_cms_opendata_2015_agc.copy(),
-    config_name=f"{campaign_cms_opendata_2015_agc.name}_limited",
-    config_id=2,
-    limit_dataset_files=2,
+ana.configs.add_lazy_factory(
+    f"{campaign_cms_opendata_2015_agc.name}_limited",
+    lambda configs: add_config(
+        campaign=campaign_cms_opendata_2015_agc.copy(),
+        config_name=f"{campaign_cms_opendata_2015_agc.name}_limited",
+        config_id=2,
+        limit_dataset_files=2,
+    ),
+)
+
+# sampled test config with 5% of the events of all files per dataset
+ana.configs.add_lazy_factory(
+    f"{campaign_cms_opendata_2015_agc.name}_sampled",
+    lambda configs: add_config(
+        campaign=campaign_cms_opendata_2015_agc.copy(),
+        config_name=f"{campaign_cms_opendata_2015_agc.name}_sampled",
+        config_id=3,
+        sample_fraction=0.05,
+    ),
 )
@@ -7,12 +7,10 @@ as used by the Analysis Grand Challenge.
 
 from __future__ import annotations
 
-import os
-import json
-
 from order import Campaign, DatasetInfo
 
 import agc.config.processes as procs
+from agc.config.agc_files import get_dataset_info
 
 
 #
@@ -32,25 +30,6 @@ campaign_cms_opendata_2015_agc = cpn = Campaign(
 )
 
 
-#
-# helpers for working with the agc file list
-#
-
-# load the agc file list
-agc_files_path = "$AGC_SRC_BASE/analyses/cms-open-data-ttbar/nanoaod_inputs.json"
-with open(os.path.expandvars(agc_files_path), "r") as f:
-    agc_files = json.load(f)
-
-
-def get_dataset_info(process: str, syst: str) -> dict[str, list[str] | int]:
-    # interpret the dataset "key" as the fragment after "/store/user/AGC/nanoAOD" of the first file
-    return {
-        "keys": [agc_files[process][syst]["files"][0]["path"].split("/")[8]],
-        "n_files": len(agc_files[process][syst]["files"]),
-        "n_events": agc_files[process][syst]["nevts_total"],
-    }
-
-
 #
 # datasets
 # (ids are pretty random, they would normally refer to IDs used in central databases)
@@ -0,0 +1,209 @@
+# coding: utf-8
+
+"""
+Batched filling of histograms of multiple variables and shifts in a single sweep.
+"""
+
+from __future__ import annotations
+
+import law
+import order as od
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import has_ak_column
+
+from agc.histogramming.expressions import ExpressionEngine, VariableExpression, expression_engine
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+hist = maybe_import("hist")
+
+
+def get_category_pairs(events: ak.Array) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the indices of *events* and the ids of the categories they belong to as two flat arrays
+    with one entry per pair. Categories are taken from the ``category_mask`` column when present,
+    with one bit per category id, and from the ``category_ids`` column otherwise.
+    """
+    if has_ak_column(events, "category_mask"):
+        mask = ak.to_numpy(events.category_mask).astype(np.uint64)
+        event_indices, category_ids = [], []
+        bits = np.arange(64, dtype=np.uint64)
+        for bit in bits[((np.bitwise_or.reduce(mask, initial=np.uint64(0)) >> bits) & np.uint64(1)) == 1]:
+            indices = np.flatnonzero((mask >> bit) & np.uint64(1))
+            event_indices.append(indices)
+            category_ids.append(np.full(len(indices), bit, dtype=np.int64))
+        if not event_indices:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(event_indices), np.concatenate(category_ids)
+
+    category_ids = events.category_ids
+    counts = ak.to_numpy(ak.num(category_ids, axis=1))
+    return (
+        np.repeat(np.arange(len(counts), dtype=np.int64), counts),
+        ak.to_numpy(ak.flatten(category_ids, axis=1)).astype(np.int64),
+    )
+
+
+class BatchedHistogrammer(object):
+    """
+    Histogrammer that fills histograms of all *variable_tuples*, mapping keys to sequences of
+    variable instances, for events of several shifts in a single sweep. Histograms have the same
+    structure as those created by ``cf.CreateHistograms``, with category, process and shift axes
+    followed by one axis per variable.
+
+    Events of each shift are added with :py:meth:`add`, which evaluates the category membership,
+    the event weight and all variables only once per event, with variable expressions being
+    evaluated through an :py:class:`~agc.histogramming.expressions.ExpressionEngine` so that columns
+    are read only once. Values are then gathered once per event-category pair, and all added shifts
+    are filled with a single call per histogram by :py:meth:`fill`. Fills with at least
+    *thread_min_entries* entries are distributed over *threads* partial histograms that are merged
+    afterwards, with zero threads referring to the number of available cores.
+
+    .. code-block:: python
+
+        histogrammer = BatchedHistogrammer({"ht": [ht_variable], "n_jet": [n_jet_variable]})
+        for shift_inst, (events, weight) in shifted_events.items():
+            histogrammer.add(events, weight, shift_inst.id)
+        histogrammer.fill(histograms)
+    """
+
+    default_threads = law.config.get_expanded_int("analysis", "histogram_fill_threads", 1)
+    default_thread_min_entries = law.config.get_expanded_int("analysis", "histogram_fill_thread_min_entries", 1000000)
+
+    def __init__(
+        self,
+        variable_tuples: dict[str, list[od.Variable]],
+        engine: ExpressionEngine = expression_engine,
+        last_edge_inclusive: bool | None = None,
+        threads: int | None = None,
+        thread_min_entries: int | None = None,
+    ):
+        super().__init__()
+
+        self.variable_tuples = {key: list(variable_insts) for key, variable_insts in variable_tuples.items()}
+        self.engine = engine
+        self.last_edge_inclusive = last_edge_inclusive
+        self.threads = self.default_threads if threads is None else threads
+        self.thread_min_entries = (
+            self.default_thread_min_entries
+            if thread_min_entries is None
+            else thread_min_entries
+        )
+
+        # variable instances by name
+        self.variable_insts = {
+            variable_inst.name: variable_inst
+            for variable_insts in self.variable_tuples.values()
+            for variable_inst in variable_insts
+        }
+
+        # expressions per variable name, parsed once
+        self._expressions = {}
+
+        # added entries, each being a dictionary of flat arrays per axis name and "weight"
+        self._batch = []
+
+    def get_expression(self, variable_inst: od.Variable) -> VariableExpression | callable:
+        if variable_inst.name not in self._expressions:
+            expr = variable_inst.expression
+            if isinstance(expr, str):
+                expr = self.engine.parse(expr, null_value=variable_inst.null_value)
+            self._expressions[variable_inst.name] = expr
+        return self._expressions[variable_inst.name]
+
+    def evaluate(self, variable_inst: od.Variable, events: ak.Array) -> np.ndarray:
+        """
+        Evaluates a *variable_inst* on *events* and returns one value per event, with missing values
+        being replaced by the null value of the variable.
+        """
+        if len(events) == 0:
+            return np.zeros(0, dtype=np.float32)
+
+        values = self.get_expression(variable_inst)(events)
+        if isinstance(values, ak.Array):
+            null_value = np.nan if variable_inst.null_value is None else variable_inst.null_value
+            values = ak.to_numpy(ak.fill_none(values, null_value))
+        values = np.asarray(values)
+        if values.ndim != 1:
+            raise ValueError(
+                f"variable '{variable_inst.name}' with expression {variable_inst.expression!r} does "
+                "not evaluate to a single value per event",
+            )
+
+        return values
+
+    def add(self, events: ak.Array, weight: ak.Array | np.ndarray, shift_id: int) -> None:
+        """
+        Adds *events* with event *weight* for a shift with id *shift_id* to the batch.
+        """
+        event_indices, category_ids = get_category_pairs(events)
+        process_ids = ak.to_numpy(events.process_id) if len(events) else np.zeros(0, dtype=np.int64)
+
+        entry = {
+            "category": category_ids,
+            "process": process_ids[event_indices],
+            "shift": np.full(len(event_indices), shift_id, dtype=np.int64),
+            "weight": np.asarray(weight, dtype=np.float64)[event_indices],
+        }
+        for name, variable_inst in self.variable_insts.items():
+            entry[name] = self.evaluate(variable_inst, events)[event_indices]
+
+        self._batch.append(entry)
+
+    def create_histogram(self, variable_insts: list[od.Variable]) -> hist.Hist:
+        h = (
+            hist.Hist.new
+            .IntCat([], name="category", growth=True)
+            .IntCat([], name="process", growth=True)
+            .IntCat([], name="shift", growth=True)
+        )
+        for variable_inst in variable_insts:
+            h = h.Var(
+                variable_inst.bin_edges,
+                name=variable_inst.name,
+                label=variable_inst.get_full_x_title(),
+            )
+        return h.Weight()
+
+    def fill(self, histograms: dict[str, hist.Hist] | None = None) -> dict[str, hist.Hist]:
+        """
+        Fills all entries added since the last call into *histograms*, creating missing ones, and
+        returns them.
+        """
+        if histograms is None:
+            histograms = {}
+
+        # concatenate all entries
+        if not self._batch:
+            return histograms
+        data = {
+            key: np.concatenate([entry[key] for entry in self._batch])
+            for key in self._batch[0]
+        }
+        self._batch.clear()
+
+        # values on the last edge of variable axes are shifted into the last bin
+        for name, variable_inst in self.variable_insts.items():
+            edges = np.asarray(variable_inst.bin_edges, dtype=np.float64)
+            if self.last_edge_inclusive is False or len(edges) < 2:
+                continue
+            on_edge = data[name] == edges[-1]
+            if np.any(on_edge):
+                data[name] = np.where(on_edge, edges[-1] - (edges[-1] - edges[-2]) * 1e-5, data[name])
+
+        n = len(data["weight"])
+        threads = self.threads if self.threads != 1 and n >= self.thread_min_entries else None
+        for var_key, variable_insts in self.variable_tuples.items():
+            if var_key not in histograms:
+                histograms[var_key] = self.create_histogram(variable_insts)
+            histograms[var_key].fill(
+                category=data["category"],
+                process=data["process"],
+                shift=data["shift"],
+                weight=data["weight"],
+                threads=threads,
+                **{variable_inst.name: data[variable_inst.name] for variable_inst in variable_insts},
+            )
+
+        return histograms
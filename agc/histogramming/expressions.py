@@ -0,0 +1,177 @@
+# coding: utf-8
+
+"""
+Compiled evaluation of variable expressions that shares column reads between variables.
+"""
+
+from __future__ import annotations
+
+import re
+import weakref
+from typing import Any
+
+import order as od
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+# plain columns, optionally followed by a single element access such as "[:,0]"
+expression_re = re.compile(r"^([a-zA-Z_][a-zA-Z0-9_]*(?:\.[a-zA-Z_][a-zA-Z0-9_]*)*)(?:\[\s*:\s*,\s*(\d+)\s*\])?$")
+
+
+class VariableExpression(object):
+    """
+    Callable expression of a single variable, evaluated by an :py:class:`ExpressionEngine`. The
+    *column* is accessed at *index* per event when set, with missing elements being replaced by the
+    *null_value*. Expressions that cannot be compiled are evaluated through their *route*.
+    """
+
+    def __init__(
+        self,
+        engine: ExpressionEngine,
+        expression: str,
+        column: str | None = None,
+        index: int | None = None,
+        null_value: Any = None,
+    ):
+        super().__init__()
+
+        self.engine = engine
+        self.expression = expression
+        self.column = column
+        self.index = index
+        self.null_value = null_value
+        self.route = Route(expression)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.expression}' at {hex(id(self))}>"
+
+    @property
+    def compiled(self) -> bool:
+        return self.column is not None
+
+    @property
+    def inputs(self) -> list[Route]:
+        return [Route(self.column) if self.compiled else self.route]
+
+    def __call__(self, events: ak.Array, *args, **kwargs) -> np.ndarray | ak.Array:
+        return self.engine.evaluate(self, events)
+
+
+class ExpressionEngine(object):
+    """
+    Engine that parses variable expressions once and evaluates them on chunks of events. Columns
+    are read only once per chunk, and jagged columns are converted once into flat buffers and
+    offsets, which are shared between all expressions accessing them. Element accesses such as
+    ``Jet.pt[:,0]`` are compiled into single gathers on these buffers.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        # cache of columns and flat buffers, valid for the last events chunk
+        self._events_ref = None
+        self._cache = {}
+
+    def parse(self, expression: str, null_value: Any = None) -> VariableExpression:
+        """
+        Parses an *expression* string and returns a :py:class:`VariableExpression`. Element
+        accesses are only compiled when a *null_value* is defined.
+        """
+        m = expression_re.match(expression)
+        if not m or (m.group(2) is not None and null_value is None):
+            return VariableExpression(self, expression, null_value=null_value)
+
+        index = None if m.group(2) is None else int(m.group(2))
+        return VariableExpression(self, expression, column=m.group(1), index=index, null_value=null_value)
+
+    def compile_variables(self, variable_insts: list[od.Variable]) -> None:
+        """
+        Replaces the string expressions of all *variable_insts* by compiled expressions and stores
+        the columns they read in their ``inputs`` auxiliary field.
+        """
+        for variable_inst in variable_insts:
+            if not isinstance(variable_inst.expression, str):
+                continue
+            expr = self.parse(variable_inst.expression, null_value=variable_inst.null_value)
+            variable_inst.expression = expr
+            variable_inst.x.inputs = expr.inputs
+
+    def _get_cached(self, events: ak.Array, key: tuple, func: callable) -> Any:
+        # reset the cache when a new events chunk is passed
+        if self._events_ref is None or self._events_ref() is not events:
+            self._events_ref = weakref.ref(events)
+            self._cache.clear()
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def get_column(self, events: ak.Array, column: str) -> ak.Array:
+        return self._get_cached(events, ("column", column), lambda: Route(column).apply(events))
+
+    def get_flat(self, events: ak.Array, column: str) -> tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+        """
+        Returns the flat values of a jagged *column* of *events*, as well as the number of elements
+        and the start offsets per event, or *None* when the column cannot be represented this way.
+        Counts and offsets are shared between all columns of the same collection.
+        """
+        def flatten():
+            arr = self.get_column(events, column)
+            if arr.ndim != 2:
+                return None
+            collection = column.rsplit(".", 1)[0] if "." in column else column
+            counts, starts = self._get_cached(events, ("offsets", collection), lambda: get_offsets(arr))
+            try:
+                flat = ak.to_numpy(ak.flatten(arr, axis=1))
+            except ValueError:
+                return None
+            return flat, counts, starts
+
+        def get_offsets(arr):
+            counts = ak.to_numpy(ak.num(arr, axis=1))
+            starts = np.zeros(len(counts), dtype=np.int64)
+            np.cumsum(counts[:-1], out=starts[1:])
+            return counts, starts
+
+        return self._get_cached(events, ("flat", column), flatten)
+
+    def evaluate(self, expr: VariableExpression, events: ak.Array) -> np.ndarray | ak.Array:
+        """
+        Evaluates a compiled expression *expr* on *events*.
+        """
+        # empty inputs might lack columns entirely
+        if len(events) == 0:
+            return ak.Array(np.array([], dtype=np.float32))
+
+        # fallback to the route
+        if not expr.compiled:
+            return self._get_cached(
+                events,
+                ("route", expr.expression, expr.null_value),
+                lambda: expr.route.apply(events, null_value=expr.null_value),
+            )
+
+        # plain columns
+        if expr.index is None:
+            return self.get_column(events, expr.column)
+
+        # element access, gathered from flat buffers
+        flat = self.get_flat(events, expr.column)
+        if flat is None:
+            return expr.route.apply(events, null_value=expr.null_value)
+        values, counts, starts = flat
+        valid = counts > expr.index
+        idx = starts[valid] + expr.index
+
+        result = np.full(len(counts), expr.null_value, dtype=values.dtype if values.dtype.kind == "f" else np.float64)
+        result[valid] = values[idx]
+
+        return result
+
+
+#: Default engine instance.
+expression_engine = ExpressionEngine()
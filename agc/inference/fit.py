@@ -0,0 +1,435 @@
+# coding: utf-8
+
+"""
+In-process binned likelihood fits of inference models, using templates extracted directly from
+histograms instead of datacards and an external combine run.
+"""
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+
+import order as od
+
+from columnflow.inference import InferenceModel, ParameterType
+from columnflow.util import maybe_import, DotDict
+
+np = maybe_import("numpy")
+hist = maybe_import("hist")
+scipy = maybe_import("scipy")
+maybe_import("scipy.optimize")
+maybe_import("scipy.special")
+
+
+def get_category_histograms(
+    inference_model_inst: InferenceModel,
+    histograms: dict[str, hist.Hist],
+    config_inst: od.Config | None = None,
+) -> dict[str, dict]:
+    """
+    Extracts the nominal and shifted histograms of all categories and processes of an
+    *inference_model_inst* from *histograms*, mapping config variable names to histograms with
+    category, process and shift axes such as those created by ``agc.MergeExpressHistograms``, summed
+    over all datasets. The returned structure is the same as the one passed to the datacard writer,
+    i.e., "category -> process -> nominal/parameter -> down/up -> histogram", with an additional
+    "data" entry per category when real data is contained in *histograms*.
+    """
+    config_inst = config_inst or inference_model_inst.config_inst
+    nominal_id = config_inst.get_shift("nominal").id
+
+    def select(h, process_inst, category_insts):
+        process_ids = [p.id for p, _, _ in process_inst.walk_processes(include_self=True)]
+        process_locs = [hist.loc(i) for i in process_ids if i in h.axes["process"]]
+        category_locs = [hist.loc(c.id) for c in category_insts if c.id in h.axes["category"]]
+        if not process_locs:
+            raise Exception(f"no histograms found for process '{process_inst.name}'")
+        return h[{"process": process_locs, "category": category_locs}][{"process": sum, "category": sum}]
+
+    def get_shift(h, shift_name, process_name):
+        shift_id = config_inst.get_shift(shift_name).id
+        if shift_id not in h.axes["shift"]:
+            raise Exception(f"no histograms found for shift '{shift_name}' of process '{process_name}'")
+        return h[{"shift": hist.loc(shift_id)}]
+
+    hists = OrderedDict()
+    for cat_obj in inference_model_inst.categories:
+        category_inst = config_inst.get_category(cat_obj.config_category)
+        leaf_category_insts = category_inst.get_leaf_categories() or [category_inst]
+        h_var = histograms[cat_obj.config_variable]
+
+        _hists = hists[cat_obj.name] = OrderedDict()
+        for proc_obj in cat_obj.processes:
+            h_proc = select(h_var, config_inst.get_process(proc_obj.config_process), leaf_category_insts)
+            __hists = _hists[proc_obj.name] = OrderedDict()
+            __hists["nominal"] = get_shift(h_proc, "nominal", proc_obj.name)
+            for param_obj in proc_obj.parameters:
+                if not inference_model_inst.require_shapes_for_parameter(param_obj):
+                    continue
+                __hists[param_obj.name] = {
+                    d: get_shift(h_proc, f"{param_obj.config_shift_source}_{d}", proc_obj.name)
+                    for d in ["down", "up"]
+                }
+
+        # real data, only nominal
+        if cat_obj.config_data_datasets and config_inst.has_process("data"):
+            h_data = select(h_var, config_inst.get_process("data"), leaf_category_insts)
+            if nominal_id in h_data.axes["shift"]:
+                _hists["data"] = {"nominal": h_data[{"shift": hist.loc(nominal_id)}]}
+
+    return hists
+
+
+class TemplateModel(object):
+    """
+    Binned likelihood model of an *inference_model_inst* built from *histograms* in the structure
+    returned by :py:func:`get_category_histograms`.
+
+    Parameters are the signal strength ``r`` of all signal processes, followed by nuisances in the
+    order of the inference model. Rate parameters scale process yields by asymmetric log-normal
+    factors, and shape parameters morph bin contents vertically between the down, nominal and up
+    templates, except for bins that are empty in the nominal template. Both effects are interpolated
+    quadratically for parameter values within [-1, 1] and extrapolated linearly beyond, continuous
+    in the first derivative. Gaussian constraints are applied to all parameters of type
+    ``rate_gauss`` and ``shape``. Statistical uncertainties of templates in categories with
+    *mc_stats* enabled are included as one multiplicative parameter per bin, whose value is profiled
+    analytically (Barlow-Beeston lite).
+
+    All template entries of all categories and processes are stored as flat arrays, so that the
+    expectation and the negative log-likelihood are evaluated for a batch of parameter points with a
+    few vectorized operations, including their analytic gradients and Hessians.
+
+    .. code-block:: python
+
+        model = TemplateModel(inference_model_inst, get_category_histograms(inference_model_inst, hists))
+        result = model.fit()
+        print(f"r = {result.parameters['r']:.3f} +- {result.errors['r']:.3f}")
+    """
+
+    poi = "r"
+
+    def __init__(
+        self,
+        inference_model_inst: InferenceModel,
+        histograms: dict[str, dict],
+        poi_bounds: tuple[float, float] = (0.0, 10.0),
+        nuisance_bounds: tuple[float, float] = (-5.0, 5.0),
+        min_yield: float = 1e-9,
+    ):
+        super().__init__()
+
+        self.inference_model_inst = inference_model_inst
+        self.min_yield = min_yield
+
+        # parameter names and types
+        self.parameter_names = [self.poi]
+        self.constrained = [False]
+        for param_name in inference_model_inst.get_parameters(flat=True):
+            types = {
+                param_obj.type
+                for _, _, param_obj in inference_model_inst.iter_parameters(parameter=param_name)
+            }
+            unsupported = types - {ParameterType.rate_gauss, ParameterType.shape}
+            if unsupported:
+                raise NotImplementedError(
+                    f"parameter '{param_name}' has unsupported type(s) {', '.join(map(str, unsupported))}",
+                )
+            self.parameter_names.append(param_name)
+            self.constrained.append(True)
+        self.constrained = np.array(self.constrained)
+        self.bounds = [poi_bounds] + [nuisance_bounds] * (len(self.parameter_names) - 1)
+        param_index = {name: i for i, name in enumerate(self.parameter_names)}
+
+        # template entries, one per bin of each process in each category
+        self.category_slices = OrderedDict()
+        nominal, variance, signal, entry_bins = [], [], [], []
+        up, down, log_up, log_down = [], [], [], []
+        observed, mc_stats = [], []
+        n_params = len(self.parameter_names)
+        n_bins = 0
+        for cat_obj in inference_model_inst.categories:
+            cat_hists = histograms[cat_obj.name]
+
+            def values(h, scale):
+                v = h.values() * scale
+                return np.where(v > 0, v, cat_obj.empty_bin_value or 0.0)
+
+            cat_nominal = OrderedDict()
+            for proc_obj in cat_obj.processes:
+                proc_hists = cat_hists[proc_obj.name]
+                h_nom = proc_hists["nominal"]
+                nom = values(h_nom, proc_obj.scale)
+                cat_nominal[proc_obj.name] = nom
+                n = len(nom)
+
+                nominal.append(nom)
+                variance.append(h_nom.variances() * proc_obj.scale**2)
+                signal.append(np.full(n, proc_obj.is_signal))
+                entry_bins.append(n_bins + np.arange(n))
+
+                # effects per parameter
+                _up, _down = np.zeros((n_params, n)), np.zeros((n_params, n))
+                _log_up, _log_down = np.zeros((n_params, n)), np.zeros((n_params, n))
+                for param_obj in proc_obj.parameters:
+                    i = param_index[param_obj.name]
+                    if param_obj.type.is_shape:
+                        # bins that are empty in the nominal template are not morphed
+                        filled = h_nom.values() * proc_obj.scale > 0
+                        for d, effect in [("down", _down[i]), ("up", _up[i])]:
+                            effect[filled] = (values(proc_hists[param_obj.name][d], proc_obj.scale) - nom)[filled]
+                    else:
+                        effect = param_obj.effect
+                        if not isinstance(effect, tuple):
+                            effect = (1.0 / effect, effect)
+                        _log_down[i] = np.log(effect[0])
+                        _log_up[i] = np.log(effect[1])
+                up.append(_up)
+                down.append(_down)
+                log_up.append(_log_up)
+                log_down.append(_log_down)
+
+            # observed counts from real data or fake data from processes
+            if "data" in cat_hists:
+                observed.append(cat_hists["data"]["nominal"].values())
+            elif cat_obj.data_from_processes:
+                observed.append(sum(cat_nominal[proc_name] for proc_name in cat_obj.data_from_processes))
+            else:
+                observed.append(sum(cat_nominal.values()))
+            mc_stats.append(np.full(len(observed[-1]), cat_obj.mc_stats not in (None, False)))
+
+            self.category_slices[cat_obj.name] = slice(n_bins, n_bins + len(observed[-1]))
+            n_bins += len(observed[-1])
+
+        self.n_bins = n_bins
+        self.nominal = np.concatenate(nominal)
+        self.signal = np.concatenate(signal)
+        self.observed = np.concatenate(observed)
+
+        # coefficients of the interpolation of effects, being a * theta + b * q(theta) with q(theta)
+        # being theta**2 within [-1, 1] and continued linearly beyond
+        up, down = np.concatenate(up, axis=1), np.concatenate(down, axis=1)
+        log_up, log_down = np.concatenate(log_up, axis=1), np.concatenate(log_down, axis=1)
+        self.shape_a, self.shape_b = 0.5 * (up - down), 0.5 * (up + down)
+        self.rate_a, self.rate_b = 0.5 * (log_up - log_down), 0.5 * (log_up + log_down)
+
+        # matrix summing entries into bins
+        entry_bins = np.concatenate(entry_bins)
+        self.bin_matrix = np.zeros((len(entry_bins), n_bins))
+        self.bin_matrix[np.arange(len(entry_bins)), entry_bins] = 1.0
+
+        # relative statistical uncertainties of the total expectation per bin
+        total = self.nominal @ self.bin_matrix
+        total_variance = np.concatenate(variance) @ self.bin_matrix
+        self.stat_variance = np.where(
+            np.concatenate(mc_stats) & (total > 0),
+            total_variance / np.maximum(total, min_yield)**2,
+            0.0,
+        )
+
+    @property
+    def n_parameters(self) -> int:
+        return len(self.parameter_names)
+
+    def get_initial_parameters(self, r: float = 1.0) -> np.ndarray:
+        x = np.zeros(self.n_parameters)
+        x[0] = r
+        return x
+
+    def _evaluate(self, x: np.ndarray) -> DotDict:
+        # clipped parameters and the quadratic interpolation term
+        theta = np.clip(x, -1.0, 1.0)
+        q = theta * (2 * x - theta)
+
+        # vertical morphing and log-normal rate factors
+        shape = self.nominal + x @ self.shape_a + q @ self.shape_b
+        positive = shape > self.min_yield
+        shape = np.where(positive, shape, self.min_yield)
+        rate = np.exp(x @ self.rate_a + q @ self.rate_b)
+
+        # signal strength
+        r = np.where(self.signal, x[..., :1], 1.0)
+        entries = shape * rate
+        yields = r * entries
+        expected = yields @ self.bin_matrix
+        valid = expected > self.min_yield
+
+        return DotDict(
+            theta=theta,
+            inside=np.abs(x) < 1,
+            rate_factor=rate * positive,
+            shape_factor=r * rate * positive,
+            entries=entries,
+            yields=yields,
+            expected=np.where(valid, expected, self.min_yield),
+            valid=valid,
+        )
+
+    def _entry_derivatives(self, ev: DotDict) -> tuple[np.ndarray, np.ndarray]:
+        # derivatives of shape effects and of log rate factors per template entry
+        theta = ev.theta[..., :, None]
+        return self.shape_a + 2 * theta * self.shape_b, self.rate_a + 2 * theta * self.rate_b
+
+    def _expected_grad(self, ev: DotDict, d_shape: np.ndarray, d_rate: np.ndarray) -> np.ndarray:
+        # derivatives of template entries, summed into bins
+        entry_grad = ev.shape_factor[..., None, :] * d_shape + ev.yields[..., None, :] * d_rate
+        entry_grad[..., 0, :] = np.where(self.signal, ev.entries, 0.0)
+        return np.where(ev.valid[..., None, :], entry_grad @ self.bin_matrix, 0.0)
+
+    def expected(self, x: np.ndarray, grad: bool = False) -> np.ndarray | tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the expected yields per bin for parameter points *x* of shape ``(..., P)``, with
+        shape ``(..., B)``. When *grad* is *True*, the derivatives with respect to all parameters are
+        returned as well, with shape ``(..., P, B)``.
+        """
+        ev = self._evaluate(np.asarray(x, dtype=np.float64))
+        if not grad:
+            return ev.expected
+        return ev.expected, self._expected_grad(ev, *self._entry_derivatives(ev))
+
+    def nll(
+        self,
+        x: np.ndarray,
+        observed: np.ndarray | None = None,
+        grad: bool = False,
+        global_obs: np.ndarray | None = None,
+        hessian: bool = False,
+    ) -> np.ndarray | tuple[np.ndarray, ...]:
+        """
+        Returns the negative log-likelihood for parameter points *x* of shape ``(..., P)`` and
+        *observed* counts of shape ``(..., B)``, defaulting to the observed counts of the model,
+        relative to the saturated model. Constraints of nuisances are centered at *global_obs*, of
+        shape ``(..., P)`` and defaulting to zero. When *grad* is *True*, the gradient with respect to
+        all parameters is returned as well. When *hessian* is *True*, the Hessian with shape
+        ``(..., P, P)`` is returned in addition.
+        """
+        if observed is None:
+            observed = self.observed
+        x = np.asarray(x, dtype=np.float64)
+        ev = self._evaluate(x)
+        nu = ev.expected
+        pull = np.where(self.constrained, x if global_obs is None else x - global_obs, 0.0)
+
+        # profile the per-bin statistical parameters analytically
+        s2 = self.stat_variance
+        c = 1.0 - nu * s2
+        root = np.sqrt(c**2 + 4 * observed * s2)
+        gamma = np.where(s2 > 0, 0.5 * (c + root), 1.0)
+        mu = nu * gamma
+
+        xlogy = scipy.special.xlogy
+        value = (
+            (mu - observed + xlogy(observed, observed) - xlogy(observed, mu)).sum(axis=-1) +
+            0.5 * (np.where(s2 > 0, (gamma - 1)**2 / np.where(s2 > 0, s2, 1.0), 0.0)).sum(axis=-1) +
+            0.5 * (pull**2).sum(axis=-1)
+        )
+        if not grad and not hessian:
+            return value
+
+        # the derivative with respect to the profiled parameters vanishes at their minimum, so the
+        # gradient is propagated through template entries with matrix products only
+        w = np.where(ev.valid, gamma - observed / nu, 0.0) @ self.bin_matrix.T
+        u = ev.shape_factor * w
+        v = ev.yields * w
+        value_grad = (
+            u @ self.shape_a.T + 2 * ev.theta * (u @ self.shape_b.T) +
+            v @ self.rate_a.T + 2 * ev.theta * (v @ self.rate_b.T) +
+            pull
+        )
+        value_grad[..., 0] = (np.where(self.signal, ev.entries, 0.0) * w).sum(axis=-1)
+        if not hessian:
+            return value, value_grad
+
+        # first derivatives of the expectation, weighted by the second derivative of the profiled
+        # likelihood with respect to the expectation
+        d_shape, d_rate = self._entry_derivatives(ev)
+        jac = self._expected_grad(ev, d_shape, d_rate)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            curvature = observed / nu**2 - np.where(s2 > 0, s2 * gamma / root, 0.0)
+        h = (jac * np.where(ev.valid, curvature, 0.0)[..., None, :]) @ np.swapaxes(jac, -1, -2)
+
+        # second derivatives of template entries, weighted by the first derivative
+        h_mixed = (d_shape * u[..., None, :]) @ np.swapaxes(d_rate, -1, -2)
+        h_entries = h_mixed + np.swapaxes(h_mixed, -1, -2) + (d_rate * v[..., None, :]) @ np.swapaxes(d_rate, -1, -2)
+        h_diag = 2 * ev.inside * (u @ self.shape_b.T + v @ self.rate_b.T)
+        h_signal = (
+            (d_shape * np.where(self.signal, ev.rate_factor * w, 0.0)[..., None, :]).sum(axis=-1) +
+            (d_rate * np.where(self.signal, ev.entries * w, 0.0)[..., None, :]).sum(axis=-1)
+        )
+        h_entries[..., 0, :] = h_signal
+        h_entries[..., :, 0] = h_signal
+        h_entries[..., 0, 0] = 0.0
+
+        h += h_entries + h_diag[..., None, :] * np.eye(self.n_parameters)
+        h += np.diag(self.constrained.astype(np.float64))
+        return value, value_grad, h
+
+    def hessian(
+        self,
+        x: np.ndarray,
+        observed: np.ndarray | None = None,
+        global_obs: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Returns the Hessian of the negative log-likelihood at parameter points *x* of shape
+        ``(..., P)``, with shape ``(..., P, P)``.
+        """
+        return self.nll(x, observed, global_obs=global_obs, hessian=True)[2]
+
+    def minimize(
+        self,
+        observed: np.ndarray | None = None,
+        x0: np.ndarray | None = None,
+        fixed: dict[int, float] | None = None,
+        tol: float = 1e-9,
+    ) -> tuple[np.ndarray, float, bool, int]:
+        """
+        Minimizes the negative log-likelihood for *observed* counts, starting from *x0*, with
+        parameters at indices in *fixed* being fixed to the mapped values. Returns the best-fit
+        parameters, the minimum, whether the minimization succeeded and the number of evaluations.
+        """
+        x0 = self.get_initial_parameters() if x0 is None else np.array(x0, dtype=np.float64)
+        bounds = list(self.bounds)
+        for i, value in (fixed or {}).items():
+            x0[i] = value
+            bounds[i] = (value, value)
+
+        res = scipy.optimize.minimize(
+            self.nll,
+            x0,
+            args=(observed, True),
+            jac=True,
+            method="L-BFGS-B",
+            bounds=bounds,
+            options={"ftol": tol, "gtol": tol * 1e-1, "maxiter": 1000},
+        )
+        return res.x, float(res.fun), bool(res.success), int(res.nfev)
+
+    def fit(self, observed: np.ndarray | None = None, x0: np.ndarray | None = None) -> DotDict:
+        """
+        Fits all parameters to *observed* counts, defaulting to those of the model, and returns a
+        dictionary with the best-fit values, their uncertainties from the inverse Hessian, the
+        minimum of the negative log-likelihood and fit diagnostics. The covariance is only meaningful
+        when the Hessian is positive definite, as flagged by *hessian_valid*, and when no parameter is
+        on one of its bounds, in which case the likelihood is not minimal with respect to it. Names of
+        such parameters are listed in *at_bounds*.
+        """
+        t1 = time.perf_counter()
+        x, nll, success, n_eval = self.minimize(observed=observed, x0=x0)
+
+        h = self.hessian(x, observed=observed)
+        cov = np.linalg.pinv(h)
+        errors = np.sqrt(np.maximum(np.diag(cov), 0.0))
+        lower, upper = np.array(self.bounds).T
+        at_bounds = np.isclose(x, lower) | np.isclose(x, upper)
+
+        return DotDict(
+            parameters=OrderedDict(zip(self.parameter_names, map(float, x))),
+            errors=OrderedDict(zip(self.parameter_names, map(float, errors))),
+            covariance=cov.tolist(),
+            nll=nll,
+            success=success,
+            hessian_valid=bool(np.all(np.linalg.eigvalsh(h) > 0)),
+            at_bounds=[name for name, flag in zip(self.parameter_names, at_bounds) if flag],
+            n_eval=n_eval,
+            duration=time.perf_counter() - t1,
+        )
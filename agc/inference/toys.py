@@ -0,0 +1,291 @@
+# coding: utf-8
+
+"""
+Batched pseudo-experiments and likelihood scans on top of
+:py:class:`~agc.inference.fit.TemplateModel`.
+"""
+
+from __future__ import annotations
+
+import time
+
+from columnflow.util import maybe_import, DotDict
+
+from agc.inference.fit import TemplateModel
+from agc.parallel import ForkedChunkPool
+
+np = maybe_import("numpy")
+
+
+def minimize_batch(
+    model: TemplateModel,
+    x0: np.ndarray,
+    observed: np.ndarray,
+    global_obs: np.ndarray | None = None,
+    fixed: np.ndarray | None = None,
+    tol: float = 1e-7,
+    max_iter: int = 100,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Minimizes the negative log-likelihood of a *model* for a batch of *observed* counts of shape
+    ``(N, B)`` and optional *global_obs* of shape ``(N, P)``, starting from parameters *x0* of shape
+    ``(N, P)``, with parameters marked in the boolean *fixed* mask, of shape ``(P,)`` or ``(N, P)``,
+    remaining at their start values. Returns the best-fit parameters, the minima and a mask of
+    converged minimizations.
+
+    All minimizations are performed simultaneously with damped Newton steps (Levenberg-Marquardt),
+    so that each iteration evaluates the negative log-likelihood, its gradient and its Hessian once
+    for the whole batch. Hessians that are not positive definite are shifted by a multiple of the
+    identity. Parameters on a bound whose gradient points outwards are held fixed in a step.
+    """
+    x = np.array(x0, dtype=np.float64)
+    n, n_params = x.shape
+    lower, upper = np.array(model.bounds).T
+    fixed = np.broadcast_to(np.zeros(n_params, dtype=bool) if fixed is None else fixed, x.shape)
+    eye = np.eye(n_params)
+
+    nll, grad, hess = model.nll(x, observed, grad=True, global_obs=global_obs, hessian=True)
+    damping = np.full(n, 1e-3)
+    converged = np.zeros(n, dtype=bool)
+    for _ in range(max_iter):
+        index = np.flatnonzero(~converged)
+        if not len(index):
+            break
+
+        # reduced newton system per minimization, with identity rows for held parameters
+        _x, _grad = x[index], grad[index]
+        held = fixed[index] | ((_x <= lower) & (_grad > 0)) | ((_x >= upper) & (_grad < 0))
+        h = np.where(held[:, :, None] | held[:, None, :], 0.0, hess[index]) + eye * held[:, :, None]
+        eigvals = np.linalg.eigvalsh(h)
+        shift = np.where(eigvals[:, 0] > 0, 0.0, 1e-6 * np.abs(eigvals[:, -1]) - eigvals[:, 0])
+        h += shift[:, None, None] * eye
+        h += damping[index, None, None] * eye * np.diagonal(h, axis1=-2, axis2=-1)[:, None, :]
+        step = np.linalg.solve(h, np.where(held, 0.0, _grad)[..., None])[..., 0]
+
+        # evaluate and accept improvements
+        x_new = np.clip(_x - step, lower, upper)
+        nll_new, grad_new, hess_new = model.nll(
+            x_new,
+            observed[index],
+            grad=True,
+            global_obs=None if global_obs is None else global_obs[index],
+            hessian=True,
+        )
+        improved = nll_new <= nll[index]
+        change = np.abs(nll[index] - nll_new)
+
+        accepted = index[improved]
+        x[accepted] = x_new[improved]
+        nll[accepted] = nll_new[improved]
+        grad[accepted] = grad_new[improved]
+        hess[accepted] = hess_new[improved]
+        damping[index] = np.where(improved, damping[index] * 0.3, damping[index] * 10.0)
+
+        # converged when the change is below tolerance, stuck when the damping grows too large
+        converged[index] = (change < tol) | (damping[index] > 1e10)
+
+    # minimizations stopped by damping did not converge
+    converged &= damping <= 1e10
+
+    return x, nll, converged
+
+
+def scan_crossings(values: np.ndarray, delta_nll: np.ndarray, level: float = 0.5) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the lower and upper points of scans where *delta_nll*, of shape ``(N, M)`` with scan
+    *values* of shape ``(M,)``, crosses *level*, linearly interpolated between the scan points next
+    to the minimum. Crossings outside the scan range are set to nan.
+    """
+    n, m = delta_nll.shape
+    i_min = np.argmin(delta_nll, axis=-1)
+    above = delta_nll >= level
+    indices = np.arange(m)
+
+    def crossing(side_mask, neighbor):
+        # last index above level on the side of the minimum, interpolated towards its neighbor
+        i = np.where(side_mask & above, indices, -1 if neighbor > 0 else m)
+        i = i.max(axis=-1) if neighbor > 0 else i.min(axis=-1)
+        valid = (i >= 0) & (i < m) & (i + neighbor >= 0) & (i + neighbor < m)
+        i = np.clip(i, 0, m - 1)
+        j = np.clip(i + neighbor, 0, m - 1)
+        rows = np.arange(n)
+        d_i, d_j = delta_nll[rows, i], delta_nll[rows, j]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            f = (d_i - level) / (d_i - d_j)
+        return np.where(valid, values[i] + f * (values[j] - values[i]), np.nan)
+
+    lower = crossing(indices[None, :] < i_min[:, None], 1)
+    upper = crossing(indices[None, :] > i_min[:, None], -1)
+    return lower, upper
+
+
+class ToyEngine(object):
+    """
+    Engine for pseudo-experiments of a :py:class:`~agc.inference.fit.TemplateModel` *model*.
+
+    Pseudo-datasets are generated as a single array of Poisson-distributed counts per bin, together
+    with global observables of constrained parameters drawn from their constraints. The negative
+    log-likelihood of all toys and scan points is evaluated in vectorized batches, and minimizations
+    are performed in chunks of *chunk_size* with :py:func:`minimize_batch`, distributed over
+    *processes* forked processes (see :py:class:`agc.parallel.ForkedChunkPool`).
+
+    .. code-block:: python
+
+        engine = ToyEngine(model, processes=4)
+        toys = engine.generate(1000, seed=1)
+        result = engine.fit_toys(toys, scan_values=np.linspace(0.8, 1.2, 21))
+        print(result.summary)
+    """
+
+    def __init__(self, model: TemplateModel, processes: int = 1, chunk_size: int = 500):
+        super().__init__()
+
+        self.model = model
+        self.processes = processes
+        self.chunk_size = chunk_size
+
+    def generate(
+        self,
+        n_toys: int,
+        x_true: np.ndarray | None = None,
+        seed: int | None = None,
+        randomize_global_obs: bool = True,
+    ) -> DotDict:
+        """
+        Generates *n_toys* pseudo-datasets for true parameters *x_true*, defaulting to a signal
+        strength of 1 and nominal nuisances. When *randomize_global_obs* is *True*, global
+        observables of constrained parameters are drawn from unit Gaussians around their true values.
+        """
+        model = self.model
+        if x_true is None:
+            x_true = model.get_initial_parameters(1.0)
+        x_true = np.asarray(x_true, dtype=np.float64)
+        rng = np.random.default_rng(seed)
+
+        observed = rng.poisson(model.expected(x_true), size=(n_toys, model.n_bins)).astype(np.float64)
+        global_obs = np.where(model.constrained, x_true, 0.0) * np.ones((n_toys, 1))
+        if randomize_global_obs:
+            global_obs += np.where(model.constrained, rng.normal(size=(n_toys, model.n_parameters)), 0.0)
+
+        return DotDict(x_true=x_true, observed=observed, global_obs=global_obs)
+
+    def _minimize_chunk(self, x0, observed, global_obs, fixed) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return minimize_batch(self.model, x0, observed, global_obs=global_obs, fixed=fixed)
+
+    def minimize(
+        self,
+        x0: np.ndarray,
+        observed: np.ndarray,
+        global_obs: np.ndarray,
+        fixed: np.ndarray | None = None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Minimizes the negative log-likelihood for batches of *x0*, *observed* and *global_obs* in
+        chunks, distributed over the processes of the engine, and returns the concatenated results
+        of :py:func:`minimize_batch`.
+        """
+        n = len(x0)
+        if fixed is not None:
+            fixed = np.broadcast_to(fixed, x0.shape)
+        chunks = (
+            (
+                x0[i:i + self.chunk_size],
+                observed[i:i + self.chunk_size],
+                global_obs[i:i + self.chunk_size],
+                None if fixed is None else fixed[i:i + self.chunk_size],
+            )
+            for i in range(0, n, self.chunk_size)
+        )
+
+        results = []
+        with ForkedChunkPool(self._minimize_chunk, processes=self.processes) as pool:
+            results.extend(pool.imap(chunks))
+
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
+    def fit_toys(
+        self,
+        toys: DotDict,
+        parameter: str = "r",
+        scan_values: np.ndarray | None = None,
+    ) -> DotDict:
+        """
+        Fits all *toys* created by :py:meth:`generate` and returns best-fit parameters, their
+        uncertainties from the Hessian and pulls per toy, as well as a summary with the mean and
+        width of pulls and the median expected uncertainty per parameter, and the number of toys
+        processed per second. When *scan_values* are given, profile likelihood scans of *parameter*
+        are performed for all toys, and the expected uncertainty is additionally extracted from the
+        crossings of the negative log-likelihood difference with 0.5.
+        """
+        model = self.model
+        n_toys = len(toys.observed)
+        t1 = time.perf_counter()
+
+        # unconditional fits
+        x0 = np.repeat(toys.x_true[None], n_toys, axis=0)
+        x, nll, converged = self.minimize(x0, toys.observed, toys.global_obs)
+
+        # uncertainties from the hessian per toy
+        h = model.hessian(x, toys.observed, global_obs=toys.global_obs)
+        errors = np.sqrt(np.maximum(np.diagonal(np.linalg.pinv(h), axis1=-2, axis2=-1), 0.0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            pulls = (x - toys.x_true) / errors
+
+        result = DotDict(
+            parameter_names=list(model.parameter_names),
+            parameters=x,
+            errors=errors,
+            pulls=pulls,
+            nll=nll,
+            converged=converged,
+        )
+
+        # profile likelihood scans, with all scan points of all toys minimized in one batch
+        if scan_values is not None:
+            scan_values = np.asarray(scan_values, dtype=np.float64)
+            n_points = len(scan_values)
+            i_param = model.parameter_names.index(parameter)
+            x0 = np.repeat(x[:, None, :], n_points, axis=1)
+            x0[:, :, i_param] = scan_values
+            fixed = np.eye(model.n_parameters, dtype=bool)[i_param]
+            _, scan_nll, scan_converged = self.minimize(
+                x0.reshape(-1, model.n_parameters),
+                np.repeat(toys.observed, n_points, axis=0),
+                np.repeat(toys.global_obs, n_points, axis=0),
+                fixed=fixed,
+            )
+            delta_nll = scan_nll.reshape(n_toys, n_points) - nll[:, None]
+            lower, upper = scan_crossings(scan_values, delta_nll)
+            result.scan = DotDict(
+                parameter=parameter,
+                values=scan_values,
+                delta_nll=delta_nll,
+                converged=scan_converged.reshape(n_toys, n_points),
+                lower=lower,
+                upper=upper,
+            )
+
+        duration = time.perf_counter() - t1
+
+        # summary
+        ok = converged & np.all(np.isfinite(pulls), axis=-1)
+        summary = DotDict(
+            n_toys=n_toys,
+            n_converged=int(converged.sum()),
+            duration=duration,
+            toys_per_second=n_toys / duration,
+            parameters={},
+        )
+        for i, name in enumerate(model.parameter_names):
+            summary.parameters[name] = {
+                "pull_mean": float(np.mean(pulls[ok, i])) if ok.any() else np.nan,
+                "pull_width": float(np.std(pulls[ok, i])) if ok.any() else np.nan,
+                "expected_error": float(np.median(errors[converged, i])) if converged.any() else np.nan,
+            }
+        if scan_values is not None:
+            width = 0.5 * (result.scan.upper - result.scan.lower)
+            width = width[converged & np.isfinite(width)]
+            summary.parameters[parameter]["expected_error_scan"] = float(np.median(width)) if len(width) else np.nan
+        result.summary = summary
+
+        return result
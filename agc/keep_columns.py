@@ -0,0 +1,136 @@
+# coding: utf-8
+
+"""
+Automatic derivation of columns to keep after certain steps, based on the dependencies of what is
+evaluated downstream.
+"""
+
+from __future__ import annotations
+
+from typing import Iterable
+
+import law
+
+from columnflow.columnar_util import Route, mandatory_coffea_columns
+
+from agc.columnar_util import expand_virtual_inputs
+
+
+logger = law.logger.get_logger(__name__)
+
+
+class DownstreamColumns(object):
+    """
+    Placeholder in the ``keep_columns`` auxiliary field of configs that is expanded to the minimal
+    set of columns that are required downstream by a task, see :py:func:`get_downstream_columns`.
+    *producers*, *weight_producer* and *before_production* are forwarded.
+    """
+
+    def __init__(
+        self,
+        producers: Iterable[str] | None = None,
+        weight_producer: str | None = None,
+        before_production: bool = True,
+    ):
+        super().__init__()
+
+        self.producers = None if producers is None else list(producers)
+        self.weight_producer = weight_producer
+        self.before_production = before_production
+
+    def __repr__(self) -> str:
+        return (
+            f"<{self.__class__.__name__} producers={self.producers} weight_producer={self.weight_producer} "
+            f"before_production={self.before_production} at {hex(id(self))}>"
+        )
+
+    def get_columns(self, task: law.Task) -> set[Route]:
+        return get_downstream_columns(
+            task,
+            producers=self.producers,
+            weight_producer=self.weight_producer,
+            before_production=self.before_production,
+        )
+
+
+def get_downstream_columns(
+    task: law.Task,
+    producers: Iterable[str] | None = None,
+    weight_producer: str | None = None,
+    before_production: bool = True,
+) -> set[Route]:
+    """
+    Returns the minimal set of columns required downstream of a *task*, given by the mandatory
+    coffea columns, the process id, the category columns, the event weights, and the inputs of all
+    variables of the config, which include those referred to by the inference model. The columns
+    used by the *weight_producer*, defaulting to the one of the *task* or the
+    ``default_weight_producer`` of the config, and the normalization weights produced by
+    *producers*, defaulting to the ``default_producer`` of the config, are always added. When
+    *before_production* is *True*, the columns used by *producers* are added as well, and all
+    columns they produce are removed. Virtual columns are extended by their inputs.
+    """
+    from columnflow.production import Producer
+    from columnflow.production.normalization import normalization_weights
+    from columnflow.weight import WeightProducer
+
+    config_inst = task.config_inst
+    dataset_inst = getattr(task, "dataset_inst", None)
+
+    required = set(map(Route, mandatory_coffea_columns)) | {Route("process_id"), Route("category_ids")}
+
+    # inputs of all variables
+    for variable_inst in config_inst.variables:
+        if isinstance(variable_inst.expression, str):
+            required.add(Route(variable_inst.expression))
+        else:
+            required |= set(map(Route, variable_inst.x("inputs", [])))
+
+    # event weights
+    required |= set(map(Route, config_inst.x("event_weights", {})))
+    if dataset_inst:
+        required |= set(map(Route, dataset_inst.x("event_weights", {})))
+
+    inst_dict = task.get_array_function_kwargs(task=task)
+    if producers is None:
+        producers = law.util.make_list(config_inst.x("default_producer", None) or [])
+    producer_insts = [Producer.get_cls(producer)(inst_dict=inst_dict) for producer in producers]
+
+    # inputs of the weight producer
+    weight_producer_inst = None
+    if weight_producer:
+        weight_producer_inst = WeightProducer.get_cls(weight_producer)(inst_dict=inst_dict)
+    elif getattr(task, "weight_producer_inst", None):
+        weight_producer_inst = task.weight_producer_inst
+    elif config_inst.x("default_weight_producer", None):
+        weight_producer_inst = WeightProducer.get_cls(config_inst.x.default_weight_producer)(inst_dict=inst_dict)
+    if weight_producer_inst is not None:
+        required |= weight_producer_inst.used_columns
+
+    # normalization weights of simulated events, which are possibly used by weight producers chosen
+    # downstream
+    if not dataset_inst or dataset_inst.is_mc:
+        for producer_inst in producer_insts:
+            required |= {
+                Route(dep.weight_name)
+                for dep in producer_inst.walk_deps(include_self=True)
+                if isinstance(dep, normalization_weights)
+            }
+
+    # inputs of producers, excluding what they produce themselves
+    if before_production:
+        produced = set()
+        for producer_inst in producer_insts:
+            required |= producer_inst.used_columns
+            produced |= {route.string_column for route in producer_inst.produced_columns}
+        required = {
+            route for route in required
+            if not law.util.multi_match(route.string_column, produced, mode=any)
+        }
+
+    # strip indices and add inputs of virtual columns
+    required = {Route(route.string_column) for route in required}
+    required |= set(map(Route, expand_virtual_inputs(required)))
+
+    logger.debug(f"derived {len(required)} columns to keep for {task.task_family}")
+
+    return required
@@ -0,0 +1,118 @@
+# coding: utf-8
+
+"""
+Processing of event chunks of a single task in worker processes forked from the task process.
+"""
+
+from __future__ import annotations
+
+import os
+import itertools
+import multiprocessing
+from collections import deque
+from typing import Any, Callable, Iterable, Iterator
+
+import law
+
+
+logger = law.logger.get_logger(__name__)
+
+
+# functions to call in worker processes, registered before forking so that they are inherited
+# together with everything they refer to, such as tasks and their array function instances
+_worker_funcs: dict[int, Callable] = {}
+_worker_ids = itertools.count()
+
+
+def _call_worker_func(func_id: int, args: tuple) -> Any:
+    return _worker_funcs[func_id](*args)
+
+
+def get_chunked_io_processes(task: law.Task) -> int:
+    """
+    Returns the number of processes to use for processing chunks of a *task*, configured in the
+    analysis section of the law config per task family via ``<task_family>__chunked_io_processes``,
+    or for all tasks via ``chunked_io_processes``. A value of zero refers to the number of cores
+    available to the process.
+    """
+    processes = law.config.get_expanded_int(
+        "analysis",
+        f"{task.task_family}__chunked_io_processes",
+        law.config.get_expanded_int("analysis", "chunked_io_processes", 1),
+    )
+    if processes <= 0:
+        processes = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return max(processes, 1)
+
+
+class ForkedChunkPool(object):
+    """
+    Pool of *processes* that applies *func* to arguments of event chunks. The processes are forked
+    when entering the pool as a context, so *func* and all objects it refers to, such as calibrator,
+    selector and producer instances that are already set up, are shared with workers without being
+    pickled. Only arguments and return values are transferred between processes.
+
+    At most *max_pending* chunks, defaulting to twice the number of processes, are processed or
+    waiting at a time, so that reading chunks does not run ahead of processing them. With a single
+    process, *func* is called in the current process.
+
+    .. code-block:: python
+
+        with ForkedChunkPool(process_chunk, processes=4) as pool:
+            for result in pool.imap((pos.index, chunk) for chunk, pos in iter_chunks()):
+                ...
+    """
+
+    def __init__(self, func: Callable, processes: int = 1, max_pending: int | None = None):
+        super().__init__()
+
+        self.func = func
+        self.processes = max(int(processes), 1)
+        self.max_pending = max_pending or 2 * self.processes
+
+        self._func_id = None
+        self._pool = None
+
+    def __enter__(self) -> ForkedChunkPool:
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close(terminate=exc_type is not None)
+
+    def open(self) -> None:
+        if self.processes == 1 or self._pool is not None:
+            return
+
+        self._func_id = next(_worker_ids)
+        _worker_funcs[self._func_id] = self.func
+        self._pool = multiprocessing.get_context("fork").Pool(self.processes)
+        logger.debug(f"forked {self.processes} processes for processing chunks")
+
+    def close(self, terminate: bool = False) -> None:
+        if self._pool is not None:
+            if terminate:
+                self._pool.terminate()
+            else:
+                self._pool.close()
+            self._pool.join()
+            self._pool = None
+        _worker_funcs.pop(self._func_id, None)
+
+    def imap(self, args_iter: Iterable[tuple]) -> Iterator[Any]:
+        """
+        Applies the function of the pool to all tuples of arguments in *args_iter* and yields the
+        results in the same order.
+        """
+        if self._pool is None:
+            for args in args_iter:
+                yield self.func(*args)
+            return
+
+        pending = deque()
+        for args in args_iter:
+            pending.append(self._pool.apply_async(_call_worker_func, (self._func_id, args)))
+            while len(pending) >= self.max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
@@ -0,0 +1,663 @@
+# coding: utf-8
+
+"""
+Prefetching of remote ROOT files into a bounded local store. Instead of copying entire files, only
+the ROOT metadata and the baskets of requested branches are fetched via ranged HTTP reads and
+written to sparse local replicas at their original offsets, so that replicas can be opened like
+the original files. Replicas are evicted in least-recently-used order when the store exceeds its
+maximum size.
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import ssl
+import time
+import fcntl
+import fnmatch
+import hashlib
+import threading
+import collections
+import urllib.request
+import contextlib
+import concurrent.futures
+from typing import Iterable, Iterator
+
+import law
+
+from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, mandatory_coffea_columns
+
+from agc.config.agc_files import get_cache_dir, read_cache_file, write_cache_file
+
+uproot = maybe_import("uproot")
+
+
+logger = law.logger.get_logger(__name__)
+
+
+def get_http_url(target: law.FileSystemFileTarget) -> str | None:
+    """
+    Returns the http(s) url of a remote file *target*, or *None* when the target is not accessible
+    via http(s). WebDAV urls are converted to https.
+    """
+    if isinstance(target, law.LocalFileTarget):
+        return None
+    try:
+        url = law.util.make_list(target.uri())[0]
+    except Exception:
+        return None
+    url = re.sub(r"^davs://", "https://", url)
+    url = re.sub(r"^dav://", "http://", url)
+    return url if re.match(r"^https?://", url) else None
+
+
+def get_branch_patterns(routes: Iterable[Route | str]) -> set[str]:
+    """
+    Returns patterns of nano branch names for a set of *routes*, including the counts of all
+    collections.
+    """
+    patterns = set()
+    for route in map(Route, routes):
+        patterns.add(route.string_nano_column)
+        if len(route.fields) > 1:
+            patterns.add(f"n{route.fields[0]}")
+    return patterns
+
+
+def get_task_branch_patterns(task: law.Task) -> set[str]:
+    """
+    Returns patterns of nano branch names that are read by the calibrators and selector of a
+    *task*, when it has any, as well as the mandatory coffea columns.
+    """
+    routes = set(map(Route, mandatory_coffea_columns))
+    calibrator_insts = list(getattr(task, "calibrator_insts", []))
+    if getattr(task, "calibrator_inst", None):
+        calibrator_insts.append(task.calibrator_inst)
+    for calibrator_inst in calibrator_insts:
+        routes |= calibrator_inst.used_columns
+    if getattr(task, "selector_inst", None):
+        routes |= task.selector_inst.used_columns
+    return get_branch_patterns(routes)
+
+
+def merge_ranges(ranges: Iterable[tuple[int, int]], gap: int = 0) -> list[tuple[int, int]]:
+    """
+    Sorts byte *ranges* and merges those that overlap or whose distance is at most *gap* bytes.
+    """
+    merged = []
+    for start, stop in sorted(ranges):
+        if stop <= start:
+            continue
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def subtract_ranges(
+    ranges: Iterable[tuple[int, int]],
+    filled: list[tuple[int, int]],
+) -> list[tuple[int, int]]:
+    """
+    Returns the parts of byte *ranges* that are not contained in the sorted, merged *filled* ranges.
+    """
+    missing = []
+    for start, stop in merge_ranges(ranges):
+        for f_start, f_stop in filled:
+            if f_stop <= start:
+                continue
+            if f_start >= stop:
+                break
+            if f_start > start:
+                missing.append((start, f_start))
+            start = max(start, f_stop)
+            if start >= stop:
+                break
+        if start < stop:
+            missing.append((start, stop))
+    return missing
+
+
+@contextlib.contextmanager
+def lock_store(root: str) -> Iterator[None]:
+    """
+    Context manager that holds an exclusive lock on the store directory *root* across processes,
+    used for writing manifests and evicting replicas.
+    """
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, ".lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_all(fd: int, data: bytes, offset: int) -> None:
+    """
+    Writes all *data* to a file descriptor *fd* at *offset*, repeating partial writes.
+    """
+    view = memoryview(data)
+    while view:
+        n = os.pwrite(fd, view, offset)
+        view = view[n:]
+        offset += n
+
+
+def create_ssl_context() -> ssl.SSLContext:
+    """
+    Returns an ssl context using the grid certificates and the user proxy when available.
+    """
+    context = ssl.create_default_context()
+    cert_dir = os.getenv("X509_CERT_DIR")
+    if cert_dir and os.path.isdir(cert_dir):
+        context.load_verify_locations(capath=cert_dir)
+    proxy = os.getenv("X509_USER_PROXY")
+    if proxy and os.path.isfile(proxy):
+        context.load_cert_chain(proxy)
+    return context
+
+
+def fetch_range(
+    url: str,
+    start: int,
+    stop: int,
+    timeout: float = 60.0,
+    context: ssl.SSLContext | None = None,
+) -> tuple[bytes, int]:
+    """
+    Fetches the bytes ``[start, stop)`` of a file at *url* with a ranged request and returns them,
+    together with the total size of the file. Ranges exceeding the end of the file are truncated.
+    An exception is raised when the server does not support ranged requests, or when the returned
+    range or the number of bytes differ from those requested.
+    """
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{stop - 1}"})
+    with urllib.request.urlopen(request, timeout=timeout, context=context) as response:
+        if response.status != 206:
+            raise Exception(f"server did not respond to ranged request for {url} with status 206")
+        m = re.match(r"^bytes\s+(\d+)-(\d+)/(\d+)$", response.headers.get("Content-Range", ""))
+        if not m:
+            raise Exception(f"invalid Content-Range for ranged request for {url}")
+        size = int(m.group(3))
+        stop = min(stop, size)
+        if int(m.group(1)) != start or int(m.group(2)) != stop - 1:
+            raise Exception(
+                f"Content-Range {m.group(1)}-{m.group(2)} does not match requested range "
+                f"{start}-{stop - 1} for {url}",
+            )
+        data = response.read()
+
+    if len(data) != stop - start:
+        raise Exception(f"received {len(data)} instead of {stop - start} bytes from {url}")
+
+    return data, size
+
+
+class Replica(object):
+    """
+    Sparse local replica at *path* of a remote file at *url* whose size is *size* bytes. Byte ranges
+    are fetched on demand by :py:meth:`fill` and their positions are stored in a manifest next to
+    the replica, together with the names of the branches whose baskets were fetched and the time of
+    the last access. Manifests are written under the lock of the store directory and merged with
+    the ranges and branches recorded by other processes. A random *token* identifies the replica
+    file, so that instances of replicas that were evicted and created again are not reused.
+    """
+
+    # registry of replicas per path, used by sources opening replicas
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(
+        self,
+        path: str,
+        url: str,
+        size: int,
+        filled: list[tuple[int, int]] | None = None,
+        branches: Iterable[str] | None = None,
+        workers: int = 8,
+        block_size: int = 256 * 1024,
+        request_size: int = 8 * 1024**2,
+        coalesce_gap: int = 64 * 1024,
+        token: str | None = None,
+    ):
+        super().__init__()
+
+        self.path = path
+        self.url = url
+        self.size = size
+        self.filled = merge_ranges(map(tuple, filled or []))
+        self.branches = set(branches or [])
+        self.workers = workers
+        self.block_size = block_size
+        self.request_size = request_size
+        self.coalesce_gap = coalesce_gap
+        self.token = token
+
+        self._lock = threading.RLock()
+        self._context = create_ssl_context() if url.startswith("https://") else None
+
+    @classmethod
+    def get_manifest_path(cls, path: str) -> str:
+        return f"{path}.json"
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> Replica | None:
+        """
+        Returns the replica at *path*, loading it from its manifest when not done before in this
+        process, or *None* if no manifest exists.
+        """
+        path = os.path.realpath(path)
+        manifest = read_cache_file(cls.get_manifest_path(path))
+        exists = bool(manifest) and os.path.exists(path)
+        with cls._instances_lock:
+            # drop replicas that were evicted in the meantime, possibly by other processes, or that
+            # were created again
+            replica = cls._instances.get(path)
+            if replica is not None and (not exists or manifest.get("token") != replica.token):
+                del cls._instances[path]
+            if path not in cls._instances:
+                if not exists:
+                    return None
+                cls._instances[path] = cls(
+                    path,
+                    manifest["url"],
+                    manifest["size"],
+                    filled=manifest["filled"],
+                    branches=manifest["branches"],
+                    token=manifest.get("token"),
+                    **kwargs,
+                )
+            return cls._instances[path]
+
+    @classmethod
+    def create(cls, path: str, url: str, **kwargs) -> Replica:
+        """
+        Creates a replica at *path* of a file at *url* by fetching its first block, or returns the
+        existing one.
+        """
+        replica = cls.load(path, **kwargs)
+        if replica is not None and replica.url == url:
+            # update the time of the last access
+            replica.save()
+            return replica
+
+        # fetch the first block to determine the size
+        replica = cls(os.path.realpath(path), url, -1, token=os.urandom(8).hex(), **kwargs)
+        data, replica.size = fetch_range(url, 0, replica.block_size, context=replica._context)
+        replica.filled = [(0, len(data))]
+
+        # create the sparse file and write the first block
+        os.makedirs(os.path.dirname(replica.path), exist_ok=True)
+        fd = os.open(replica.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, replica.size)
+            write_all(fd, data, 0)
+        finally:
+            os.close(fd)
+
+        replica.save(create=True)
+        with cls._instances_lock:
+            cls._instances[replica.path] = replica
+
+        return replica
+
+    @property
+    def n_bytes(self) -> int:
+        return sum(stop - start for start, stop in self.filled)
+
+    def save(self, create: bool = False) -> None:
+        """
+        Writes the manifest, merging ranges and branches recorded by other processes, unless the
+        replica was evicted or created again in the meantime. When *create* is *True*, an existing
+        manifest is replaced.
+        """
+        manifest_path = self.get_manifest_path(self.path)
+        with self._lock, lock_store(os.path.dirname(self.path)):
+            # nothing to do when the replica was evicted or created again in the meantime
+            if not os.path.exists(self.path):
+                return
+            manifest = read_cache_file(manifest_path)
+            if not create and (not manifest or manifest.get("token") != self.token):
+                return
+
+            # merge ranges and branches recorded by other processes
+            if not create:
+                self.filled = merge_ranges(self.filled + [tuple(r) for r in manifest["filled"]])
+                self.branches |= set(manifest["branches"])
+
+            write_cache_file(manifest_path, {
+                "url": self.url,
+                "size": self.size,
+                "filled": self.filled,
+                "branches": sorted(self.branches),
+                "n_bytes": self.n_bytes,
+                "last_access": time.time(),
+                "token": self.token,
+            })
+
+    def fill(self, ranges: Iterable[tuple[int, int]], align: bool = True) -> int:
+        """
+        Fetches all byte *ranges* that are not yet filled and returns the number of fetched bytes.
+        When *align* is *True*, missing ranges are extended to multiples of the block size to
+        reduce the number of requests for small reads, such as those of metadata.
+        """
+        ranges = [(max(start, 0), min(stop, self.size)) for start, stop in ranges]
+        with self._lock:
+            missing = subtract_ranges(ranges, self.filled)
+            if not missing:
+                return 0
+            if align:
+                bs = self.block_size
+                missing = subtract_ranges(
+                    [(start // bs * bs, min(-(-stop // bs) * bs, self.size)) for start, stop in missing],
+                    self.filled,
+                )
+
+            # coalesce close ranges and split them into requests of limited size
+            requests = []
+            for start, stop in merge_ranges(missing, gap=self.coalesce_gap):
+                requests.extend(
+                    (s, min(s + self.request_size, stop))
+                    for s in range(start, stop, self.request_size)
+                )
+
+            # fetch in parallel and write to the replica, only marking ranges as filled once they
+            # are entirely written, also when other requests fail
+            written = []
+
+            def fetch(start, stop):
+                data, _ = fetch_range(self.url, start, stop, context=self._context)
+                write_all(fd, data, start)
+                written.append((start, stop))
+                return len(data)
+
+            fd = os.open(self.path, os.O_WRONLY)
+            try:
+                with concurrent.futures.ThreadPoolExecutor(min(self.workers, len(requests))) as pool:
+                    n = sum(pool.map(lambda r: fetch(*r), requests))
+            finally:
+                os.close(fd)
+                if written:
+                    self.filled = merge_ranges(self.filled + written)
+                    self.save()
+
+        logger.debug(f"fetched {law.util.human_bytes(n, fmt=True)} in {len(requests)} requests from {self.url}")
+
+        return n
+
+    def open(self, **options) -> uproot.ReadOnlyDirectory:
+        """
+        Opens the replica with uproot using a :py:class:`ReplicaSource` that fetches missing ranges.
+        """
+        return uproot.open(self.path, handler=ReplicaSource, **options)
+
+    def fill_branches(self, patterns: Iterable[str], tree_name: str = "Events") -> int:
+        """
+        Fetches the baskets of all branches of the tree *tree_name* that match any of the
+        *patterns*, as well as all required metadata, and returns the number of fetched bytes.
+        """
+        patterns = set(patterns)
+        with self._lock, self.open() as f:
+            # load metadata
+            f.file.streamers
+            tree = f[tree_name]
+            names = [
+                name for name in tree.keys(recursive=True)
+                if name not in self.branches and any(fnmatch.fnmatch(name, p) for p in patterns)
+            ]
+            if not names:
+                return 0
+
+            # byte ranges of all baskets that are not embedded in the metadata
+            ranges = []
+            for name in names:
+                ranges.extend(
+                    (int(r[0]), int(r[1]))
+                    for _, r in tree[name].entries_to_ranges_or_baskets(0, tree.num_entries)
+                    if isinstance(r, tuple)
+                )
+
+            n = self.fill(ranges, align=False)
+            self.branches |= set(names)
+            self.save()
+
+        return n
+
+
+class ReplicaSource(uproot.source.file.MultithreadedFileSource):
+    """
+    Uproot source for local replicas that fetches all ranges before they are read.
+    """
+
+    def __init__(self, file_path: str, **options):
+        self._replica = Replica.load(file_path)
+        if self._replica is None:
+            raise Exception(f"no replica found at {file_path}")
+        super().__init__(file_path, **options)
+
+    def chunk(self, start: int, stop: int) -> uproot.source.chunk.Chunk:
+        self._replica.fill([(start, stop)])
+        return super().chunk(start, stop)
+
+    def chunks(self, ranges: list[tuple[int, int]], notifications) -> list[uproot.source.chunk.Chunk]:
+        self._replica.fill(ranges)
+        return super().chunks(ranges, notifications)
+
+
+class BranchStore(object):
+    """
+    Bounded local store of replicas of remote files in a directory *root*. The total number of bytes
+    of all replicas is limited to *max_size*, and replicas are evicted in least-recently-used order.
+    Replicas can be requested synchronously through :py:meth:`fetch` or in the background through
+    :py:meth:`prefetch`, using a pool of *prefetch_workers* threads. The *replica_kwargs* are
+    forwarded to all :py:class:`Replica` instances.
+
+    Recently requested replicas are never evicted by this store, and it holds a shared lock on each
+    of them, so that stores of other processes sharing the directory do not evict them either.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_size: int,
+        prefetch_workers: int = 1,
+        **replica_kwargs,
+    ):
+        super().__init__()
+
+        self.root = os.path.realpath(os.path.expandvars(os.path.expanduser(root)))
+        self.max_size = int(max_size)
+        self.replica_kwargs = replica_kwargs
+
+        self._pool = concurrent.futures.ThreadPoolExecutor(prefetch_workers)
+        self._futures = {}
+        self._lock = threading.Lock()
+
+        # recently requested replicas that are never evicted by this store, and file descriptors
+        # holding shared locks on them
+        self._recent = collections.deque(maxlen=prefetch_workers + 2)
+        self._held = {}
+
+    def get_replica_path(self, url: str) -> str:
+        h = hashlib.sha1(url.encode("utf-8")).hexdigest()[:20]
+        return os.path.join(self.root, f"{h}_{os.path.basename(url.split('?', 1)[0])}")
+
+    def contains(self, path: str) -> bool:
+        return os.path.dirname(os.path.realpath(path)) == self.root
+
+    def fetch(self, url: str, patterns: Iterable[str]) -> str:
+        """
+        Fetches the metadata and the baskets of branches matching *patterns* of a file at *url*,
+        after waiting for a prefetch of the same file, and returns the path of the replica.
+        """
+        # wait for a running prefetch, ignoring its errors
+        with self._lock:
+            future = self._futures.pop(url, None)
+        if future is not None:
+            t1 = time.perf_counter()
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"prefetching {url} failed: {e}")
+            logger.debug(f"waited {time.perf_counter() - t1:.2f}s for prefetch of {url}")
+
+        self._recent.append(self.get_replica_path(url))
+        replica = self._create(url)
+        n = replica.fill_branches(patterns)
+        if n:
+            logger.info(f"fetched {law.util.human_bytes(n, fmt=True)} of {url}")
+        self.evict()
+
+        return replica.path
+
+    def prefetch(self, url: str, patterns: Iterable[str]) -> concurrent.futures.Future:
+        """
+        Schedules the fetching of a file at *url* with branches matching *patterns* in the background
+        and returns a future.
+        """
+        with self._lock:
+            if url not in self._futures:
+                self._recent.append(self.get_replica_path(url))
+                self._futures[url] = self._pool.submit(self._prefetch, url, list(patterns))
+            return self._futures[url]
+
+    def _prefetch(self, url: str, patterns: list[str]) -> str:
+        replica = self._create(url)
+        replica.fill_branches(patterns)
+        return replica.path
+
+    def _create(self, url: str, attempts: int = 3) -> Replica:
+        """
+        Creates the replica of a file at *url*, or returns the existing one, and holds a shared lock
+        on it while it is recently requested. Replicas that are evicted by another process before the
+        lock is acquired are created again, up to a number of *attempts*.
+        """
+        for _ in range(attempts):
+            replica = Replica.create(self.get_replica_path(url), url, **self.replica_kwargs)
+            if self._hold(replica.path):
+                break
+        return replica
+
+    def _release(self) -> None:
+        """
+        Releases the shared locks on replicas that are no longer recently requested.
+        """
+        with self._lock:
+            for path in list(self._held):
+                if path not in self._recent:
+                    # closing the descriptor releases the lock
+                    os.close(self._held.pop(path))
+
+    def _hold(self, path: str) -> bool:
+        """
+        Acquires a shared lock on the replica at *path* if it is recently requested, and releases
+        those on replicas that are no longer. Returns *False* if the replica was removed before the
+        lock was acquired.
+        """
+        self._release()
+        with self._lock:
+            if path in self._held or path not in self._recent:
+                return True
+
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                return False
+            fcntl.flock(fd, fcntl.LOCK_SH)
+
+            # the replica might have been removed while waiting for the lock
+            try:
+                held = os.fstat(fd).st_ino == os.stat(path).st_ino
+            except FileNotFoundError:
+                held = False
+            if not held:
+                os.close(fd)
+                return False
+
+            self._held[path] = fd
+            return True
+
+    def evict(self) -> list[str]:
+        """
+        Removes replicas in least-recently-used order until the store does not exceed its maximum
+        size and returns their paths. The store is locked while evicting so that no manifests are
+        written by other processes in the meantime. Replicas that are locked by stores of other
+        processes are skipped.
+        """
+        self._release()
+
+        evicted = []
+        with lock_store(self.root):
+            entries = []
+            for name in os.listdir(self.root):
+                if not name.endswith(".json"):
+                    continue
+                manifest = read_cache_file(os.path.join(self.root, name))
+                if manifest:
+                    entries.append((manifest["last_access"], manifest["n_bytes"], name[:-5]))
+
+            total = sum(n for _, n, _ in entries)
+            for _, n, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                path = os.path.join(self.root, name)
+                if path in self._recent:
+                    continue
+
+                # skip replicas in use, and remove others while holding an exclusive lock
+                try:
+                    fd = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    fd = None
+                try:
+                    if fd is not None:
+                        try:
+                            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except BlockingIOError:
+                            continue
+                    for p in [path, Replica.get_manifest_path(path)]:
+                        try:
+                            os.remove(p)
+                        except OSError:
+                            pass
+                finally:
+                    if fd is not None:
+                        os.close(fd)
+
+                with Replica._instances_lock:
+                    Replica._instances.pop(path, None)
+                total -= n
+                evicted.append(path)
+
+        if evicted:
+            logger.debug(f"evicted {len(evicted)} replicas from {self.root}")
+
+        return evicted
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} '{self.root}' at {hex(id(self))}>"
+
+
+_store = None
+
+
+def get_nano_store() -> BranchStore | None:
+    """
+    Returns the store for prefetched nano files configured in the analysis section of the law
+    config, or *None* when prefetching is disabled.
+    """
+    global _store
+
+    if _store is None and law.config.get_expanded_boolean("analysis", "prefetch_nano_inputs", False):
+        get = lambda key, default: law.config.get_expanded("analysis", f"prefetch_nano_{key}", default) or default
+        _store = BranchStore(
+            root=get("store", os.path.join(get_cache_dir(), "nano_store")),
+            max_size=law.util.parse_bytes(get("store_size", "20GB"), input_unit="MB", unit="bytes"),
+            prefetch_workers=int(get("ahead", 1)),
+            workers=int(get("workers", 8)),
+        )
+
+    return _store
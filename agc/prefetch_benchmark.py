@@ -0,0 +1,250 @@
+# coding: utf-8
+
+"""
+Benchmark of the prefetching of remote ROOT files against a local http server that injects latency
+and limits the bandwidth. Example:
+
+.. code-block:: bash
+
+    python -m agc.prefetch_benchmark nano_*.root --latency 50 --bandwidth 20 --branches "Jet_*" nJet
+
+Three strategies are compared, each processing all files in sequence:
+
+    - ``copy``: copy entire files, then read the branches locally
+    - ``fetch``: fetch only the required ranges into a store, then read the branches locally
+    - ``prefetch``: same as ``fetch``, but the next file is prefetched while the current one is read
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import urllib.request
+import http.server
+
+import law
+
+from agc.prefetch import BranchStore
+
+
+class ThrottledHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Request handler serving files with support for single byte ranges, delaying each response by the
+    :py:attr:`latency` of the server and limiting the bandwidth shared by all connections.
+    """
+
+    block_size = 64 * 1024
+
+    def log_message(self, *args, **kwargs) -> None:
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "file not found")
+            return None
+
+        size = os.path.getsize(path)
+        start, stop = 0, size
+        m = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if m:
+            start = int(m.group(1))
+            stop = min(int(m.group(2)) + 1, size) if m.group(2) else size
+            if start >= size:
+                self.send_error(416, "requested range not satisfiable")
+                return None
+
+        time.sleep(self.server.latency)
+
+        self.send_response(206 if m else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(stop - start))
+        self.send_header("Accept-Ranges", "bytes")
+        if m:
+            self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{size}")
+        self.end_headers()
+
+        self._range = (start, stop)
+        return open(path, "rb")
+
+    def copyfile(self, source, outputfile) -> None:
+        start, stop = self._range
+        source.seek(start)
+        while start < stop:
+            data = source.read(min(self.block_size, stop - start))
+            if not data:
+                break
+            self.server.throttle(len(data))
+            outputfile.write(data)
+            start += len(data)
+
+
+class ThrottledHTTPServer(http.server.ThreadingHTTPServer):
+    """
+    Threaded http server for files in a *directory* that delays responses by *latency* seconds and
+    limits the total bandwidth to *bandwidth* bytes per second, when set. The number of requests and
+    transferred bytes are counted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory: str, latency: float = 0.0, bandwidth: float | None = None, port: int = 0):
+        handler = lambda *args, **kwargs: ThrottledHTTPRequestHandler(*args, directory=directory, **kwargs)
+        super().__init__(("127.0.0.1", port), handler)
+
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.n_requests = 0
+        self.n_bytes = 0
+
+        self._lock = threading.Lock()
+        self._next_free = time.perf_counter()
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def throttle(self, n: int) -> None:
+        # reserve the time slot to transfer n bytes over the shared link
+        with self._lock:
+            self.n_bytes += n
+            if not self.bandwidth:
+                return
+            now = time.perf_counter()
+            self._next_free = max(self._next_free, now) + n / self.bandwidth
+            delay = self._next_free - now
+        time.sleep(delay)
+
+    def process_request(self, *args, **kwargs) -> None:
+        with self._lock:
+            self.n_requests += 1
+        super().process_request(*args, **kwargs)
+
+    def reset_counters(self) -> None:
+        with self._lock:
+            self.n_requests = 0
+            self.n_bytes = 0
+
+    def start(self) -> ThrottledHTTPServer:
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def read_branches(path: str, patterns: list[str], work: float = 0.0) -> int:
+    """
+    Reads all branches matching *patterns* from a file at *path*, simulates *work* seconds of
+    processing, and returns the number of entries.
+    """
+    import uproot
+
+    with uproot.open(path) as f:
+        tree = f["Events"]
+        tree.arrays(filter_name=patterns, library="np")
+        n = tree.num_entries
+    time.sleep(work)
+    return n
+
+
+def run_benchmark(
+    files: list[str],
+    patterns: list[str],
+    latency: float = 0.05,
+    bandwidth: float | None = None,
+    work: float = 0.0,
+    workers: int = 8,
+) -> dict[str, dict]:
+    """
+    Serves *files* through a :py:class:`ThrottledHTTPServer` with *latency* and *bandwidth* limits,
+    processes them with all strategies and returns the wall time, the number of requests and the
+    transferred bytes per strategy.
+    """
+    results = {}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # serve all files from a single directory
+        serve_dir = os.path.join(tmp_dir, "serve")
+        os.makedirs(serve_dir)
+        for i, path in enumerate(files):
+            os.symlink(os.path.abspath(path), os.path.join(serve_dir, f"file_{i}.root"))
+        server = ThrottledHTTPServer(serve_dir, latency=latency, bandwidth=bandwidth).start()
+        urls = [f"{server.url}/file_{i}.root" for i in range(len(files))]
+
+        def measure(name, func):
+            server.reset_counters()
+            t1 = time.perf_counter()
+            func()
+            results[name] = {
+                "seconds": round(time.perf_counter() - t1, 3),
+                "requests": server.n_requests,
+                "bytes": server.n_bytes,
+            }
+
+        def copy():
+            for i, url in enumerate(urls):
+                path = os.path.join(tmp_dir, f"copy_{i}.root")
+                with urllib.request.urlopen(url) as response, open(path, "wb") as f:
+                    shutil.copyfileobj(response, f)
+                read_branches(path, patterns, work)
+                os.remove(path)
+
+        def fetch(prefetch):
+            store_dir = os.path.join(tmp_dir, f"store_{int(prefetch)}")
+            store = BranchStore(store_dir, max_size=2 * sum(map(os.path.getsize, files)), workers=workers)
+            for i, url in enumerate(urls):
+                path = store.fetch(url, patterns)
+                if prefetch and i + 1 < len(urls):
+                    store.prefetch(urls[i + 1], patterns)
+                read_branches(path, patterns, work)
+
+        measure("copy", copy)
+        measure("fetch", lambda: fetch(False))
+        measure("prefetch", lambda: fetch(True))
+
+        server.stop()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("files", nargs="+", help="ROOT files to serve")
+    parser.add_argument("--branches", "-b", nargs="+", default=["*"], help="branch patterns to read")
+    parser.add_argument("--latency", "-l", type=float, default=50.0, help="latency in ms; default: 50")
+    parser.add_argument("--bandwidth", "-w", type=float, help="bandwidth in MB/s; default: unlimited")
+    parser.add_argument("--work", type=float, default=0.0, help="processing time per file in s; default: 0")
+    parser.add_argument("--workers", type=int, default=8, help="parallel requests per file; default: 8")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.files,
+        args.branches,
+        latency=args.latency / 1000.0,
+        bandwidth=args.bandwidth and args.bandwidth * 1024**2,
+        work=args.work,
+        workers=args.workers,
+    )
+
+    for name, result in results.items():
+        print(
+            f"{name:>8}: {result['seconds']:8.2f}s, {result['requests']:5d} requests, "
+            f"{law.util.human_bytes(result['bytes'], fmt=True)}",
+        )
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
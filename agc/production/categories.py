@@ -0,0 +1,135 @@
+# coding: utf-8
+
+"""
+Column production methods related to event categorization.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+import law
+
+from columnflow.categorization import Categorizer
+from columnflow.production import Producer, producer
+from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
+
+from agc.columnar_util import virtual_column
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def category_ids_from_mask(category_mask: np.ndarray) -> ak.Array:
+    """
+    Converts a *category_mask* with bit ``i`` set for events in the category with id ``i`` into a
+    jagged array of category ids per event, in ascending order.
+    """
+    category_mask = np.asarray(category_mask, dtype=np.uint64)
+
+    # only consider bits that are set in any event
+    bits = np.arange(64, dtype=np.uint64)
+    bits = bits[((np.bitwise_or.reduce(category_mask, initial=np.uint64(0)) >> bits) & np.uint64(1)) == 1]
+    is_set = ((category_mask[:, None] >> bits) & np.uint64(1)) == 1
+
+    ids = np.broadcast_to(bits.astype(np.int64), is_set.shape)[is_set]
+    return ak.unflatten(ids, is_set.sum(axis=1))
+
+
+def register_category_ids_column(postfix: str = "") -> None:
+    """
+    Registers the virtual column ``category_ids<postfix>`` that is computed from the category mask
+    ``category_mask<postfix>``, and that is always resolved when no *postfix* is given.
+    """
+    virtual_column(f"category_ids{postfix}", inputs={f"category_mask{postfix}"}, auto=not postfix)(
+        lambda events: category_ids_from_mask(ak.to_numpy(events[f"category_mask{postfix}"])),
+    )
+
+
+# expose category ids to downstream tasks that only find the category mask
+register_category_ids_column()
+
+
+@producer(
+    produces={"category_mask"},
+)
+def category_mask(
+    self: Producer,
+    events: ak.Array,
+    target_events: ak.Array | None = None,
+    **kwargs,
+) -> ak.Array:
+    """
+    Assigns each event a 64-bit mask, with the bit at the position of the id of each leaf category
+    set when the event belongs to it. As opposed to
+    :py:class:`~columnflow.production.categories.category_ids`, each categorizer is evaluated only
+    once, even if it is shared between categories, and categorizers receive a common *cache* to
+    share intermediate results such as object multiplicities.
+    """
+    cache = {}
+    categorizer_masks = {}
+    mask = np.zeros(len(events), dtype=np.uint64)
+
+    for cat_inst, categorizers in self.categorizer_map.items():
+        # start with a true mask
+        cat_mask = np.ones(len(events), dtype=bool)
+
+        # loop through selectors, evaluating each of them only once
+        for categorizer in categorizers:
+            if categorizer not in categorizer_masks:
+                events, categorizer_masks[categorizer] = self[categorizer](events, cache=cache, **kwargs)
+            cat_mask &= ak.to_numpy(categorizer_masks[categorizer])
+
+        # set the bit
+        mask |= cat_mask.astype(np.uint64) << np.uint64(cat_inst.id)
+
+    # save, optionally on a target events array
+    if target_events is None:
+        target_events = events
+    target_events = set_ak_column(target_events, "category_mask", mask, value_type=np.uint64)
+
+    return target_events
+
+
+@category_mask.init
+def category_mask_init(self: Producer) -> None:
+    # store a mapping from leaf category to categorizer classes for faster lookup
+    self.categorizer_map = defaultdict(list)
+
+    # add all categorizers obtained from leaf category selection expressions to the used columns
+    for cat_inst in self.config_inst.get_leaf_categories():
+        # the category id defines the bit
+        if not 0 <= cat_inst.id < 64:
+            raise ValueError(
+                f"cannot encode id {cat_inst.id} of category '{cat_inst.name}' in a 64-bit "
+                "category mask",
+            )
+
+        # treat all selections as lists of categorizers
+        for sel in law.util.make_list(cat_inst.selection):
+            if Categorizer.derived_by(sel):
+                categorizer = sel
+            elif Categorizer.has_cls(sel):
+                categorizer = Categorizer.get_cls(sel)
+            else:
+                raise Exception(
+                    f"selection '{sel}' of category '{cat_inst.name}' cannot be resolved to an "
+                    "existing Categorizer object",
+                )
+
+            # the categorizer must be exposed
+            if not categorizer.exposed:
+                raise RuntimeError(
+                    f"cannot use unexposed categorizer '{categorizer}' to evaluate category "
+                    f"{cat_inst}",
+                )
+
+            # update dependency sets
+            self.uses.add(categorizer)
+            self.produces.add(categorizer)
+
+            self.categorizer_map[cat_inst].append(categorizer)
+
+    # cast to normal dict to prevent silent failures on KeyError
+    self.categorizer_map = dict(self.categorizer_map)
@@ -8,23 +8,62 @@ from columnflow.production import Producer, producer
 from columnflow.production.categories import category_ids
 from columnflow.production.normalization import normalization_weights
 from columnflow.util import maybe_import
+from columnflow.columnar_util import set_ak_column
 
-from agc.production.features import features
+from agc.calibration.default import get_jec_shift_jet_aliases, any_shift_jet_collection
+from agc.production.features import features, features_multi_shift, get_shift_jets
+from agc.production.categories import category_mask
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def mask_categories(categories: ak.Array, event_mask: ak.Array) -> ak.Array:
+    """
+    Removes all *categories* of events not passing an *event_mask*, given either as lists of
+    category ids or as category masks.
+    """
+    event_mask = ak.to_numpy(event_mask)
+    if categories.ndim == 1:
+        return np.where(event_mask, ak.to_numpy(categories), np.uint64(0))
+    return categories[ak.broadcast_arrays(event_mask, categories)[0]]
+
+
 @producer(
-    uses={features, category_ids, normalization_weights},
-    produces={features, category_ids, normalization_weights},
+    uses={normalization_weights},
+    produces={normalization_weights},
+    # producer of high-level features
+    features_producer=features,
+    # producer of the category column, and the name of the column
+    category_producer=category_ids,
+    category_column="category_ids",
+    # whether to additionally assign categories for all jet energy shifts, on events and jets
+    # selected in any of them by the "default_shift_union" selector, stored with the shift name as
+    # postfix, and to only keep nominal categories for events selected in the nominal shift
+    multi_shift=False,
 )
 def default(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
     # features
-    events = self[features](events, **kwargs)
+    events = self[self.features_producer](events, **kwargs)
 
-    # category ids
-    events = self[category_ids](events, **kwargs)
+    # category ids or mask
+    events = self[self.category_producer](events, **kwargs)
+
+    # categories per jet energy shift, evaluated on the jets selected in it
+    if self.shift_jet_aliases:
+        c = self.category_column
+        events = set_ak_column(events, c, mask_categories(events[c], events.shift_selected.nominal))
+        for shift_name, jet_aliases in self.shift_jet_aliases.items():
+            jets = get_shift_jets(events, jet_aliases)
+            shift_events = set_ak_column(events, "Jet", jets)
+            shift_events = set_ak_column(shift_events, "BJet", jets[jets.btagCSVV2 >= 0.5])
+            # force the evaluation, as results of repeated calls are cached otherwise
+            shift_events = self[self.category_producer](shift_events, **{**kwargs, "call_force": True})
+            events = set_ak_column(
+                events,
+                f"{c}_{shift_name}",
+                mask_categories(shift_events[c], events.shift_selected[shift_name]),
+            )
 
     # mc-only weights
     if self.dataset_inst.is_mc:
@@ -32,3 +71,45 @@ def default(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
         events = self[normalization_weights](events, **kwargs)
 
     return events
+
+
+@default.init
+def default_init(self: Producer) -> None:
+    # add the features and category producers to the dependency sets
+    self.uses |= {self.features_producer, self.category_producer}
+    self.produces |= {self.features_producer, self.category_producer}
+
+    # store jet column aliases per jet energy shift, as done by the features producer
+    self.shift_jet_aliases = {}
+    if not self.multi_shift:
+        return
+    if getattr(self, "dataset_inst", None) and not self.dataset_inst.is_mc:
+        return
+
+    self.shift_jet_aliases = get_jec_shift_jet_aliases(self.config_inst, any_shift_jet_collection)
+
+    # update dependency sets
+    self.produces |= {f"{self.category_column}_{shift_name}" for shift_name in self.shift_jet_aliases}
+
+
+# multi-shift version that produces features and categories for nominal and all jet energy shifts in
+# a single pass, to be used with the "default_shift_union" selector
+default_multi_shift = default.derive(
+    "default_multi_shift",
+    cls_dict={"features_producer": features_multi_shift, "multi_shift": True},
+)
+
+# versions that store categories as a bit mask instead of lists of category ids
+default_category_mask = default.derive(
+    "default_category_mask",
+    cls_dict={"category_producer": category_mask, "category_column": "category_mask"},
+)
+default_multi_shift_category_mask = default.derive(
+    "default_multi_shift_category_mask",
+    cls_dict={
+        "features_producer": features_multi_shift,
+        "multi_shift": True,
+        "category_producer": category_mask,
+        "category_column": "category_mask",
+    },
+)
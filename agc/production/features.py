@@ -4,16 +4,94 @@
 Column production methods related to higher-level features.
 """
 
+from __future__ import annotations
+
 from columnflow.production import Producer, producer
 from columnflow.production.categories import category_ids
 from columnflow.selection.util import create_collections_from_masks
 from columnflow.util import maybe_import
 from columnflow.columnar_util import EMPTY_FLOAT, Route, set_ak_column, attach_behavior
 
+from agc.calibration.default import get_jec_shift_jet_aliases, any_shift_jet_collection
+from agc.columnar_util import resolve_virtual_columns
+from agc.production.util import flat_and_offsets, max_pt_trijet_mass
+from agc.selection.util import sorted_masked_positions, to_jagged_indices
+
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
 
+def add_jet_features(
+    events: ak.Array,
+    jets: ak.Array,
+    postfix: str = "",
+    trijet_kernel: bool = True,
+    event_mask: ak.Array | None = None,
+) -> ak.Array:
+    """
+    Adds the ht, n_jet and trijet_mass columns computed from *jets* to *events*, with column names
+    extended by *postfix*, and returns the updated array. When an *event_mask* is given, features of
+    events not passing it are set to *EMPTY_FLOAT*.
+    """
+    def mask(values: ak.Array) -> ak.Array:
+        return values if event_mask is None else ak.where(event_mask, values, EMPTY_FLOAT)
+
+    # ht and njet
+    events = set_ak_column(events, f"ht{postfix}", mask(ak.sum(jets.pt, axis=1)))
+    events = set_ak_column(events, f"n_jet{postfix}", mask(ak.num(jets.pt, axis=1)), value_type=np.int32)
+
+    # trijet mass
+    if trijet_kernel:
+        # evaluate the kernel on flat jet buffers
+        pt, offsets = flat_and_offsets(jets.pt)
+        trijet_mass, valid = max_pt_trijet_mass(
+            pt,
+            ak.to_numpy(ak.flatten(jets.eta, axis=1)),
+            ak.to_numpy(ak.flatten(jets.phi, axis=1)),
+            ak.to_numpy(ak.flatten(jets.mass, axis=1)),
+            ak.to_numpy(ak.flatten(jets.btagCSVV2, axis=1)),
+            offsets,
+            btag_threshold=0.5,
+        )
+        # events without valid triplets are masked
+        trijet_mass = ak.mask(trijet_mass, valid)
+    else:
+        # create all combinations
+        triplets = ak.combinations(attach_behavior(jets, "Jet"), 3, fields=["j1", "j2", "j3"])
+        # at least one b-tag per combination
+        max_btag = np.maximum(
+            triplets.j1.btagCSVV2,
+            np.maximum(triplets.j2.btagCSVV2, triplets.j3.btagCSVV2),
+        )
+        triplets = triplets[max_btag >= 0.5]
+        # per event, pick the triplet with the maximum pt
+        p4 = triplets.j1 + triplets.j2 + triplets.j3
+        trijet_mass = p4[ak.argmax(p4.pt, axis=1, keepdims=True)][:, 0].mass
+    # store the mass
+    events = set_ak_column(events, f"trijet_mass{postfix}", mask(trijet_mass), np.float32)
+
+    return events
+
+
+def get_shift_jets(events: ak.Array, jet_aliases: dict[str, str]) -> ak.Array:
+    """
+    Returns the jets selected in a jet energy shift, given by its *jet_aliases* relative to the jet
+    collection that contains the jets selected in any shift (see agc.selection.default). Aliased
+    fields are shifted, and jets are sorted by decreasing shifted pt as done by the jet selection.
+    """
+    _events = resolve_virtual_columns(events, jet_aliases.values())
+    jets = events[any_shift_jet_collection]
+    for field, src in jet_aliases.items():
+        jets = set_ak_column(jets, field, Route(src).apply(_events))
+
+    # only the pt requirement of the jet selection depends on the shift
+    pt, offsets = flat_and_offsets(jets.pt)
+    pos, event_index = sorted_masked_positions(pt > 30.0, pt, offsets, ascending=False)
+    jet_indices, _ = to_jagged_indices(pos, event_index, offsets)
+
+    return jets[jet_indices]
+
+
 @producer(
     uses={
         "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.btagCSVV2",
@@ -22,30 +100,60 @@ ak = maybe_import("awkward")
         # new columns
         "ht", "n_jet", "trijet_mass",
     },
+    # whether to compute the trijet mass with the combinatorics-free kernel instead of building
+    # all triplets explicitly via ak.combinations
+    trijet_kernel=True,
+    # whether to additionally compute features for all jet energy shifts in the same pass, on
+    # events and jets selected in any of them by the "default_shift_union" selector, using the
+    # shifted jet columns referred to by the column aliases of the corresponding shifts
+    multi_shift=False,
 )
 def features(self: Producer, events: ak.Array, **kwargs) -> ak.Array:
-    # ht and njet
-    events = set_ak_column(events, "ht", ak.sum(events.Jet.pt, axis=1))
-    events = set_ak_column(events, "n_jet", ak.num(events.Jet.pt, axis=1), value_type=np.int32)
+    # features of nominal jets, only kept for events selected in the nominal shift when events of
+    # other shifts are present
+    event_mask = events.shift_selected.nominal if self.shift_jet_aliases else None
+    events = add_jet_features(events, events.Jet, trijet_kernel=self.trijet_kernel, event_mask=event_mask)
 
-    # trijet mass
-    # create all combinations
-    triplets = ak.combinations(attach_behavior(events.Jet, "Jet"), 3, fields=["j1", "j2", "j3"])
-    # at least one b-tag per combination
-    max_btag = np.maximum(
-        triplets.j1.btagCSVV2,
-        np.maximum(triplets.j2.btagCSVV2, triplets.j3.btagCSVV2),
-    )
-    triplets = triplets[max_btag >= 0.5]
-    # per event, pick the triplet with the maximum pt
-    p4 = triplets.j1 + triplets.j2 + triplets.j3
-    p4_maxpt = p4[ak.argmax(p4.pt, axis=1, keepdims=True)][:, 0]
-    # store the mass
-    events = set_ak_column(events, "trijet_mass", p4_maxpt.mass, np.float32)
+    # features of shifted jets, with the postfix being the shift name
+    for shift_name, jet_aliases in self.shift_jet_aliases.items():
+        events = add_jet_features(
+            events,
+            get_shift_jets(events, jet_aliases),
+            postfix=f"_{shift_name}",
+            trijet_kernel=self.trijet_kernel,
+            event_mask=events.shift_selected[shift_name],
+        )
 
     return events
 
 
+@features.init
+def features_init(self: Producer) -> None:
+    # store jet column aliases per jet energy shift, relative to the Jet collection and referring to
+    # jets selected in any shift (shifted jet columns are only produced by the mc-only jec calibrator)
+    self.shift_jet_aliases = {}
+    if not self.multi_shift:
+        return
+    if getattr(self, "dataset_inst", None) and not self.dataset_inst.is_mc:
+        return
+
+    self.shift_jet_aliases = get_jec_shift_jet_aliases(self.config_inst, any_shift_jet_collection)
+
+    # update dependency sets
+    self.uses |= {
+        f"{any_shift_jet_collection}.{field}"
+        for field in ["pt", "eta", "phi", "mass", "btagCSVV2"]
+    }
+    self.uses |= {f"shift_selected.{name}" for name in ["nominal", *self.shift_jet_aliases]}
+    for shift_name, jet_aliases in self.shift_jet_aliases.items():
+        self.uses |= set(jet_aliases.values())
+        self.produces |= {f"{name}_{shift_name}" for name in ["ht", "n_jet", "trijet_mass"]}
+
+
+# multi-shift version that produces features for nominal and all jet energy shifts at once
+features_multi_shift = features.derive("features_multi_shift", cls_dict={"multi_shift": True})
+
+
 @producer(
     uses={
         category_ids,
@@ -4,18 +4,344 @@
 Producers related to pre-trained ML models.
 """
 
+from __future__ import annotations
+
 import os
+import json
+import itertools
+import threading
+import collections
+from typing import TYPE_CHECKING
 
 from columnflow.production import Producer, producer
 from columnflow.util import InsertableDict, maybe_import
+from columnflow.columnar_util import EMPTY_FLOAT, set_ak_column
+
+from agc.production.util import flat_and_offsets, gather_index, p4_cartesian, p4_mass
 
+np = maybe_import("numpy")
 ak = maybe_import("awkward")
 
+if TYPE_CHECKING:
+    # xgboost is slow to import and only loaded when models are evaluated with it
+    import xgboost
+
+
+# names of the features per jet permutation in the order expected by the models,
+# with jets assigned to the roles w1, w2 (hadronic W decay), btophad and btoplep
+permutation_feature_names = [
+    "deltar_leptonbtoplep", "deltar_w1w2", "deltar_w1btophad", "deltar_w2btophad",
+    "mass_leptonbtoplep", "mass_w1w2", "mass_w1w2btophad", "pt_w1w2btophad",
+    "pt_w1", "pt_w2", "pt_btophad", "pt_btoplep",
+    "btag_w1", "btag_w2", "btag_btophad", "btag_btoplep",
+    "qgl_w1", "qgl_w2", "qgl_btophad", "qgl_btoplep",
+]
+
+
+def jet_permutations(n_jets: int) -> np.ndarray:
+    """
+    Returns all assignments of *n_jets* jets to the four roles (w1, w2, btophad, btoplep) as an
+    array of shape (n_permutations, 4). As the two W jets are interchangeable, only assignments
+    with w1 < w2 are considered. The order follows that of the AGC reference implementation.
+    """
+    perms = [p for p in itertools.permutations(range(n_jets), 4) if p[0] < p[1]]
+    return np.array(perms, dtype=np.int64).reshape(-1, 4)
+
+
+def permutation_features(
+    jets: dict[str, np.ndarray],
+    jet_offsets: np.ndarray,
+    lepton: dict[str, np.ndarray],
+    event_indices: np.ndarray,
+    permutations: np.ndarray,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Computes the features of all jet *permutations* for events referred to by *event_indices*,
+    which must all contain enough jets. *jets* should map the fields "pt", "eta", "phi", "mass",
+    "btag" and "qgl" to flat jet buffers defined through *jet_offsets*, and *lepton* the fields
+    "pt", "eta", "phi" and "mass" to per-event arrays of the single lepton. The returned array has
+    the shape (len(event_indices), n_permutations, n_features) and is written into *out* if given.
+    """
+    # jet indices per role, each with shape (n_events, n_permutations)
+    starts = jet_offsets[:-1][event_indices, None]
+    w1, w2, bhad, blep = (starts + permutations[None, :, i] for i in range(4))
+
+    # per-event lepton values, broadcastable against jet values
+    lep = {name: values[event_indices, None] for name, values in lepton.items()}
+
+    # cartesian coordinates of all jets and of the lepton
+    jet_p4 = p4_cartesian(jets["pt"], jets["eta"], jets["phi"], jets["mass"])
+    lep_p4 = p4_cartesian(lep["pt"], lep["eta"], lep["phi"], lep["mass"])
+
+    def delta_r(eta1, phi1, eta2, phi2):
+        # note that the AGC reference does not wrap delta phi, which is kept for model compatibility
+        return np.sqrt((eta1 - eta2)**2 + (phi1 - phi2)**2)
+
+    features = out if out is not None else np.empty(
+        w1.shape + (len(permutation_feature_names),),
+        dtype=np.float32,
+    )
+    eta, phi = jets["eta"], jets["phi"]
+    features[..., 0] = delta_r(lep["eta"], lep["phi"], eta[blep], phi[blep])
+    features[..., 1] = delta_r(eta[w1], phi[w1], eta[w2], phi[w2])
+    features[..., 2] = delta_r(eta[w1], phi[w1], eta[bhad], phi[bhad])
+    features[..., 3] = delta_r(eta[w2], phi[w2], eta[bhad], phi[bhad])
+    features[..., 4] = p4_mass(*(lc + c[blep] for lc, c in zip(lep_p4, jet_p4)))
+    w_p4 = [c[w1] + c[w2] for c in jet_p4]
+    features[..., 5] = p4_mass(*w_p4)
+    top_p4 = [wc + c[bhad] for wc, c in zip(w_p4, jet_p4)]
+    features[..., 6] = p4_mass(*top_p4)
+    features[..., 7] = np.hypot(top_p4[0], top_p4[1])
+    for i, (field, idx) in enumerate(itertools.product(["pt", "btag", "qgl"], [w1, w2, bhad, blep])):
+        features[..., 8 + i] = jets[field][idx]
+
+    return features
+
+
+class TreeEnsemble(object):
+    """
+    Array-backed representation of a binary-classification tree ensemble as trained with xgboost,
+    evaluated purely with numpy. All trees are stored in flat node tables (*feature* index,
+    *threshold*, *left* and *right* children, *default_left* for missing values and leaf *value*),
+    and *roots* refers to the index of the root node per tree. Leaves point to themselves, so that
+    all trees can be traversed level by level in lockstep for *depth* iterations.
+    """
+
+    @classmethod
+    def from_xgboost_json(cls, path: str) -> TreeEnsemble:
+        """
+        Creates a new instance from an xgboost model saved in json format at *path*.
+        """
+        with open(path, "r") as f:
+            learner = json.load(f)["learner"]
+
+        # only plain tree boosters with logistic objectives are supported
+        booster = learner["gradient_booster"]
+        if booster["name"] != "gbtree":
+            raise NotImplementedError(f"unsupported booster '{booster['name']}' in {path}")
+        objective = learner["objective"]["name"]
+        if objective not in ("binary:logistic", "reg:logistic"):
+            raise NotImplementedError(f"unsupported objective '{objective}' in {path}")
+
+        # concatenate node tables of all trees, shifting child indices by the offset of each tree
+        tables = {key: [] for key in ["feature", "threshold", "left", "right", "default_left", "value"]}
+        roots, depth, offset = [], 0, 0
+        for tree in booster["model"]["trees"]:
+            left = np.array(tree["left_children"], dtype=np.int64)
+            right = np.array(tree["right_children"], dtype=np.int64)
+            cond = np.array(tree["split_conditions"], dtype=np.float32)
+            is_leaf = left < 0
+            idx = np.arange(len(left))
+            tables["feature"].append(np.where(is_leaf, 0, tree["split_indices"]))
+            tables["threshold"].append(np.where(is_leaf, 0.0, cond).astype(np.float32))
+            tables["left"].append(np.where(is_leaf, idx, left) + offset)
+            tables["right"].append(np.where(is_leaf, idx, right) + offset)
+            tables["default_left"].append(np.array(tree["default_left"], dtype=bool))
+            tables["value"].append(np.where(is_leaf, cond, 0.0).astype(np.float32))
+            roots.append(offset)
+            offset += len(left)
+
+            # tree depth, exploiting that children are always stored after their parents
+            node_depth = np.zeros(len(left), dtype=np.int64)
+            for i in idx[~is_leaf]:
+                node_depth[[left[i], right[i]]] = node_depth[i] + 1
+            depth = max(depth, int(node_depth.max()))
+
+        # base score, potentially stored as a single-element list
+        base_score = float(str(learner["learner_model_param"]["base_score"]).strip("[]"))
+
+        return cls(
+            roots=np.array(roots, dtype=np.int64),
+            depth=depth,
+            base_margin=float(np.log(base_score / (1.0 - base_score))),
+            **{key: np.concatenate(values) for key, values in tables.items()},
+        )
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        left: np.ndarray,
+        right: np.ndarray,
+        default_left: np.ndarray,
+        value: np.ndarray,
+        roots: np.ndarray,
+        depth: int,
+        base_margin: float = 0.0,
+    ) -> None:
+        super().__init__()
+
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float32)
+        self.default_left = np.asarray(default_left, dtype=bool)
+        self.value = np.asarray(value, dtype=np.float32)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.depth = depth
+        self.base_margin = base_margin
+
+        # interleaved children, so that the next node is found at 2 * node + go_left
+        self.children = np.stack([right, left], axis=1).ravel().astype(np.int32)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Total number of bytes occupied by the node tables.
+        """
+        return sum(
+            arr.nbytes
+            for arr in [self.feature, self.threshold, self.default_left, self.value, self.roots, self.children]
+        )
+
+    def predict_margin(self, features: np.ndarray, block_size: int = 2**12) -> np.ndarray:
+        """
+        Returns the raw margin for each row in *features*, processing *block_size* rows at a time
+        so that the (rows x trees) node index matrix stays small enough to remain in cache.
+        """
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        n_features = features.shape[1]
+        margin = np.empty(len(features), dtype=np.float32)
+
+        for start in range(0, len(features), block_size):
+            x = features[start:start + block_size].ravel()
+            n_rows = len(x) // n_features
+            row_offsets = (np.arange(n_rows, dtype=np.int32) * n_features)[:, None]
+            node = np.broadcast_to(self.roots, (n_rows, len(self.roots)))
+            for _ in range(self.depth):
+                values = x.take(row_offsets + self.feature.take(node))
+                # nan values (missing features) follow the default direction
+                go_left = (values < self.threshold.take(node)) | (np.isnan(values) & self.default_left.take(node))
+                node = self.children.take(2 * node + go_left)
+            margin[start:start + n_rows] = self.value.take(node).sum(axis=1, dtype=np.float32)
+
+        return margin + np.float32(self.base_margin)
+
+    def predict(self, features: np.ndarray, **kwargs) -> np.ndarray:
+        """
+        Returns the probability of the positive class for each row in *features*.
+        """
+        return 1.0 / (1.0 + np.exp(-self.predict_margin(features, **kwargs)))
+
+
+def predict(model: TreeEnsemble | xgboost.XGBClassifier, features: np.ndarray) -> np.ndarray:
+    """
+    Returns the probability of the positive class for each row in *features* given a *model*
+    that is either a :py:class:`TreeEnsemble` or an xgboost classifier.
+    """
+    if isinstance(model, TreeEnsemble):
+        return model.predict(features)
+    return model.get_booster().inplace_predict(features)
+
+
+class ModelCache(object):
+    """
+    Process-wide registry of deserialized models, keyed by the engine used to load them, the real
+    path of the model file and its modification time, so that each model is loaded only once per
+    process and reloaded automatically when the file changes. Least recently used models are
+    evicted once more than *max_entries* models are held, or once their estimated total size
+    exceeds *max_bytes*, while the most recently requested model is always kept.
+
+    Processes forked after a model was loaded inherit the cache and share its memory with the
+    parent until written to, which the cache avoids by marking arrays of numpy-based models as
+    read-only.
+    """
+
+    def __init__(self, max_entries: int = 8, max_bytes: int = 2**30) -> None:
+        super().__init__()
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Estimated total size of all cached models in bytes.
+        """
+        return sum(size for _, size in self._entries.values())
+
+    @classmethod
+    def load(cls, path: str, engine: str) -> tuple[TreeEnsemble | xgboost.XGBClassifier, int]:
+        """
+        Loads the model at *path* with a certain *engine* and returns it, together with an estimate
+        of its size in bytes.
+        """
+        if engine == "numpy":
+            model = TreeEnsemble.from_xgboost_json(path)
+            for attr in ["feature", "threshold", "default_left", "value", "roots", "children"]:
+                getattr(model, attr).flags.writeable = False
+            return model, model.nbytes
+
+        if engine == "xgboost":
+            from xgboost import XGBClassifier
+
+            model = XGBClassifier()
+            model.load_model(path)
+            # the in-memory booster is roughly as large as its serialized form
+            return model, os.path.getsize(path)
+
+        raise ValueError(f"unknown model engine '{engine}'")
+
+    def get(self, path: str, engine: str) -> TreeEnsemble | xgboost.XGBClassifier:
+        """
+        Returns the model at *path* loaded with *engine*, either from the cache or by loading it.
+        """
+        path = os.path.realpath(os.path.expandvars(os.path.expanduser(path)))
+        key = (engine, path, os.stat(path).st_mtime_ns)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+
+            # remove entries referring to outdated versions of the same file
+            for _key in list(self._entries):
+                if _key[:2] == key[:2]:
+                    del self._entries[_key]
+
+            model, size = self.load(path, engine)
+            self._entries[key] = (model, size)
+
+            # evict least recently used entries
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self.nbytes > self.max_bytes
+            ):
+                self._entries.popitem(last=False)
+
+            return model
+
+    def clear(self) -> None:
+        """
+        Removes all models from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+#: Process-wide model cache used by the ml producers.
+model_cache = ModelCache()
+
 
 @producer(
     uses={
         "event",
+        "Jet.pt", "Jet.eta", "Jet.phi", "Jet.mass", "Jet.btagCSVV2", "Jet.qgl",
+        "Electron.pt", "Electron.eta", "Electron.phi", "Electron.mass",
+        "Muon.pt", "Muon.eta", "Muon.phi", "Muon.mass",
+    },
+    produces={
+        "ml.score",
+        *(f"ml.{name}" for name in permutation_feature_names),
     },
+    # maximum number of leading jets to consider for permutations
+    max_n_jets=6,
+    # model evaluation engine, either "xgboost" or "numpy"
+    engine="xgboost",
 )
 def ttbar_ml_score(
     self: Producer,
@@ -23,8 +349,90 @@ def ttbar_ml_score(
     **kwargs,
 ) -> ak.Array:
     """
-    TODO: implement
+    Jet-permutation scorer of the AGC. For events with at least four jets and exactly one lepton,
+    all assignments of the leading jets to the decay products of the hadronic and leptonic top
+    quarks are scored by a BDT, and the score and features of the best permutation are stored.
+
+    Models are evaluated in two folds: events with an even event number are scored by the model
+    trained on odd events, and vice versa. Each fold is evaluated in a single batch per chunk.
     """
+    flat = lambda arr: ak.to_numpy(ak.flatten(arr, axis=1))
+
+    # flat jet buffers
+    jet_pt, jet_offsets = flat_and_offsets(events.Jet.pt)
+    jets = {
+        "pt": jet_pt,
+        "eta": flat(events.Jet.eta),
+        "phi": flat(events.Jet.phi),
+        "mass": flat(events.Jet.mass),
+        "btag": flat(events.Jet.btagCSVV2),
+        "qgl": flat(events.Jet.qgl),
+    }
+    n_jets = np.diff(jet_offsets)
+
+    # single lepton per event, preferring electrons as in the AGC reference
+    _, e_offsets = flat_and_offsets(events.Electron.pt)
+    _, mu_offsets = flat_and_offsets(events.Muon.pt)
+    n_electrons = np.diff(e_offsets)
+    n_leptons = n_electrons + np.diff(mu_offsets)
+    lepton = {
+        field: np.where(
+            n_electrons > 0,
+            gather_index(flat(events.Electron[field]), e_offsets, 0, EMPTY_FLOAT),
+            gather_index(flat(events.Muon[field]), mu_offsets, 0, EMPTY_FLOAT),
+        )
+        for field in ["pt", "eta", "phi", "mass"]
+    }
+
+    # group events by fold and by the number of considered jets, sharing the same permutations per
+    # group, and so that rows of each fold form a contiguous block in the feature matrix
+    n_considered = np.minimum(n_jets, self.max_n_jets)
+    n_considered[(n_jets < 4) | (n_leptons != 1)] = 0
+    even = ak.to_numpy(events.event) % 2 == 0
+    groups = []
+    fold_rows = []
+    n_rows = 0
+    for fold_mask in [even, ~even]:
+        fold_start = n_rows
+        for n in range(4, self.max_n_jets + 1):
+            event_indices = np.flatnonzero(fold_mask & (n_considered == n))
+            if len(event_indices):
+                perms = jet_permutations(n)
+                groups.append((event_indices, perms, n_rows))
+                n_rows += len(event_indices) * len(perms)
+        fold_rows.append((fold_start, n_rows))
+
+    # build features of all groups into one contiguous matrix
+    flat_features = np.empty((n_rows, len(permutation_feature_names)), dtype=np.float32)
+    group_features = []
+    for event_indices, perms, row in groups:
+        out = flat_features[row:row + len(event_indices) * len(perms)]
+        out = out.reshape(len(event_indices), len(perms), -1)
+        group_features.append(
+            permutation_features(jets, jet_offsets, lepton, event_indices, perms, out=out),
+        )
+
+    # score both folds in one batch each, applying the model that was trained on the other fold
+    scores = np.empty(n_rows, dtype=np.float32)
+    for (start, stop), model in zip(fold_rows, [self.model_odd, self.model_even]):
+        if stop > start:
+            scores[start:stop] = predict(model, flat_features[start:stop])
+
+    # per event, pick the permutation with the highest score, defaulting to empty values
+    score = np.full(len(events), EMPTY_FLOAT, dtype=np.float32)
+    best_features = np.full((len(events), len(permutation_feature_names)), EMPTY_FLOAT, dtype=np.float32)
+    for (event_indices, perms, row), feats in zip(groups, group_features):
+        n_events, n_perms = len(event_indices), len(perms)
+        group_scores = scores[row:row + n_events * n_perms].reshape(n_events, n_perms)
+        best = np.argmax(group_scores, axis=1)
+        score[event_indices] = group_scores[np.arange(n_events), best]
+        best_features[event_indices] = feats[np.arange(n_events), best]
+
+    # store columns
+    events = set_ak_column(events, "ml.score", score)
+    for i, name in enumerate(permutation_feature_names):
+        events = set_ak_column(events, f"ml.{name}", best_features[:, i])
+
     return events
 
 
@@ -38,11 +446,11 @@ def ttbar_ml_score_setup(
     """
     Custom setup function invoked before chunks are processed.
     """
-    from xgboost import XGBClassifier
+    # models are loaded only once per process and shared between producer instances
+    model_dir = os.path.expandvars("$AGC_SRC_BASE/analyses/cms-open-data-ttbar/models")
+    self.model_even = model_cache.get(os.path.join(model_dir, "model_even"), self.engine)
+    self.model_odd = model_cache.get(os.path.join(model_dir, "model_odd"), self.engine)
 
-    self.model_even = XGBClassifier()
-    self.model_odd = XGBClassifier()
 
-    model_dir = os.path.expandvars("$AGC_SRC_BASE/analyses/cms-open-data-ttbar/models")
-    self.model_even.load_model(os.path.join(model_dir, "model_even"))
-    self.model_odd.load_model(os.path.join(model_dir, "model_odd"))
+# version of the scorer that does not depend on xgboost at runtime
+ttbar_ml_score_numpy = ttbar_ml_score.derive("ttbar_ml_score_numpy", cls_dict={"engine": "numpy"})
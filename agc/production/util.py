@@ -0,0 +1,142 @@
+# coding: utf-8
+
+"""
+Helpers for column production that operate on flat, contiguous buffers of jagged collections.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def flat_and_offsets(array: ak.Array) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the flat content of a jagged *array* with a depth of two as a numpy array, as well as
+    the list offsets with a length of ``len(array) + 1``.
+    """
+    counts = ak.to_numpy(ak.num(array, axis=1)).astype(np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return ak.to_numpy(ak.flatten(array, axis=1)), offsets
+
+
+def p4_cartesian(
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Converts four-vector components given in *pt*, *eta*, *phi* and *mass* to cartesian
+    coordinates x, y, z and t, following the same arithmetic as coffea's LorentzVector behavior.
+    """
+    x = pt * np.cos(phi)
+    y = pt * np.sin(phi)
+    z = pt * np.sinh(eta)
+    t = np.hypot(pt * np.cosh(eta), mass)
+    return x, y, z, t
+
+
+def p4_mass(x: np.ndarray, y: np.ndarray, z: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """
+    Returns the invariant mass of four-vectors given in cartesian coordinates.
+    """
+    return np.sqrt(t**2 - (x**2 + y**2 + z**2))
+
+
+def max_pt_trijet_mass(
+    pt: np.ndarray,
+    eta: np.ndarray,
+    phi: np.ndarray,
+    mass: np.ndarray,
+    btag: np.ndarray,
+    offsets: np.ndarray,
+    btag_threshold: float = 0.5,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Computes, per event, the mass of the trijet system with the highest transverse momentum among
+    all combinations of three jets that contain at least one jet with a *btag* value of at least
+    *btag_threshold*. Jets are given as flat buffers *pt*, *eta*, *phi*, *mass* and *btag*, with
+    events being defined through *offsets*.
+
+    The result is identical to evaluating ``ak.combinations(jets, 3)``, masking and taking the
+    argmax, but the triplets are never materialized. Instead, events are ordered by their jet
+    multiplicity so that the events that hold a jet at a certain position form a prefix, and the
+    loop over jet index triplets (i, j, k) only ever processes these prefixes. Memory consumption
+    is therefore linear in the number of events, independent of the jet multiplicity.
+
+    Two numpy arrays are returned, containing the trijet masses and a boolean mask denoting events
+    for which a valid triplet was found.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    n_events = len(counts)
+    dtype = np.result_type(pt, mass)
+
+    # cartesian coordinates and tag decisions per jet
+    x, y, z, t = p4_cartesian(pt, eta, phi, mass)
+    tagged = btag >= btag_threshold
+
+    # sort events by decreasing multiplicity, then n_min[m] is the number of events with >= m jets
+    order = np.argsort(-counts, kind="stable")
+    starts = offsets[:-1][order]
+    n_max = int(counts[order[0]]) if n_events else 0
+    n_min = np.searchsorted(-counts[order], -np.arange(n_max + 1), side="right")
+
+    # components of the best triplet per (sorted) event
+    best_pt = np.full(n_events, -np.inf, dtype=dtype)
+    best_x, best_y, best_z, best_t = (np.zeros(n_events, dtype=dtype) for _ in range(4))
+
+    # lexicographic loop with a strict comparison, so that the first maximum wins as in ak.argmax
+    for i in range(n_max - 2):
+        for j in range(i + 1, n_max - 1):
+            # events that have at least one more jet after j
+            s = starts[:n_min[j + 2]]
+            a, b = s + i, s + j
+            ij_x, ij_y, ij_z, ij_t = x[a] + x[b], y[a] + y[b], z[a] + z[b], t[a] + t[b]
+            ij_tagged = tagged[a] | tagged[b]
+            for k in range(j + 1, n_max):
+                n = n_min[k + 1]
+                c = s[:n] + k
+                tri_x = ij_x[:n] + x[c]
+                tri_y = ij_y[:n] + y[c]
+                tri_pt = np.hypot(tri_x, tri_y)
+                better = (ij_tagged[:n] | tagged[c]) & (tri_pt > best_pt[:n])
+                if not better.any():
+                    continue
+                idx = np.flatnonzero(better)
+                best_pt[idx] = tri_pt[idx]
+                best_x[idx] = tri_x[idx]
+                best_y[idx] = tri_y[idx]
+                best_z[idx] = ij_z[idx] + z[c[idx]]
+                best_t[idx] = ij_t[idx] + t[c[idx]]
+
+    # compute masses and revert the multiplicity ordering
+    trijet_mass = np.empty(n_events, dtype=dtype)
+    trijet_mass[order] = p4_mass(best_x, best_y, best_z, best_t)
+    valid = np.empty(n_events, dtype=bool)
+    valid[order] = np.isfinite(best_pt)
+
+    return trijet_mass, valid
+
+
+def gather_index(
+    flat: np.ndarray,
+    offsets: np.ndarray,
+    index: int,
+    null_value: int | float,
+) -> np.ndarray:
+    """
+    Returns the element at position *index* of each list defined by *flat* content and *offsets*,
+    or *null_value* for lists that are too short. Negative indices are counted from the end of each
+    list.
+    """
+    counts = np.diff(offsets)
+    out = np.full(len(counts), null_value, dtype=np.result_type(flat, null_value))
+    valid = counts > index if index >= 0 else counts >= -index
+    pos = (offsets[:-1] if index >= 0 else offsets[1:]) + index
+    out[valid] = flat[pos[valid]]
+    return out
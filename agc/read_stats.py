@@ -0,0 +1,73 @@
+# coding: utf-8
+
+"""
+Accounting of the bytes read from root files opened by chunked io handlers in the current process,
+and of the wall time since they were opened, see
+:py:func:`agc.columnflow_patches.patch_read_stats`.
+"""
+
+from __future__ import annotations
+
+import time
+import threading
+
+
+_lock = threading.Lock()
+
+# uproot sources of opened files, mapped to their number of requested bytes at the last call to
+# pop_read_stats, and the start time of the current interval
+_sources: dict = {}
+_start_time: float | None = None
+
+
+def track_source(source) -> None:
+    """
+    Starts tracking the bytes read from an uproot *source*, dropping all previously tracked sources
+    and resetting the wall time. Called when a root file is opened.
+    """
+    global _start_time
+
+    with _lock:
+        _sources.clear()
+        _sources[source] = 0
+        _start_time = time.perf_counter()
+
+
+def pop_read_stats() -> tuple[int, float]:
+    """
+    Returns the number of bytes read from all tracked sources and the wall time elapsed since the
+    previous call, or since the last source was opened, and starts a new interval. Zeros are returned
+    when no source was opened.
+    """
+    global _start_time
+
+    with _lock:
+        if _start_time is None:
+            return 0, 0.0
+
+        nbytes = 0
+        for source, n in _sources.items():
+            _sources[source] = source.num_requested_bytes
+            nbytes += _sources[source] - n
+
+        now = time.perf_counter()
+        wall_time = now - _start_time
+        _start_time = now
+
+    return nbytes, wall_time
+
+
+def get_read_stats_keys(prefix: str = "") -> tuple[str, str]:
+    """
+    Returns the keys of the number of bytes read and the wall time in stats, starting with *prefix*.
+    """
+    return f"{prefix}read_bytes", f"{prefix}wall_time"
+
+
+def add_read_stats(stats: dict, prefix: str = "") -> None:
+    """
+    Increments the entries of *stats* named by :py:func:`get_read_stats_keys` by the values returned
+    by :py:func:`pop_read_stats`.
+    """
+    for key, value in zip(get_read_stats_keys(prefix), pop_read_stats()):
+        stats[key] += value
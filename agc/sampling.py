@@ -0,0 +1,112 @@
+# coding: utf-8
+
+"""
+Helpers for deterministic sampling of event fractions, with entire clusters being either sampled or
+skipped so that readers never need to read unsampled entries. Sampling is enabled by the
+*sample_fraction* auxiliary field of a config. As the sums of mc weights are only computed for
+processed events, normalization weights are corrected accordingly.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+from agc.util import counter_uniform
+
+np = maybe_import("numpy")
+
+
+def get_sampling_open_options(config_inst) -> dict:
+    """
+    Returns open options of root sources for sampling the fraction of events configured in the
+    auxiliary fields of a *config_inst*, or an empty dictionary when no sampling is configured.
+    """
+    fraction = config_inst.x("sample_fraction", None) if config_inst else None
+    if fraction is None:
+        return {}
+    return {"agc_sample_fraction": fraction, "agc_sample_seed": config_inst.x.sample_seed}
+
+
+def sampled_entry_ranges(
+    tree,
+    fraction: float,
+    seed: int = 0,
+    event_branch: str = "event",
+) -> list[tuple[int, int]]:
+    """
+    Returns a list of ``(entry_start, entry_stop)`` ranges of clusters of a *tree* that are sampled
+    with a certain *fraction*. Whether a cluster is sampled is decided by a hash of the event number
+    of its first entry and a *seed*, so that the decision does not depend on file names or on the
+    order of processing, and the sample is stratified across all files. Only the first entry of
+    each cluster is read. At least one cluster, the one with the smallest hash, is sampled per
+    non-empty tree. Adjacent sampled clusters are merged into single ranges.
+    """
+    offsets = np.asarray(tree.common_entry_offsets(), dtype=np.int64)
+    if len(offsets) < 2:
+        return []
+
+    # hash the event number of the first entry per cluster
+    branch = tree[event_branch]
+    event = np.concatenate([
+        branch.array(entry_start=start, entry_stop=start + 1, library="np")
+        for start in offsets[:-1].tolist()
+    ])
+    uniform = counter_uniform(event, seed=seed)
+    sampled = uniform < fraction
+    if not sampled.any():
+        sampled[np.argmin(uniform)] = True
+
+    ranges = []
+    for start, stop in zip(offsets[:-1][sampled].tolist(), offsets[1:][sampled].tolist()):
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], stop)
+        else:
+            ranges.append((start, stop))
+
+    return ranges
+
+
+def map_entry_range(
+    ranges: list[tuple[int, int]],
+    entry_start: int,
+    entry_stop: int,
+) -> list[tuple[int, int]]:
+    """
+    Maps an entry range ``[entry_start, entry_stop)`` that refers to the concatenation of sampled
+    *ranges* to a list of ranges of original entries.
+    """
+    mapped = []
+    offset = 0
+    for start, stop in ranges:
+        n = stop - start
+        lo = max(entry_start - offset, 0)
+        hi = min(entry_stop - offset, n)
+        if lo < hi:
+            mapped.append((start + lo, start + hi))
+        offset += n
+        if offset >= entry_stop:
+            break
+    return mapped
+
+
+def intersect_entry_ranges(
+    ranges1: list[tuple[int, int]],
+    ranges2: list[tuple[int, int]],
+) -> list[tuple[int, int]]:
+    """
+    Returns the intersection of two sorted lists of non-overlapping entry ranges *ranges1* and
+    *ranges2*, again as a sorted list of ``(entry_start, entry_stop)`` ranges.
+    """
+    intersection = []
+    i = j = 0
+    while i < len(ranges1) and j < len(ranges2):
+        start = max(ranges1[i][0], ranges2[j][0])
+        stop = min(ranges1[i][1], ranges2[j][1])
+        if start < stop:
+            intersection.append((start, stop))
+        # advance the range that ends first
+        if ranges1[i][1] < ranges2[j][1]:
+            i += 1
+        else:
+            j += 1
+    return intersection
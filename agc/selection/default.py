@@ -5,18 +5,25 @@ Event selectors.
 """
 
 from functools import reduce
-from operator import and_
+from operator import and_, or_
 from collections import defaultdict
 
+import law
+
 from columnflow.selection import Selector, SelectionResult, selector
 from columnflow.selection.util import sorted_indices_from_mask
-from columnflow.selection.stats import increment_stats
 from columnflow.production.processes import process_ids
 from columnflow.production.cms.mc_weight import mc_weight
 from columnflow.util import maybe_import
+from columnflow.columnar_util import Route, set_ak_column
 
-from agc.calibration.default import jec_shifts
+from agc.calibration.default import jec_shifts, get_jec_shift_jet_aliases, any_shift_jet_collection
+from agc.columnar_util import resolve_virtual_columns
 from agc.production.features import cutflow_features
+from agc.production.util import flat_and_offsets
+from agc.read_stats import add_read_stats
+from agc.selection.stats import increment_stats_grouped
+from agc.selection.util import flat_column, sorted_masked_positions, to_jagged_indices
 
 np = maybe_import("numpy")
 ak = maybe_import("awkward")
@@ -29,90 +36,152 @@ ak = maybe_import("awkward")
 
 @selector(
     uses={"Electron.pt", "Electron.eta", "Electron.cutBased", "Electron.sip3d"},
+    # whether to evaluate the selection on flat buffers, sorting and counting surviving objects in
+    # a single pass instead of using jagged masks and per-event sorting
+    fused=True,
 )
 def electron_selection(
     self: Selector,
     events: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-    # per electron selection
-    electron_mask = (
-        (events.Electron.pt > 30.0) &
-        (np.abs(events.Electron.eta) < 2.1) &
-        (events.Electron.cutBased == 4) &
-        (events.Electron.sip3d < 4.0)
-    )
+    if self.fused:
+        # per electron selection on flat buffers
+        pt, offsets = flat_and_offsets(events.Electron.pt)
+        electron_mask = (
+            (pt > 30.0) &
+            (np.abs(flat_column(events, "Electron", "eta")) < 2.1) &
+            (flat_column(events, "Electron", "cutBased") == 4) &
+            (flat_column(events, "Electron", "sip3d") < 4.0)
+        )
+        pos, event_index = sorted_masked_positions(electron_mask, pt, offsets, ascending=False)
+        electron_indices, n_electrons = to_jagged_indices(pos, event_index, offsets)
+    else:
+        # per electron selection
+        electron_mask = (
+            (events.Electron.pt > 30.0) &
+            (np.abs(events.Electron.eta) < 2.1) &
+            (events.Electron.cutBased == 4) &
+            (events.Electron.sip3d < 4.0)
+        )
+        electron_indices = sorted_indices_from_mask(electron_mask, events.Electron.pt, ascending=False)
+        n_electrons = ak.sum(electron_mask, axis=1)
 
     return events, SelectionResult(
         objects={
             "Electron": {
-                "Electron": sorted_indices_from_mask(electron_mask, events.Electron.pt, ascending=False),
+                "Electron": electron_indices,
             },
         },
         aux={
-            "n_electrons": ak.sum(electron_mask, axis=1),
+            "n_electrons": n_electrons,
         },
     )
 
 
 @selector(
     uses={"Muon.pt", "Muon.eta", "Muon.tightId", "Muon.sip3d", "Muon.pfRelIso04_all"},
+    # whether to evaluate the selection on flat buffers, sorting and counting surviving objects in
+    # a single pass instead of using jagged masks and per-event sorting
+    fused=True,
 )
 def muon_selection(
     self: Selector,
     events: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-    # per muon selection
-    muon_mask = (
-        (events.Muon.pt > 30.0) &
-        (abs(events.Muon.eta) < 2.1) &
-        (events.Muon.tightId) &
-        (events.Muon.sip3d < 4.0) &
-        (events.Muon.pfRelIso04_all < 0.15)
-    )
+    if self.fused:
+        # per muon selection on flat buffers
+        pt, offsets = flat_and_offsets(events.Muon.pt)
+        muon_mask = (
+            (pt > 30.0) &
+            (abs(flat_column(events, "Muon", "eta")) < 2.1) &
+            (flat_column(events, "Muon", "tightId")) &
+            (flat_column(events, "Muon", "sip3d") < 4.0) &
+            (flat_column(events, "Muon", "pfRelIso04_all") < 0.15)
+        )
+        pos, event_index = sorted_masked_positions(muon_mask, pt, offsets, ascending=False)
+        muon_indices, n_muons = to_jagged_indices(pos, event_index, offsets)
+    else:
+        # per muon selection
+        muon_mask = (
+            (events.Muon.pt > 30.0) &
+            (abs(events.Muon.eta) < 2.1) &
+            (events.Muon.tightId) &
+            (events.Muon.sip3d < 4.0) &
+            (events.Muon.pfRelIso04_all < 0.15)
+        )
+        muon_indices = sorted_indices_from_mask(muon_mask, events.Muon.pt, ascending=False)
+        n_muons = ak.sum(muon_mask, axis=1)
 
     return events, SelectionResult(
         objects={
             "Muon": {
-                "Muon": sorted_indices_from_mask(muon_mask, events.Muon.pt, ascending=False),
+                "Muon": muon_indices,
             },
         },
         aux={
-            "n_muons": ak.sum(muon_mask, axis=1),
+            "n_muons": n_muons,
         },
     )
 
 
 @selector(
     uses={"Jet.pt", "Jet.eta", "Jet.jetId", "Jet.btagCSVV2"},
+    # whether to evaluate the selection on flat buffers, sorting and counting surviving objects in
+    # a single pass instead of using jagged masks and per-event sorting
+    fused=True,
+    # whether to only sort jets in events whose selected jets are not already ordered by decreasing
+    # pt, as stored in nano files, which yields identical results (only considered when fused)
+    lazy_sort=False,
 )
 def jet_selection(
     self: Selector,
     events: ak.Array,
     **kwargs,
 ) -> tuple[ak.Array, SelectionResult]:
-    # per jet selection
-    jet_mask = (
-        (events.Jet.pt > 30.0) &
-        (abs(events.Jet.eta) < 2.4) &
-        # the jetId bit at index 2 refers to the tight lepton veto
-        ((events.Jet.jetId & (1 << 2)) != 0)
-    )
-
-    # additional btag selection
-    btag_mask = jet_mask & (events.Jet.btagCSVV2 >= 0.5)
+    if self.fused:
+        # per jet selection on flat buffers
+        pt, offsets = flat_and_offsets(events.Jet.pt)
+        jet_mask = (
+            (pt > 30.0) &
+            (abs(flat_column(events, "Jet", "eta")) < 2.4) &
+            # the jetId bit at index 2 refers to the tight lepton veto
+            ((flat_column(events, "Jet", "jetId") & (1 << 2)) != 0)
+        )
+        pos, event_index = sorted_masked_positions(jet_mask, pt, offsets, ascending=False, lazy=self.lazy_sort)
+        jet_indices, n_jets = to_jagged_indices(pos, event_index, offsets)
+
+        # additional btag selection, applied to the already sorted jets
+        btag_mask = flat_column(events, "Jet", "btagCSVV2")[pos] >= 0.5
+        bjet_indices, n_btags = to_jagged_indices(pos[btag_mask], event_index[btag_mask], offsets)
+    else:
+        # per jet selection
+        jet_mask = (
+            (events.Jet.pt > 30.0) &
+            (abs(events.Jet.eta) < 2.4) &
+            # the jetId bit at index 2 refers to the tight lepton veto
+            ((events.Jet.jetId & (1 << 2)) != 0)
+        )
+
+        # additional btag selection
+        btag_mask = jet_mask & (events.Jet.btagCSVV2 >= 0.5)
+
+        jet_indices = sorted_indices_from_mask(jet_mask, events.Jet.pt, ascending=False)
+        bjet_indices = sorted_indices_from_mask(btag_mask, events.Jet.pt, ascending=False)
+        n_jets = ak.sum(jet_mask, axis=1)
+        n_btags = ak.sum(btag_mask, axis=1)
 
     return events, SelectionResult(
         objects={
             "Jet": {
-                "Jet": sorted_indices_from_mask(jet_mask, events.Jet.pt, ascending=False),
-                "BJet": sorted_indices_from_mask(btag_mask, events.Jet.pt, ascending=False),
+                "Jet": jet_indices,
+                "BJet": bjet_indices,
             },
         },
         aux={
-            "n_jets": ak.sum(jet_mask, axis=1),
-            "n_btags": ak.sum(btag_mask, axis=1),
+            "n_jets": n_jets,
+            "n_btags": n_btags,
         },
     )
 
@@ -146,8 +215,8 @@ def event_selection(
 
 @selector(
     uses={
-        process_ids, mc_weight, electron_selection, muon_selection, jet_selection,
-        event_selection, cutflow_features, increment_stats,
+        process_ids, mc_weight, electron_selection, muon_selection, event_selection,
+        cutflow_features, increment_stats_grouped,
     },
     produces={
         process_ids, mc_weight, cutflow_features,
@@ -156,6 +225,22 @@ def event_selection(
         jec_shifts,
     },
     exposed=True,
+    # selector of jets
+    jet_selector=jet_selection,
+    # whether to additionally evaluate the jet and event selection for all jet energy shifts when
+    # running on nominal events, using the shifted jet columns referred to by the column aliases of
+    # the corresponding shifts and reusing the lepton selection, so that express tasks can skip the
+    # selection of these shifts (see agc.tasks.express.ExpressHistograms), while the reduction only
+    # considers them with shift_union
+    multi_shift=False,
+    # whether to keep all events selected in the nominal or any jet energy shift, storing their
+    # event selection as "shift_selected.<name>" and the union of their selected jets as an
+    # additional jet collection, so that producers can evaluate all shifts on the same reduced
+    # events and only histograms are created per shift (requires multi_shift)
+    shift_union=False,
+    # whether to record the bytes read from the nano file and the wall time in the selection stats
+    # as "selection_read_bytes" and "selection_wall_time", which makes them non-deterministic
+    profile_stats=law.config.get_expanded_bool("analysis", "selection_profile_stats", True),
 )
 def default(
     self: Selector,
@@ -182,7 +267,7 @@ def default(
     results += muon_results
 
     # jet selection
-    events, jet_results = self[jet_selection](events, **kwargs)
+    events, jet_results = self[self.jet_selector](events, **kwargs)
     results += jet_results
 
     # full event selection
@@ -194,23 +279,47 @@ def default(
     # combined event selection after all steps
     results.event = reduce(and_, results.steps.values())
 
+    # jet and event selection for jet energy shifts, stored as additional fields "shift_<name>"
+    # with the same structure as the nominal results, but only containing jet objects
+    shift_results = {}
+    if self.dataset_inst.is_mc and self.global_shift_inst.name == "nominal":
+        for shift_name, jet_aliases in self.shift_jet_aliases.items():
+            _events = resolve_virtual_columns(events, jet_aliases.values())
+            jets = events.Jet
+            for field, src in jet_aliases.items():
+                jets = set_ak_column(jets, field, Route(src).apply(_events))
+            shifted_events = set_ak_column(events, "Jet", jets)
+
+            _results = SelectionResult(aux={
+                "n_electrons": results.x.n_electrons,
+                "n_muons": results.x.n_muons,
+            })
+            _, _jet_results = self[self.jet_selector](shifted_events, **kwargs)
+            _results += _jet_results
+            _, _results = self[event_selection](shifted_events, _results, **kwargs)
+            shift_results[shift_name] = _results
+            results.other[f"shift_{shift_name}"] = _results.to_ak()
+
     # increment stats
     weight_map = {
         "num_events": Ellipsis,
         "num_events_selected": results.event,
     }
+    for shift_name, _results in shift_results.items():
+        weight_map[f"num_events_selected_{shift_name}"] = _results.event
     group_map = {}
     if self.dataset_inst.is_mc:
         # sum of mc weight for all events
         weight_map["sum_mc_weight"] = (events.mc_weight, Ellipsis)
         # sum of mc weight for selected events
         weight_map["sum_mc_weight_selected"] = (events.mc_weight, results.event)
+        for shift_name, _results in shift_results.items():
+            weight_map[f"sum_mc_weight_selected_{shift_name}"] = (events.mc_weight, _results.event)
         # store all weights per process id
         group_map["process"] = {
             "values": events.process_id,
-            "mask_fn": (lambda v: events.process_id == v),
         }
-    events, results = self[increment_stats](
+    events, results = self[increment_stats_grouped](
         events=events,
         results=results,
         stats=stats,
@@ -219,4 +328,70 @@ def default(
         **kwargs,
     )
 
+    # keep events selected in any shift, with the nominal selection stored in the stats and steps
+    if self.shift_union and shift_results:
+        all_results = {"nominal": results, **shift_results}
+        for shift_name, _results in all_results.items():
+            events = set_ak_column(events, f"shift_selected.{shift_name}", _results.event)
+
+        # jets selected in any shift, in their original order
+        _, offsets = flat_and_offsets(events.Jet.pt)
+        jet_mask = np.zeros(offsets[-1], dtype=bool)
+        for _results in all_results.values():
+            jet_indices = _results.objects.Jet.Jet
+            jet_mask[ak.to_numpy(ak.flatten(jet_indices)) + np.repeat(offsets[:-1], ak.num(jet_indices))] = True
+        pos = np.flatnonzero(jet_mask)
+        jet_indices, _ = to_jagged_indices(pos, np.searchsorted(offsets, pos, side="right") - 1, offsets)
+        results.objects.Jet[any_shift_jet_collection] = jet_indices
+
+        results.event = reduce(or_, (_results.event for _results in all_results.values()))
+
+    # bytes read and wall time since the previous chunk, including reading and writing, which are
+    # summed per dataset when merging stats
+    if self.profile_stats:
+        add_read_stats(stats, prefix="selection_")
+
     return events, results
+
+
+@default.init
+def default_init(self: Selector) -> None:
+    # add the jet selector to the dependency sets
+    self.uses |= {self.jet_selector}
+
+    # store jet column aliases per jet energy shift, relative to the Jet collection
+    # (shifted jet columns are only produced by the mc-only jec calibrator)
+    self.shift_jet_aliases = {}
+    if not self.multi_shift:
+        return
+
+    # when keeping events of all shifts, the selection is shared between them and no longer
+    # evaluated per shift, which is left to downstream array functions registering them
+    if self.shift_union:
+        self.shifts.discard(jec_shifts)
+
+    if getattr(self, "dataset_inst", None) and not self.dataset_inst.is_mc:
+        return
+
+    self.shift_jet_aliases = get_jec_shift_jet_aliases(self.config_inst)
+
+    # update dependency sets
+    for jet_aliases in self.shift_jet_aliases.values():
+        self.uses |= set(jet_aliases.values())
+    if self.shift_union:
+        self.produces |= {f"shift_selected.{name}" for name in ["nominal", *self.shift_jet_aliases]}
+
+
+# version of the default selector that only sorts jets in events in which they are not already
+# ordered by decreasing pt, which is an in-memory optimization that yields identical results
+default_lazy_sort = default.derive(
+    "default_lazy_sort",
+    cls_dict={"jet_selector": jet_selection.derive("jet_selection_lazy_sort", cls_dict={"lazy_sort": True})},
+)
+
+# multi-shift version that additionally selects events for all jet energy shifts in a single pass
+default_multi_shift = default.derive("default_multi_shift", cls_dict={"multi_shift": True})
+
+# multi-shift version that keeps events selected in any jet energy shift for shifted production
+# (see agc.production.default.default_multi_shift)
+default_shift_union = default.derive("default_shift_union", cls_dict={"multi_shift": True, "shift_union": True})
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+"""
+Selector helpers for book keeping of selection and event weight statistics.
+"""
+
+from __future__ import annotations
+
+from functools import reduce
+from collections import defaultdict
+from operator import getitem
+
+from columnflow.selection import Selector, SelectionResult, selector
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def nested_defaultdict(dtype: type, depth: int) -> defaultdict:
+    """
+    Returns a nested defaultdict with *depth* levels whose innermost values default to *dtype*.
+    """
+    if depth <= 1:
+        return defaultdict(dtype)
+    return defaultdict(lambda: nested_defaultdict(dtype, depth - 1))
+
+
+@selector(
+    call_force=True,
+)
+def increment_stats_grouped(
+    self: Selector,
+    events: ak.Array,
+    results: SelectionResult,
+    stats: dict,
+    weight_map: dict[str, ak.Array | tuple[ak.Array, ak.Array]] | None = None,
+    group_map: dict[str, dict[str, ak.Array | bool]] | None = None,
+    group_combinations: list[tuple[str]] | None = None,
+    **kwargs,
+) -> tuple[ak.Array, SelectionResult]:
+    """
+    Drop-in replacement for :py:class:`columnflow.selection.stats.increment_stats` that fills the
+    same fields in *stats* given the same *weight_map*, but computes sums per group in a single
+    ``np.bincount`` pass over dense group codes, so that its cost does not scale with the number of
+    unique values per group.
+
+    Entries in *group_map* only require the per-event ``"values"``, and optionally
+    ``"combinations_only"``, whereas a ``"mask_fn"`` is not needed and ignored if present.
+    """
+    weight_map = weight_map or {}
+    group_map = group_map or {}
+
+    # unique values and dense codes per group
+    unique_group_values, group_codes = {}, {}
+    for group_name, group_data in group_map.items():
+        values = ak.to_numpy(group_data["values"])
+        unique_group_values[group_name], group_codes[group_name] = np.unique(values, return_inverse=True)
+
+    # treat groups as combinations of a single group
+    group_combinations = list(group_combinations or [])
+    for group_name, group_data in list(group_map.items())[::-1]:
+        if group_data.get("combinations_only", False) or (group_name,) in group_combinations:
+            continue
+        group_combinations.insert(0, (group_name,))
+
+    # combined codes per group combination
+    combination_codes = {}
+    for group_names in group_combinations:
+        shape = tuple(len(unique_group_values[g]) for g in group_names)
+        codes = np.ravel_multi_index([group_codes[g] for g in group_names], shape)
+        combination_codes[group_names] = (shape, codes)
+
+    # get and store the weights per entry in the map
+    for weight_name, obj in weight_map.items():
+        # check whether the weight is either a "num" or "sum" field
+        is_num = weight_name.startswith("num")
+        if not is_num and not weight_name.startswith("sum"):
+            raise Exception(
+                f"weight '{weight_name}' starting with unknown operation; should either start with "
+                "'num' or 'sum'",
+            )
+
+        # interpret obj based on the operation to be applied
+        weights = None
+        weight_mask = Ellipsis
+        if isinstance(obj, (tuple, list)):
+            if is_num:
+                raise Exception(
+                    f"weight map entry '{weight_name}' should refer to a mask, "
+                    f"but found a sequence: {obj}",
+                )
+            if len(obj) == 1:
+                weights = obj[0]
+            elif len(obj) == 2:
+                weights, weight_mask = obj
+            else:
+                raise Exception(f"cannot interpret as weights and optional mask: '{obj}'")
+        elif is_num:
+            weight_mask = obj
+        else:
+            weights = obj
+
+        # convert to numpy, with an Ellipsis selecting all events
+        if weight_mask is Ellipsis:
+            weight_mask = np.ones(len(events), dtype=bool)
+        else:
+            weight_mask = ak.to_numpy(weight_mask).astype(bool)
+        if weights is not None:
+            weights = ak.to_numpy(weights)[weight_mask].astype(np.float64)
+
+        # apply the operation
+        if is_num:
+            stats[weight_name] += int(weight_mask.sum())
+        else:
+            stats[weight_name] += float(weights.sum())
+
+        # per group combination
+        for group_names, (shape, codes) in combination_codes.items():
+            group_key = f"{weight_name}_per_" + "_and_".join(group_names)
+
+            # set the default structures
+            if group_key not in stats:
+                stats[group_key] = nested_defaultdict(int if is_num else float, len(group_names))
+
+            # sums for all combinations of values at once
+            sums = np.bincount(codes[weight_mask], weights=weights, minlength=int(np.prod(shape)))
+
+            # set values
+            for index in np.ndindex(*shape):
+                str_values = [str(unique_group_values[g][i]) for g, i in zip(group_names, index)]
+                innermost_dict = reduce(getitem, [stats[group_key]] + str_values[:-1])
+                value = sums[np.ravel_multi_index(index, shape)]
+                innermost_dict[str_values[-1]] += int(value) if is_num else float(value)
+
+    return events, results
@@ -0,0 +1,70 @@
+# coding: utf-8
+
+"""
+Helpers for object selection that operate on flat, contiguous buffers of jagged collections.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def flat_column(events: ak.Array, collection: str, field: str) -> np.ndarray:
+    """
+    Returns the flat content of the *field* of a *collection* in *events* as a numpy array.
+    """
+    return ak.to_numpy(ak.flatten(events[collection][field], axis=1))
+
+
+def sorted_masked_positions(
+    mask: np.ndarray,
+    metric: np.ndarray,
+    offsets: np.ndarray,
+    ascending: bool = True,
+    lazy: bool = False,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Segmented argsort of all objects passing a flat *mask*, using a flat *metric* and the list
+    *offsets* of the collection. Objects are sorted per event by their *metric*, with ties keeping
+    their original order. Two arrays are returned, containing the flat positions of the selected,
+    sorted objects and the event index each of them belongs to.
+
+    When *lazy* is *True*, only events whose selected objects are not already in the requested
+    order are sorted. As the sort is stable, the result is identical, but sorting is mostly skipped
+    for collections that are stored in sorted order, such as jets in nano files.
+    """
+    pos = np.flatnonzero(mask)
+    event_index = np.searchsorted(offsets, pos, side="right") - 1
+    key = metric[pos] if ascending else -metric[pos]
+
+    if lazy:
+        # events with at least one pair of neighboring objects in the wrong order
+        unordered = np.zeros(len(offsets) - 1, dtype=bool)
+        unordered[event_index[1:][(key[1:] < key[:-1]) & (event_index[1:] == event_index[:-1])]] = True
+        # sort only their objects, which occupy the same slots before and after sorting
+        idx = np.flatnonzero(unordered[event_index])
+        order = np.lexsort((key[idx], event_index[idx]))
+        pos = pos.copy()
+        pos[idx] = pos[idx[order]]
+        return pos, event_index
+
+    # lexsort is stable and sorts by the last key first, i.e., by event and then by metric
+    order = np.lexsort((key, event_index))
+    return pos[order], event_index[order]
+
+
+def to_jagged_indices(
+    pos: np.ndarray,
+    event_index: np.ndarray,
+    offsets: np.ndarray,
+) -> tuple[ak.Array, np.ndarray]:
+    """
+    Converts flat object positions *pos*, grouped by their *event_index*, into a jagged array of
+    indices local to each event, and returns it together with the number of objects per event.
+    """
+    counts = np.bincount(event_index, minlength=len(offsets) - 1)
+    indices = ak.unflatten(pos - offsets[event_index], counts)
+    return indices, counts
@@ -3,3 +3,7 @@
 
 # provisioning imports
 import agc.tasks.base
+import agc.tasks.catalog
+import agc.tasks.columns
+import agc.tasks.express
+import agc.tasks.inference
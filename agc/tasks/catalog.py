@@ -0,0 +1,152 @@
+# coding: utf-8
+
+"""
+Tasks for building file catalogs and planning balanced work units.
+"""
+
+from __future__ import annotations
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.framework.mixins import CalibratorsMixin, SelectorMixin
+from columnflow.tasks.framework.remote import RemoteWorkflow
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.util import dev_sandbox
+
+from agc.tasks.base import AGCTask
+
+
+class FileCatalog(
+    AGCTask,
+    SelectorMixin,
+    CalibratorsMixin,
+    DatasetTask,
+    law.LocalWorkflow,
+    RemoteWorkflow,
+):
+    """
+    Reads the headers of the input files of a dataset, one per branch, and stores the number of
+    entries, the cluster boundaries and the compressed bytes of all branches read by the
+    calibrators and the selector.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        RemoteWorkflow.reqs,
+        GetDatasetLFNs=GetDatasetLFNs,
+    )
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        reqs["lfns"] = self.reqs.GetDatasetLFNs.req(self)
+        return reqs
+
+    def requires(self):
+        return {"lfns": self.reqs.GetDatasetLFNs.req(self)}
+
+    def output(self):
+        return self.target(f"catalog_{self.branch}.json")
+
+    def get_branch_patterns(self) -> set[str]:
+        """
+        Returns patterns of nano branch names that are read by the calibrators and the selector,
+        including the counts of all collections.
+        """
+        from columnflow.columnar_util import Route, mandatory_coffea_columns
+
+        routes = set(map(Route, mandatory_coffea_columns))
+        for calibrator_inst in self.calibrator_insts:
+            routes |= calibrator_inst.used_columns
+        routes |= self.selector_inst.used_columns
+
+        patterns = set()
+        for route in routes:
+            patterns.add(route.nano_column)
+            if len(route.fields) > 1:
+                patterns.add(f"n{route.fields[0]}")
+
+        return patterns
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        from agc.catalog import scan_file
+
+        lfn_task = self.requires()["lfns"]
+
+        # let the lfn_task prepare the nano file, but only read its header without localizing it
+        [(lfn_index, input_file)] = lfn_task.iter_nano_files(self)
+        path = (
+            input_file.abspath
+            if isinstance(input_file, law.LocalFileTarget)
+            else law.util.make_list(input_file.uri())[0]
+        )
+
+        entry = scan_file(path, branches=self.get_branch_patterns())
+        entry["lfn_index"] = lfn_index
+
+        self.publish_message(
+            f"{entry['entries']} entries in {len(entry['clusters']) - 1} clusters, "
+            f"{law.util.human_bytes(sum(entry['compressed_bytes'].values()), fmt=True)} compressed",
+        )
+
+        self.output().dump(entry, formatter="json", indent=None)
+
+
+class PlanWorkUnits(
+    AGCTask,
+    SelectorMixin,
+    CalibratorsMixin,
+    DatasetTask,
+):
+    """
+    Combines the file catalog of a dataset and plans work units of approximately
+    ``--target-events`` events each, aligned to cluster boundaries. The units define the branches of
+    :py:class:`agc.tasks.express.ExpressHistograms` when run with the same ``--target-events``.
+    """
+
+    target_events = luigi.IntParameter(
+        default=500000,
+        description="targeted number of events per work unit; default: 500000",
+    )
+
+    # upstream requirements
+    reqs = Requirements(
+        FileCatalog=FileCatalog,
+    )
+
+    def requires(self):
+        return self.reqs.FileCatalog.req(self)
+
+    def output(self):
+        return self.target(f"plan_{self.target_events}.json")
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        from agc.catalog import plan_work_units, summarize_work_units
+
+        # load the catalog, ordered by file index
+        collection = self.input()["collection"]
+        catalog = [collection[b].load(formatter="json") for b in sorted(collection.keys())]
+
+        units = plan_work_units(catalog, self.target_events)
+        summary = summarize_work_units(units)
+
+        # compare to the default splitting of one file per branch
+        file_summary = summarize_work_units([[(i, 0, entry["entries"])] for i, entry in enumerate(catalog)])
+        self.publish_message(
+            f"planned {summary['n_units']} units with imbalance {summary['imbalance']:.2f} "
+            f"(one file per branch: {file_summary['n_units']} units, imbalance "
+            f"{file_summary['imbalance']:.2f})",
+        )
+
+        self.output().dump({
+            "catalog": catalog,
+            "units": units,
+            "summary": summary,
+        }, formatter="json", indent=None)
@@ -0,0 +1,104 @@
+# coding: utf-8
+
+"""
+Tasks for inspecting the columns kept after certain steps.
+"""
+
+from __future__ import annotations
+
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.util import dev_sandbox
+
+from agc.tasks.base import AGCTask
+
+
+class KeepColumnsReport(
+    AGCTask,
+    DatasetTask,
+):
+    """
+    Compares the columns configured to be kept after the reduction with the minimal set derived
+    from their downstream usage, and estimates the number of bytes saved per dataset from the
+    compressed sizes of the corresponding branches in the first input file. Columns that are not
+    contained in input files, such as those produced during the selection, are not considered in the
+    estimate.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        GetDatasetLFNs=GetDatasetLFNs,
+    )
+
+    # the task whose keep_columns are inspected
+    keep_columns_task_family = "cf.ReduceEvents"
+
+    def requires(self):
+        return self.reqs.GetDatasetLFNs.req(self)
+
+    def output(self):
+        return self.target("keep_columns_report.json")
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        from agc.catalog import scan_file
+        from agc.keep_columns import get_downstream_columns
+
+        # read the header of the first file
+        lfn_task = self.requires()
+        [(_, input_file)] = lfn_task.iter_nano_files(self, lfn_indices=[0])
+        path = (
+            input_file.abspath
+            if isinstance(input_file, law.LocalFileTarget)
+            else law.util.make_list(input_file.uri())[0]
+        )
+        entry = scan_file(path)
+
+        # configured and derived columns
+        configured = set()
+        for c in self.config_inst.x.keep_columns.get(self.keep_columns_task_family, ["*"]):
+            configured |= {r for r in self._expand_keep_column(c) if not r.has_tag("skip")}
+        derived = get_downstream_columns(self)
+
+        # compressed bytes of branches matching columns
+        def get_bytes(routes):
+            patterns = {r.nano_column for r in routes}
+            patterns |= {f"n{r.fields[0]}" for r in routes if len(r.fields) > 1}
+            return sum(
+                n for branch, n in entry["compressed_bytes"].items()
+                if law.util.multi_match(branch, patterns, mode=any)
+            )
+
+        n_bytes = {
+            "all": sum(entry["compressed_bytes"].values()),
+            "configured": get_bytes(configured),
+            "derived": get_bytes(derived),
+        }
+        n_bytes["saved"] = n_bytes["configured"] - n_bytes["derived"]
+
+        # extrapolate to the full dataset
+        scale = self.dataset_info_inst.n_events / max(entry["entries"], 1)
+        dataset_bytes = {key: int(n * scale) for key, n in n_bytes.items()}
+
+        self.publish_message(
+            f"derived {len(derived)} instead of {len(configured)} columns, saving "
+            f"{law.util.human_bytes(dataset_bytes['saved'], fmt=True)} of "
+            f"{law.util.human_bytes(dataset_bytes['configured'], fmt=True)} compressed input data "
+            f"for dataset {self.dataset_inst.name}",
+        )
+
+        self.output().dump({
+            "columns": {
+                "configured": sorted(r.column for r in configured),
+                "derived": sorted(r.column for r in derived),
+                "dropped": sorted({r.column for r in configured} - {r.column for r in derived}),
+                "added": sorted({r.column for r in derived} - {r.column for r in configured}),
+            },
+            "file_bytes": n_bytes,
+            "dataset_bytes": dataset_bytes,
+        }, formatter="json", indent=4)
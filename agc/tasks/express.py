@@ -0,0 +1,742 @@
+# coding: utf-8
+
+"""
+Express tasks that process nano files to histograms in a single pass, without writing and reading
+intermediate columns between calibration, selection, reduction, production and histogramming.
+"""
+
+from __future__ import annotations
+
+import time
+import json
+from collections import defaultdict
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements, DatasetTask
+from columnflow.tasks.framework.mixins import (
+    CalibratorsMixin, SelectorMixin, ProducersMixin, WeightProducerMixin, VariablesMixin, ChunkedIOMixin,
+)
+from columnflow.tasks.framework.remote import RemoteWorkflow
+from columnflow.tasks.framework.parameters import last_edge_inclusive_inst
+from columnflow.tasks.external import GetDatasetLFNs
+from columnflow.columnar_util import TaskArrayFunction
+from columnflow.util import dev_sandbox, DotDict
+
+from agc.tasks.base import AGCTask
+from agc.tasks.catalog import PlanWorkUnits
+
+
+class ExpressMixin(
+    AGCTask,
+    VariablesMixin,
+    WeightProducerMixin,
+    ProducersMixin,
+    SelectorMixin,
+    CalibratorsMixin,
+    DatasetTask,
+):
+    """
+    Mixin for express tasks that evaluate calibrators, the selector, producers and the weight
+    producer in memory. Shifts registered by these array functions that are not disjoint from
+    nominal, such as jet energy shifts, are evaluated as part of the nominal processing, so that
+    only dataset variations remain as shifts of these tasks.
+
+    As the normalization weights depend on the sum of mc weights of the full dataset, which is only
+    known after processing all files, they are computed without the per-process factor and
+    histograms are scaled accordingly when merged.
+    """
+
+    target_events = luigi.IntParameter(
+        default=0,
+        description="when positive, process work units of approximately this number of events per "
+        "branch as planned by agc.PlanWorkUnits, rather than one file per branch; default: 0",
+    )
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    def store_parts(self):
+        parts = super().store_parts()
+        if self.target_events > 0:
+            parts.insert_before("version", "units", f"units_{self.target_events}")
+        return parts
+
+    @classmethod
+    def get_known_shifts(cls, config_inst, params):
+        shifts, upstream_shifts = super().get_known_shifts(config_inst, params)
+
+        # only keep dataset variations
+        dataset_inst = params.get("dataset_inst")
+        dataset_shifts = set(dataset_inst.info.keys()) if dataset_inst and dataset_inst.is_mc else set()
+
+        return set(), upstream_shifts & dataset_shifts
+
+    @property
+    def array_function_insts(self) -> list[TaskArrayFunction]:
+        """
+        Calibrator, selector, producer and weight producer instances, followed by all their
+        dependencies.
+        """
+        insts = [*self.calibrator_insts, self.selector_inst, *self.producer_insts, self.weight_producer_inst]
+        return law.util.make_unique(
+            dep
+            for inst in insts
+            for dep in inst.walk_deps(include_self=True)
+            if isinstance(dep, TaskArrayFunction)
+        )
+
+    @property
+    def normalization_insts(self) -> list[TaskArrayFunction]:
+        """
+        Instances of normalization weight producers whose process weights are deferred.
+        """
+        from columnflow.production.normalization import normalization_weights
+
+        return [inst for inst in self.array_function_insts if isinstance(inst, normalization_weights)]
+
+    @property
+    def express_shift_insts(self) -> list:
+        """
+        Shifts that are evaluated in memory, starting with the global shift.
+        """
+        shift_insts = [self.global_shift_inst]
+        if self.dataset_inst.is_mc and self.global_shift_inst.name == "nominal":
+            shift_names = set.union(*(inst.all_shifts for inst in self.array_function_insts))
+            shift_insts.extend(sorted(
+                (
+                    self.config_inst.get_shift(shift_name)
+                    for shift_name in shift_names
+                    if shift_name != "nominal" and self.config_inst.has_shift(shift_name)
+                ),
+                key=lambda shift_inst: shift_inst.id,
+            ))
+        return [
+            shift_inst for shift_inst in shift_insts
+            if shift_inst == self.global_shift_inst or not shift_inst.has_tag("disjoint_from_nominal")
+        ]
+
+    def run_array_function_requires(self) -> DotDict:
+        """
+        Runs the requires functions of all array functions, except for those of normalization weight
+        producers which would require selection stats of the staged processing.
+        """
+        reqs = DotDict()
+        normalization_insts = self.normalization_insts
+        for inst in self.array_function_insts:
+            if callable(inst.requires_func) and inst not in normalization_insts:
+                if inst.cls_name not in reqs:
+                    reqs[inst.cls_name] = DotDict()
+                inst.requires_func(reqs[inst.cls_name])
+        return reqs
+
+    def run_array_function_setup(self, reqs: dict, inputs: dict) -> DotDict:
+        """
+        Runs the setup functions of all array functions given their *reqs* and *inputs*, and sets
+        up normalization weight producers to only apply mc weights. As in their own setup, they only
+        accept processes with a cross section at the center-of-mass energy of the campaign. Returns
+        the reader targets.
+        """
+        import numpy as np
+        import scipy.sparse
+
+        reader_targets = DotDict()
+        normalization_insts = self.normalization_insts
+        ecm = self.config_inst.campaign.ecm
+        for inst in self.array_function_insts:
+            if inst in normalization_insts:
+                if inst.allow_stitching:
+                    raise Exception(f"{self.task_family} does not support stitched normalization weights")
+                process_ids = [
+                    process_inst.id
+                    for process_inst, _, _ in self.dataset_inst.walk_processes(include_self=False)
+                    if process_inst.is_mc and ecm in process_inst.xsecs
+                ]
+                weight_table = scipy.sparse.lil_matrix((1, max(process_ids, default=0) + 1), dtype=np.float32)
+                for process_id in process_ids:
+                    weight_table[0, process_id] = 1.0
+                inst.process_weight_table = weight_table
+                inst.xs_process_ids = set(process_ids)
+            elif callable(inst.setup_func):
+                for d in [reqs, inputs]:
+                    if inst.cls_name not in d:
+                        d[inst.cls_name] = DotDict()
+                inst.setup_func(reqs[inst.cls_name], inputs[inst.cls_name], reader_targets)
+        return reader_targets
+
+    def get_process_weights(self, stats: dict) -> dict[int, float]:
+        """
+        Returns the deferred normalization factors per process id, defined as the product of the
+        luminosity and the cross section, divided by the sum of mc weights in *stats*. An empty
+        dictionary is returned when no normalization weights enter the event weight. An exception is
+        raised when no events were processed at all, e.g. when none were sampled, or when events of a
+        process without a cross section at the center-of-mass energy of the campaign were processed.
+        """
+        from columnflow.columnar_util import Route
+
+        used_columns = self.weight_producer_inst.used_columns
+        if self.dataset_inst.is_data or not any(
+            Route(inst.weight_name) in used_columns
+            for inst in self.normalization_insts
+        ):
+            return {}
+
+        if not stats.get("sum_mc_weight"):
+            fraction = self.config_inst.x("sample_fraction", None)
+            raise Exception(
+                f"sum of mc weights of dataset {self.dataset_inst.name} is zero after processing "
+                f"{int(stats.get('num_events', 0))} events" +
+                (f" with a sample fraction of {fraction}" if fraction is not None else "") +
+                ", cannot compute normalization weights",
+            )
+
+        lumi = self.config_inst.x.luminosity.nominal
+        ecm = self.config_inst.campaign.ecm
+        sum_weights = stats.get("sum_mc_weight_per_process", {})
+        process_insts = [
+            process_inst
+            for process_inst, _, _ in self.dataset_inst.walk_processes(include_self=False)
+            if process_inst.is_mc and sum_weights.get(str(process_inst.id))
+        ]
+
+        # all processes found in the stats must have a cross section
+        invalid_ids = {process_inst.id for process_inst in process_insts if ecm not in process_inst.xsecs}
+        if invalid_ids:
+            raise Exception(
+                f"stats of dataset {self.dataset_inst.name} contain process id(s) {invalid_ids} for "
+                f"which no cross sections at {ecm} TeV were found",
+            )
+
+        return {
+            process_inst.id: lumi * process_inst.get_xsec(ecm).nominal / sum_weights[str(process_inst.id)]
+            for process_inst in process_insts
+        }
+
+
+class ExpressHistograms(
+    ExpressMixin,
+    ChunkedIOMixin,
+    law.LocalWorkflow,
+    RemoteWorkflow,
+):
+    """
+    Reads the nano file of each branch once and, per chunk, runs the calibrators, the selector, the
+    event and object reduction, the producers and the weight producer in memory, and fills
+    histograms of all variables. Histograms of all in-memory shifts (see :py:class:`ExpressMixin`)
+    are filled in the same pass, re-running the selection and production with the shift's column
+    aliases on the calibrated events. Selection results of shifts that a multi-shift selector, such
+    as ``default_multi_shift``, evaluated along with the global shift are reused instead of running
+    the selector again. Only histograms and selection stats are written.
+
+    With ``--target-events``, branches process the work units planned by
+    :py:class:`agc.tasks.catalog.PlanWorkUnits`, i.e., entry ranges of one or more files that are
+    aligned to cluster boundaries, instead of one file per branch.
+
+    With a single process, chunks are read in a thread pool of the task process while the previous
+    chunk is processed. With multiple processes configured via ``chunked_io_processes`` (see
+    :py:func:`agc.parallel.get_chunked_io_processes`), the task process only determines the entry
+    ranges of chunks, and forked worker processes read and process them, so that neither reading
+    nor the transfer of events is serialized in the task process. Adaptive chunk sizes are only
+    applied with a single process. Results are merged in the order of chunks.
+    """
+
+    last_edge_inclusive = last_edge_inclusive_inst
+
+    # upstream requirements
+    reqs = Requirements(
+        RemoteWorkflow.reqs,
+        GetDatasetLFNs=GetDatasetLFNs,
+        PlanWorkUnits=PlanWorkUnits,
+    )
+
+    # strategy for handling missing source columns when adding aliases on event chunks
+    missing_column_alias_strategy = "original"
+
+    # histogrammer, created on demand
+    _histogrammer = None
+
+    # source and opened chunked io handler for reading chunks in worker processes
+    _chunk_source = None
+
+    @law.dynamic_workflow_condition
+    def workflow_condition(self):
+        # with work units, the workflow shape can be constructed as soon as they are planned
+        return self.target_events <= 0 or self.reqs.PlanWorkUnits.req(self).complete()
+
+    @workflow_condition.create_branch_map
+    def create_branch_map(self):
+        if self.target_events <= 0:
+            return super().create_branch_map()
+
+        # map branches to segments (lfn_index, entry_start, entry_stop) of planned work units
+        plan = self.reqs.PlanWorkUnits.req(self).output().load(formatter="json")
+        return {
+            branch: [
+                (plan["catalog"][file_index]["lfn_index"], entry_start, entry_stop)
+                for file_index, entry_start, entry_stop in unit
+            ]
+            for branch, unit in enumerate(plan["units"])
+        }
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+
+        reqs["lfns"] = self.reqs.GetDatasetLFNs.req(self)
+        if self.target_events > 0:
+            reqs["units"] = self.reqs.PlanWorkUnits.req(self)
+        reqs["array_functions"] = law.util.make_unique(law.util.flatten(self.run_array_function_requires()))
+
+        return reqs
+
+    def requires(self):
+        return {
+            "lfns": self.reqs.GetDatasetLFNs.req(self),
+            "array_functions": self.run_array_function_requires(),
+        }
+
+    @workflow_condition.output
+    def output(self):
+        return {
+            "hists": self.target(f"histograms__vars_{self.variables_repr}__{self.branch}.pickle"),
+            "stats": self.target(f"stats_{self.branch}.json"),
+        }
+
+    def get_read_columns(self) -> set:
+        """
+        Returns the columns to read from nano files, consisting of all columns used by array
+        functions and variables, as well as sources of column aliases of all in-memory shifts.
+        Columns that are only produced on the fly are not contained in nano files and are skipped
+        when reading.
+        """
+        from columnflow.columnar_util import Route, mandatory_coffea_columns
+
+        read_columns = set(map(Route, mandatory_coffea_columns))
+        for inst in [*self.calibrator_insts, self.selector_inst, *self.producer_insts, self.weight_producer_inst]:
+            read_columns |= inst.used_columns
+        for shift_inst in self.express_shift_insts:
+            read_columns |= set(map(Route, shift_inst.x("column_aliases", {}).values()))
+        for variable_inst in self.get_variable_insts():
+            expr = variable_inst.expression
+            read_columns |= set(map(Route, [expr] if isinstance(expr, str) else variable_inst.x("inputs", [])))
+
+        return read_columns
+
+    def get_variable_insts(self) -> list:
+        return [
+            self.config_inst.get_variable(var_name)
+            for var_name in law.util.make_unique(law.util.flatten(self.variable_tuples.values()))
+        ]
+
+    @property
+    def histogrammer(self):
+        """
+        Histogrammer filling all variables and shifts of a chunk in a single sweep.
+        """
+        from agc.histogramming.batched import BatchedHistogrammer
+
+        if self._histogrammer is None:
+            self._histogrammer = BatchedHistogrammer(
+                {
+                    var_key: [self.config_inst.get_variable(var_name) for var_name in var_names]
+                    for var_key, var_names in self.variable_tuples.items()
+                },
+                last_edge_inclusive=self.last_edge_inclusive,
+            )
+        return self._histogrammer
+
+    def get_shift_results(self, results, shift_name: str):
+        """
+        Returns the selection results of a shift named *shift_name* that were evaluated along with
+        the global shift by a multi-shift selector and stored as the additional field
+        ``shift_<shift_name>`` of its *results*, or *None* when not present. Objects not selected
+        per shift are taken from the global shift, per source and destination collection.
+        """
+        import awkward as ak
+
+        field = f"shift_{shift_name}"
+        if field not in results.fields:
+            return None
+
+        shift_results = results[field]
+        fields = {"event": shift_results.event}
+        if "steps" in shift_results.fields:
+            fields["steps"] = shift_results.steps
+        if "objects" in results.fields:
+            objects = defaultdict(dict)
+            for _results in [results, shift_results]:
+                if "objects" not in _results.fields:
+                    continue
+                for src_name in _results.objects.fields:
+                    for dst_name in _results.objects[src_name].fields:
+                        objects[src_name][dst_name] = _results.objects[src_name][dst_name]
+            fields["objects"] = ak.zip(
+                {src_name: ak.zip(dst_objects, depth_limit=1) for src_name, dst_objects in objects.items()},
+                depth_limit=1,
+            )
+
+        return ak.zip(fields, depth_limit=1)
+
+    def process_shift(
+        self,
+        events,
+        shift_inst,
+        stats: defaultdict,
+        hists: DotDict,
+        selection: tuple | None = None,
+    ) -> tuple:
+        """
+        Selects, reduces and produces columns of calibrated *events* for a certain *shift_inst*.
+        Selection *stats* and *hists* are updated by the selector. When a *selection* is given,
+        consisting of events with the columns produced by the selector and selection results, it is
+        used instead of running the selector. Returns the selected events, their event weights and
+        the selection.
+        """
+        import numpy as np
+        import awkward as ak
+        from columnflow.columnar_util import add_ak_aliases
+        from columnflow.selection.util import create_collections_from_masks
+
+        # add aliases, keeping source columns that might be used by multi-shift array functions
+        aliases = shift_inst.x("column_aliases", {})
+        events = add_ak_aliases(
+            selection[0] if selection else events,
+            aliases,
+            remove_src=False,
+            missing_strategy=self.missing_column_alias_strategy,
+        )
+
+        # selection
+        if selection:
+            results = selection[1]
+        else:
+            events, results = self.selector_inst(events, stats, hists=hists)
+            if results.event is None:
+                raise Exception(
+                    f"selector {self.selector_inst.cls_name} returned {results!r} object that does not "
+                    "contain 'event' mask",
+                )
+            results = results.to_ak()
+        selection = (events, results)
+
+        # reduction of events and objects
+        event_mask = results.event
+        events = events[event_mask]
+        if "objects" in results.fields:
+            events = create_collections_from_masks(events, results.objects[event_mask])
+
+        # production
+        for producer_inst in self.producer_insts:
+            if not (callable(producer_inst.skip_func) and producer_inst.skip_func()):
+                events = producer_inst(events)
+
+        # add aliases again for columns that only exist after production
+        events = add_ak_aliases(
+            events,
+            aliases,
+            remove_src=True,
+            missing_strategy=self.missing_column_alias_strategy,
+        )
+
+        # event weight
+        if not self.weight_producer_inst.skip_func():
+            events, weight = self.weight_producer_inst(events)
+        else:
+            weight = ak.Array(np.ones(len(events), dtype=np.float32))
+
+        return events, weight, selection
+
+    def process_chunk(self, index: int, events) -> tuple[int, dict, dict, dict]:
+        """
+        Calibrates *events* of the chunk with *index* and processes them for all in-memory shifts.
+        Returns the index, the histograms, the selection stats of the global shift and the number of
+        selected events per shift, all of which can be pickled to be sent between processes.
+        """
+        from agc.read_stats import get_read_stats_keys
+
+        # calibration
+        for calibrator_inst in self.calibrator_insts:
+            if not (callable(calibrator_inst.skip_func) and calibrator_inst.skip_func()):
+                events = calibrator_inst(events)
+
+        # selection, reduction and production per shift, only recording stats of the global shift and
+        # reusing selection results of shifts that were evaluated along with it
+        stats = defaultdict(float)
+        n_selected = {}
+        global_selection = None
+        for shift_inst in self.express_shift_insts:
+            shift_results = global_selection and self.get_shift_results(global_selection[1], shift_inst.name)
+            shift_stats = stats if shift_inst == self.global_shift_inst else defaultdict(float)
+            shift_events, weight, selection = self.process_shift(
+                events,
+                shift_inst,
+                shift_stats,
+                DotDict(),
+                selection=None if shift_results is None else (global_selection[0], shift_results),
+            )
+            if shift_inst == self.global_shift_inst:
+                global_selection = selection
+            else:
+                # bytes read and wall time are recorded by any selector call
+                for key in get_read_stats_keys(prefix="selection_"):
+                    if key in shift_stats:
+                        stats[key] += shift_stats[key]
+            n_selected[shift_inst.name] = len(shift_events)
+            self.histogrammer.add(shift_events, weight, shift_inst.id)
+
+        # fill histograms of all shifts at once
+        histograms = self.histogrammer.fill()
+
+        # convert nested stats to plain dictionaries
+        stats = json.loads(json.dumps(stats))
+
+        return index, histograms, stats, n_selected
+
+    def get_chunk_positions(self, source: dict, chunk_size: int | None = None) -> list:
+        """
+        Opens a *source*, given by the arguments of a chunked io handler, and returns the positions
+        of its chunks with a certain *chunk_size*, defaulting to the configured one.
+        """
+        from columnflow.columnar_util import ChunkedIOHandler
+
+        if chunk_size is None:
+            chunk_size = law.config.get_expanded_int(
+                "analysis",
+                f"{self.task_family}__chunked_io_chunk_size",
+                self.default_chunk_size,
+            )
+
+        handler = ChunkedIOHandler(**source, **({"chunk_size": chunk_size} if chunk_size else {}))
+        with handler:
+            return [
+                handler.create_chunk_position(handler.n_entries, handler.chunk_size, chunk_index)
+                for chunk_index in range(max(handler.n_chunks, 1))
+            ]
+
+    def read_and_process_chunk(self, index: int, source: dict, chunk_pos: tuple) -> tuple[int, dict, dict, dict]:
+        """
+        Reads the entries of the chunk with *index* at *chunk_pos*, given as a plain tuple of the
+        fields of a chunk position, from a *source*, given by the arguments of a chunked io handler,
+        and processes them with :py:meth:`process_chunk`. The source is opened once per process and
+        kept open for subsequent chunks of the same source.
+        """
+        from columnflow.columnar_util import ChunkedIOHandler, update_ak_array
+
+        if self._chunk_source is None or self._chunk_source[0] != source:
+            if self._chunk_source is not None:
+                self._chunk_source[1].close()
+            handler = ChunkedIOHandler(**source)
+            handler.open()
+            self._chunk_source = (source, handler)
+        handler = self._chunk_source[1]
+
+        chunk_pos = handler.ChunkPosition(*chunk_pos)
+        events, *cols = [
+            source_handler.read(obj, chunk_pos, read_options=read_options, read_columns=read_columns)
+            for obj, source_handler, read_options, read_columns in zip(
+                handler.source_objects,
+                handler.source_handlers,
+                handler.read_options_list,
+                handler.read_columns_list,
+            )
+        ]
+
+        return self.process_chunk(index, update_ak_array(events, *cols))
+
+    @law.decorator.log
+    @law.decorator.localize(input=False)
+    @law.decorator.safe_output
+    def run(self):
+        from columnflow.columnar_util import update_ak_array
+        from columnflow.tasks.selection import MergeSelectionStats
+        from agc.parallel import ForkedChunkPool, get_chunked_io_processes
+        from agc.sampling import get_sampling_open_options
+
+        # prepare inputs and outputs
+        reqs = self.requires()
+        lfn_task = reqs["lfns"]
+        inputs = self.input()
+        outputs = self.output()
+        histograms = {}
+        stats = defaultdict(float)
+        n_selected = defaultdict(int)
+
+        # run the setup of all array functions
+        reader_targets = self.run_array_function_setup(reqs["array_functions"], inputs["array_functions"])
+        n_ext = len(reader_targets)
+
+        read_columns = self.get_read_columns()
+        shift_insts = self.express_shift_insts
+        chunk_size = min(
+            (inst.get_min_chunk_size() for inst in self.array_function_insts if inst.get_min_chunk_size()),
+            default=None,
+        )
+
+        # merge results of chunks per segment in the order of their indices, independent of the
+        # order in which they are read and processed
+        pending = {}
+        next_index = 0
+
+        def merge(index):
+            _, chunk_histograms, chunk_stats, chunk_n_selected = pending.pop(index)
+            for var_key, h in chunk_histograms.items():
+                histograms[var_key] = histograms[var_key] + h if var_key in histograms else h
+            MergeSelectionStats.merge_counts(stats, chunk_stats)
+            for shift_name, n in chunk_n_selected.items():
+                n_selected[shift_name] += n
+
+        # segments of files to process, either entry ranges of work units or entire files
+        if self.target_events > 0:
+            if n_ext:
+                raise Exception(f"{self.task_family} does not support reader targets with --target-events")
+            segments = [tuple(segment) for segment in self.branch_data]
+        else:
+            segments = [(lfn_index, None, None) for lfn_index in self.branch_data]
+
+        t_start = time.perf_counter()
+        processes = get_chunked_io_processes(self)
+
+        # fork workers before reading starts, with more than one process, workers read the entry
+        # ranges of chunks themselves, otherwise chunks are read in the thread pool of the chunked
+        # io handler while the previous chunk is processed
+        read_in_workers = processes > 1
+        func = self.read_and_process_chunk if read_in_workers else self.process_chunk
+        with ForkedChunkPool(func, processes=processes) as pool:
+            for lfn_index, entry_start, entry_stop in segments:
+                # let the lfn_task prepare the nano file
+                [(_, input_file)] = lfn_task.iter_nano_files(self, lfn_indices=[lfn_index])
+                open_options = get_sampling_open_options(self.config_inst)
+                if entry_start is not None:
+                    open_options["agc_entry_ranges"] = [(entry_start, entry_stop)]
+
+                with law.localize_file_targets([input_file, *reader_targets.values()], mode="r") as inps:
+                    source = {
+                        "source": [inp.abspath for inp in inps],
+                        "source_type": ["coffea_root"] + n_ext * [None],
+                        "open_options": [open_options] + n_ext * [None],
+                        "read_columns": (1 + n_ext) * [read_columns],
+                    }
+                    if read_in_workers:
+                        chunks = (
+                            (pos.index, source, tuple(pos))
+                            for pos in self.get_chunk_positions(source, chunk_size=chunk_size)
+                        )
+                    else:
+                        chunks = (
+                            (pos.index, update_ak_array(events, *cols))
+                            for (events, *cols), pos in self.iter_chunked_io(**source, chunk_size=chunk_size)
+                        )
+                    for result in pool.imap(chunks):
+                        pending[result[0]] = result
+                        while next_index in pending:
+                            merge(next_index)
+                            next_index += 1
+
+                # merge remaining results in case of gaps between chunk indices
+                for index in sorted(pending):
+                    merge(index)
+                next_index = 0
+
+        # some logs
+        duration = time.perf_counter() - t_start
+        n_events = int(stats["num_events"])
+        stats["express_wall_time"] = duration
+        self.publish_message(
+            f"processed {n_events} events with {len(shift_insts)} shift(s) in {duration:.2f}s "
+            f"({n_events / max(duration, 1e-9):.1f} events/s) using {processes} process(es)",
+        )
+        for shift_name, n in n_selected.items():
+            self.publish_message(f"selected {n} events for shift {shift_name}")
+
+        # save outputs
+        outputs["hists"].dump(histograms, formatter="pickle")
+        outputs["stats"].dump(stats, indent=4, formatter="json")
+
+
+class MergeExpressHistograms(
+    ExpressMixin,
+    law.LocalWorkflow,
+    RemoteWorkflow,
+):
+    """
+    Merges the histograms and selection stats of all branches of :py:class:`ExpressHistograms`,
+    applies the deferred normalization per process and stores one histogram per variable, with the
+    same structure as those of ``cf.MergeHistograms``.
+    """
+
+    remove_previous = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="when True, remove particlar input histograms after merging; default: False",
+    )
+
+    # upstream requirements
+    reqs = Requirements(
+        RemoteWorkflow.reqs,
+        ExpressHistograms=ExpressHistograms,
+    )
+
+    def create_branch_map(self):
+        # create a dummy branch map so that this task could be submitted as a job
+        return {0: None}
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        reqs["hists"] = self.as_branch().requires()
+        return reqs
+
+    def requires(self):
+        return self.reqs.ExpressHistograms.req(self, branch=-1, _exclude={"branches"})
+
+    def output(self):
+        return {
+            "hists": law.SiblingFileCollection({
+                variable_name: self.target(f"hist__{variable_name}.pickle")
+                for variable_name in self.variables
+            }),
+            "stats": self.target("stats.json"),
+        }
+
+    @law.decorator.log
+    def run(self):
+        from columnflow.tasks.selection import MergeSelectionStats
+
+        # prepare inputs and outputs
+        inputs = self.input()["collection"]
+        outputs = self.output()
+
+        # merge stats and histograms
+        stats = defaultdict(float)
+        merged = {}
+        for inp in self.iter_progress(inputs.targets.values(), len(inputs), reach=(0, 80)):
+            MergeSelectionStats.merge_counts(stats, inp["stats"].load(formatter="json"))
+            for variable_name, h in inp["hists"].load(formatter="pickle").items():
+                merged[variable_name] = merged[variable_name] + h if variable_name in merged else h
+
+        # apply the deferred normalization by scaling process bins
+        process_weights = self.get_process_weights(stats)
+        for variable_name, h in merged.items():
+            process_axis = h.axes["process"]
+            view = h.view(flow=True)
+            for process_id, process_weight in process_weights.items():
+                if process_id not in list(process_axis):
+                    continue
+                index = (slice(None), process_axis.index(process_id))
+                view.value[index] *= process_weight
+                view.variance[index] *= process_weight**2
+
+        # create a separate file per output variable
+        for variable_name, h in merged.items():
+            self.publish_message(f"merged histograms for '{variable_name}'")
+            outputs["hists"][variable_name].dump(h, formatter="pickle")
+        outputs["stats"].dump(stats, indent=4, formatter="json")
+
+        # throughput of the express processing
+        if stats["express_wall_time"]:
+            self.publish_message(
+                f"processed {int(stats['num_events'])} events at "
+                f"{stats['num_events'] / stats['express_wall_time']:.1f} events/s per branch",
+            )
+
+        # optionally remove inputs
+        if self.remove_previous:
+            inputs.remove()
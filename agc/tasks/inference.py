@@ -0,0 +1,229 @@
+# coding: utf-8
+
+"""
+Tasks performing statistical inference in-process, without datacards and an external combine run.
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+
+import luigi
+import law
+
+from columnflow.tasks.framework.base import Requirements
+from columnflow.tasks.framework.mixins import (
+    CalibratorsMixin, SelectorMixin, ProducersMixin, WeightProducerMixin, InferenceModelMixin,
+)
+from columnflow.tasks.framework.remote import RemoteWorkflow
+from columnflow.config_util import get_datasets_from_process
+from columnflow.util import dev_sandbox
+
+from agc.tasks.base import AGCTask
+from agc.tasks.express import MergeExpressHistograms
+
+
+class TemplateFitBase(
+    AGCTask,
+    InferenceModelMixin,
+    WeightProducerMixin,
+    ProducersMixin,
+    SelectorMixin,
+    CalibratorsMixin,
+    law.LocalWorkflow,
+    RemoteWorkflow,
+):
+    """
+    Base task for binned likelihood fits of the inference model with templates built directly from
+    the histograms of :py:class:`~agc.tasks.express.MergeExpressHistograms`, using
+    :py:class:`agc.inference.fit.TemplateModel`. Histograms of shifts that are dataset variations
+    are required from the express tasks of these shifts.
+    """
+
+    sandbox = dev_sandbox(law.config.get("analysis", "default_columnar_sandbox"))
+
+    # upstream requirements
+    reqs = Requirements(
+        RemoteWorkflow.reqs,
+        MergeExpressHistograms=MergeExpressHistograms,
+    )
+
+    def create_branch_map(self):
+        # create a dummy branch map so that this task could be submitted as a job
+        return {0: None}
+
+    def get_dataset_params(self) -> dict[str, dict[str, set]]:
+        """
+        Returns a mapping of dataset names to the variables and shifts whose histograms are required
+        from them.
+        """
+        dataset_params = defaultdict(lambda: {"variables": set(), "shifts": {"nominal"}})
+        for cat_obj in self.inference_model_inst.categories:
+            for proc_obj in cat_obj.processes:
+                dataset_names = proc_obj.config_mc_datasets or [
+                    dataset_inst.name
+                    for dataset_inst in get_datasets_from_process(self.config_inst, proc_obj.config_process)
+                ]
+                for dataset_name in dataset_names:
+                    dataset_inst = self.config_inst.get_dataset(dataset_name)
+                    params = dataset_params[dataset_name]
+                    params["variables"].add(cat_obj.config_variable)
+                    # shifts that are not dataset variations are produced by the nominal express task
+                    params["shifts"].update(
+                        shift_name
+                        for param_obj in proc_obj.parameters
+                        if self.inference_model_inst.require_shapes_for_parameter(param_obj)
+                        for shift_name in [f"{param_obj.config_shift_source}_{d}" for d in ["up", "down"]]
+                        if shift_name in dataset_inst.info
+                    )
+            for dataset_name in cat_obj.config_data_datasets:
+                dataset_params[dataset_name]["variables"].add(cat_obj.config_variable)
+
+        return dataset_params
+
+    def workflow_requires(self):
+        reqs = super().workflow_requires()
+        reqs["hists"] = self.as_branch().requires()
+        return reqs
+
+    def requires(self):
+        return {
+            dataset_name: {
+                shift_name: self.reqs.MergeExpressHistograms.req(
+                    self,
+                    dataset=dataset_name,
+                    shift=shift_name,
+                    variables=tuple(sorted(params["variables"])),
+                    branch=0,
+                )
+                for shift_name in sorted(params["shifts"])
+            }
+            for dataset_name, params in self.get_dataset_params().items()
+        }
+
+    def load_template_model(self):
+        """
+        Loads the histograms of all inputs, summed per variable over all datasets and shifts, and
+        returns the :py:class:`~agc.inference.fit.TemplateModel` of the inference model.
+        """
+        from agc.inference.fit import get_category_histograms, TemplateModel
+
+        histograms = {}
+        for dataset_inputs in self.input().values():
+            for inp in dataset_inputs.values():
+                for variable_name, target in inp["hists"].targets.items():
+                    h = target.load(formatter="pickle")
+                    histograms[variable_name] = histograms[variable_name] + h if variable_name in histograms else h
+
+        return TemplateModel(
+            self.inference_model_inst,
+            get_category_histograms(self.inference_model_inst, histograms, self.config_inst),
+        )
+
+
+class FitInferenceModel(TemplateFitBase):
+    """
+    Performs a binned maximum likelihood fit of the inference model to its (fake) data or, when
+    requested, to the expectation for a signal strength of 1.
+    """
+
+    asimov = luigi.BoolParameter(
+        default=False,
+        description="when True, fit the expectation for a signal strength of 1 instead of the (fake) "
+        "data of the inference model; default: False",
+    )
+
+    def output(self):
+        return self.target(f"fit{'__asimov' if self.asimov else ''}.json")
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        with self.publish_step(f"fitting inference model '{self.inference_model}' ..."):
+            model = self.load_template_model()
+            observed = model.expected(model.get_initial_parameters(1.0)) if self.asimov else None
+            result = model.fit(observed=observed)
+
+        for name in model.parameter_names:
+            flag = " (on bound)" if name in result.at_bounds else ""
+            self.publish_message(f"{name:>20}: {result.parameters[name]:8.4f} +- {result.errors[name]:.4f}{flag}")
+        if not result.success or not result.hessian_valid or result.at_bounds:
+            self.logger.warning(
+                f"fit status: minimization succeeded: {result.success}, hessian valid: {result.hessian_valid}, "
+                f"parameters on bounds: {', '.join(result.at_bounds) or 'none'}; uncertainties of parameters on "
+                "bounds are not meaningful",
+            )
+        self.publish_message(f"fit took {result.duration:.3f}s with {result.n_eval} evaluations")
+
+        self.output().dump(dict(result, parameter_names=model.parameter_names), indent=4, formatter="json")
+
+
+class ToysInferenceModel(TemplateFitBase):
+    """
+    Generates pseudo-experiments of the inference model for a signal strength of 1 and nominal
+    nuisances, fits them and performs profile likelihood scans of the signal strength, using
+    :py:class:`agc.inference.toys.ToyEngine`. Minimizations are distributed over the number of
+    processes configured for this task family via ``chunked_io_processes`` (see
+    :py:func:`agc.parallel.get_chunked_io_processes`). Pulls and expected uncertainties are
+    summarized in a json file, while results per toy are stored in a pickle file.
+    """
+
+    n_toys = luigi.IntParameter(
+        default=1000,
+        description="number of pseudo-experiments; default: 1000",
+    )
+    seed = luigi.IntParameter(
+        default=1,
+        description="seed of the random number generator for pseudo-experiments; default: 1",
+    )
+    scan_points = luigi.IntParameter(
+        default=21,
+        description="number of points of profile likelihood scans of the signal strength per toy, "
+        "covering three expected standard deviations around 1, with 0 disabling scans; default: 21",
+    )
+
+    def output(self):
+        basename = f"toys__n{self.n_toys}__seed{self.seed}__scan{self.scan_points}"
+        return {
+            "summary": self.target(f"{basename}.json"),
+            "toys": self.target(f"{basename}.pickle"),
+        }
+
+    @law.decorator.log
+    @law.decorator.safe_output
+    def run(self):
+        import numpy as np
+        from agc.inference.toys import ToyEngine
+        from agc.parallel import get_chunked_io_processes
+
+        model = self.load_template_model()
+        engine = ToyEngine(model, processes=get_chunked_io_processes(self))
+
+        # scan range from the expected uncertainty of the signal strength
+        scan_values = None
+        if self.scan_points > 0:
+            asimov = model.fit(observed=model.expected(model.get_initial_parameters(1.0)))
+            error = asimov.errors[model.poi]
+            scan_values = np.linspace(1.0 - 3 * error, 1.0 + 3 * error, self.scan_points)
+
+        with self.publish_step(f"fitting {self.n_toys} toys of inference model '{self.inference_model}' ..."):
+            toys = engine.generate(self.n_toys, seed=self.seed)
+            result = engine.fit_toys(toys, parameter=model.poi, scan_values=scan_values)
+
+        summary = result.summary
+        for name, stats in summary.parameters.items():
+            self.publish_message(
+                f"{name:>20}: pull {stats['pull_mean']:+.3f} +- {stats['pull_width']:.3f}, "
+                f"expected error {stats['expected_error']:.4f}" + (
+                    f" (scan: {stats['expected_error_scan']:.4f})" if "expected_error_scan" in stats else ""
+                ),
+            )
+        if summary.n_converged < summary.n_toys:
+            self.logger.warning(f"{summary.n_toys - summary.n_converged} of {summary.n_toys} fits did not converge")
+        self.publish_message(
+            f"processed {summary.n_toys} toys in {summary.duration:.2f}s ({summary.toys_per_second:.1f} toys/s)",
+        )
+
+        outputs = self.output()
+        outputs["summary"].dump(summary, indent=4, formatter="json")
+        outputs["toys"].dump(dict(result, toys=dict(toys)), formatter="pickle")
@@ -0,0 +1,55 @@
+# coding: utf-8
+
+"""
+Generic helpers.
+"""
+
+from __future__ import annotations
+
+from columnflow.util import maybe_import
+
+np = maybe_import("numpy")
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    """
+    Applies the splitmix64 finalizer to an array *x* of unsigned 64-bit integers and returns the
+    well-mixed result.
+    """
+    with np.errstate(over="ignore"):
+        z = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def counter_hash(*keys: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    Returns a 64-bit hash per element of the broadcasted integer arrays *keys*, mixed in order and
+    starting from a *seed*. The result only depends on the values of the keys, and not on their
+    position in the arrays, so that it is stable under any chunking of the keys.
+    """
+    h = splitmix64(np.uint64(seed))
+    for key in keys:
+        h = splitmix64(h ^ np.asarray(key).astype(np.uint64))
+    return h
+
+
+def counter_uniform(*keys: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    Returns uniformly distributed numbers in [0, 1) that are fully determined by the integer arrays
+    *keys* and the *seed*, see :py:func:`counter_hash`.
+    """
+    # use the upper 53 bits to fill the mantissa of a double
+    return (counter_hash(*keys, seed=seed) >> np.uint64(11)) * (1.0 / 2**53)
+
+
+def counter_normal(*keys: np.ndarray, seed: int = 0) -> np.ndarray:
+    """
+    Returns normally distributed numbers with zero mean and unit width that are fully determined by
+    the integer arrays *keys* and the *seed*, see :py:func:`counter_hash`.
+    """
+    # box-muller transform with two independent streams
+    u1 = 1.0 - counter_uniform(*keys, 0, seed=seed)
+    u2 = counter_uniform(*keys, 1, seed=seed)
+    return np.sqrt(-2.0 * np.log(u1)) * np.cos(2.0 * np.pi * u2)
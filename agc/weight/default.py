@@ -0,0 +1,36 @@
+# coding: utf-8
+
+"""
+Event weight producers.
+"""
+
+from columnflow.weight import WeightProducer, weight_producer
+from columnflow.weight.all_weights import all_weights
+from columnflow.util import maybe_import
+
+from agc.calibration.default import jec_shifts
+
+ak = maybe_import("awkward")
+
+
+@weight_producer(
+    uses={all_weights},
+    # only run on mc
+    mc_only=True,
+    # whether to declare the jet energy shifts, for which the features and categories of events are
+    # produced in a single pass by multi-shift producers, so that only histograms are created per shift
+    multi_shift=False,
+)
+def default(self: WeightProducer, events: ak.Array, **kwargs) -> tuple[ak.Array, ak.Array]:
+    # combine all event weights
+    return self[all_weights](events, **kwargs)
+
+
+@default.init
+def default_init(self: WeightProducer) -> None:
+    if self.multi_shift:
+        self.shifts |= {jec_shifts}
+
+
+# multi-shift version to be used with multi-shift producers (see agc.production.default)
+default_multi_shift = default.derive("default_multi_shift", cls_dict={"multi_shift": True})
@@ -14,3 +14,7 @@ import sys
 base = os.path.normpath(os.path.join(os.path.abspath(__file__), "../.."))
 sys.path.append(base)
 import agc  # noqa
+
+# import all tests
+from .test_util import *
+from .test_catalog import *
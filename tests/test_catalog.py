@@ -0,0 +1,141 @@
+# coding: utf-8
+
+__all__ = ["CatalogTest"]
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from columnflow.util import maybe_import
+
+from agc.catalog import scan_file, plan_work_units, summarize_work_units
+from agc.sampling import sampled_entry_ranges, map_entry_range, intersect_entry_ranges
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+uproot = maybe_import("uproot")
+
+
+class CatalogTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+
+        # files with different numbers of clusters and cluster sizes
+        cls.cluster_sizes = [
+            [1000, 1000, 1000, 1000, 500],
+            [300],
+            [200, 200],
+            [2500, 2500],
+        ]
+        cls.paths = [
+            cls.create_file(os.path.join(cls.tmp_dir, f"nano_{i}.root"), sizes, seed=i)
+            for i, sizes in enumerate(cls.cluster_sizes)
+        ]
+        cls.catalog = [scan_file(path) for path in cls.paths]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmp_dir)
+
+    @classmethod
+    def create_file(cls, path, cluster_sizes, seed=0):
+        # nano-like tree with one basket per branch and cluster, written by extending the tree
+        rng = np.random.default_rng(seed)
+        with uproot.recreate(path) as f:
+            tree = None
+            for i, n in enumerate(cluster_sizes):
+                n_jets = rng.poisson(4, n)
+                data = {
+                    "event": np.arange(n, dtype=np.uint64) + sum(cluster_sizes[:i]),
+                    "Jet": ak.zip({
+                        "pt": ak.unflatten(rng.exponential(30.0, n_jets.sum()).astype(np.float32), n_jets),
+                        "eta": ak.unflatten(rng.uniform(-3.0, 3.0, n_jets.sum()).astype(np.float32), n_jets),
+                    }),
+                }
+                if tree is None:
+                    tree = f.mktree("Events", {"event": np.uint64, "Jet": data["Jet"].type.content})
+                tree.extend(data)
+        return path
+
+    def test_scan_file(self):
+        for entry, sizes in zip(self.catalog, self.cluster_sizes):
+            self.assertEqual(entry["entries"], sum(sizes))
+            self.assertEqual(entry["clusters"], np.cumsum([0] + sizes).tolist())
+            self.assertEqual(set(entry["compressed_bytes"]), {"event", "nJet", "Jet_pt", "Jet_eta"})
+            self.assertTrue(all(n > 0 for n in entry["compressed_bytes"].values()))
+
+        # only matching branches
+        entry = scan_file(self.paths[0], branches=["nJet", "Jet_pt"])
+        self.assertEqual(set(entry["uncompressed_bytes"]), {"nJet", "Jet_pt"})
+
+    def test_plan_work_units(self):
+        units = plan_work_units(self.catalog, 1000)
+
+        # segments cover all entries exactly once, in order
+        segments = [segment for unit in units for segment in unit]
+        for file_index, entry in enumerate(self.catalog):
+            file_segments = [(start, stop) for i, start, stop in segments if i == file_index]
+            self.assertEqual(file_segments[0][0], 0)
+            self.assertEqual(file_segments[-1][1], entry["entries"])
+            for (_, stop), (start, _) in zip(file_segments[:-1], file_segments[1:]):
+                self.assertEqual(stop, start)
+
+        # segments start and end at cluster boundaries
+        for file_index, start, stop in segments:
+            self.assertIn(start, self.catalog[file_index]["clusters"])
+            self.assertIn(stop, self.catalog[file_index]["clusters"])
+
+        # small files and remainders are grouped, large clusters are not split
+        self.assertEqual(units, [
+            [(0, 0, 1000)],
+            [(0, 1000, 2000)],
+            [(0, 2000, 3000)],
+            [(0, 3000, 4000)],
+            [(0, 4000, 4500), (1, 0, 300), (2, 0, 200)],
+            [(2, 200, 400)],
+            [(3, 0, 2500)],
+            [(3, 2500, 5000)],
+        ])
+        self.assertEqual(summarize_work_units(units), {
+            "n_units": 8,
+            "min_events": 200,
+            "max_events": 2500,
+            "mean_events": 1275.0,
+            "imbalance": 2500 / 1275.0,
+        })
+
+        # a single unit with a large target
+        units = plan_work_units(self.catalog, 10**6)
+        self.assertEqual(units, [[(0, 0, 4500), (1, 0, 300), (2, 0, 400), (3, 0, 5000)]])
+
+        with self.assertRaises(ValueError):
+            plan_work_units(self.catalog, 0)
+
+    def test_sampled_entry_ranges(self):
+        for path, entry in zip(self.paths, self.catalog):
+            with uproot.open(path) as f:
+                tree = f["Events"]
+                ranges = sampled_entry_ranges(tree, 0.5, seed=1)
+                self.assertEqual(ranges, sampled_entry_ranges(tree, 0.5, seed=1))
+                self.assertEqual(sampled_entry_ranges(tree, 1.0), [(0, entry["entries"])])
+
+                # ranges consist of entire clusters
+                for start, stop in ranges:
+                    self.assertIn(start, entry["clusters"])
+                    self.assertIn(stop, entry["clusters"])
+
+                # at least one cluster per file
+                ranges = sampled_entry_ranges(tree, 1e-9)
+                self.assertEqual(len(ranges), 1)
+                self.assertEqual(entry["clusters"].index(ranges[0][1]), entry["clusters"].index(ranges[0][0]) + 1)
+
+    def test_entry_range_mapping(self):
+        ranges = [(0, 100), (300, 400)]
+        self.assertEqual(map_entry_range(ranges, 50, 150), [(50, 100), (300, 350)])
+        self.assertEqual(map_entry_range(ranges, 100, 200), [(300, 400)])
+        self.assertEqual(map_entry_range(ranges, 200, 300), [])
+        self.assertEqual(intersect_entry_ranges(ranges, [(50, 350)]), [(50, 100), (300, 350)])
+        self.assertEqual(intersect_entry_ranges(ranges, [(100, 300)]), [])
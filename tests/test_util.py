@@ -0,0 +1,90 @@
+# coding: utf-8
+
+__all__ = ["UtilTest"]
+
+import unittest
+import multiprocessing
+
+from columnflow.util import maybe_import
+
+from agc.util import counter_hash, counter_uniform, counter_normal
+from agc.calibration.default import jer_smearing
+
+np = maybe_import("numpy")
+ak = maybe_import("awkward")
+
+
+def create_events(n_events: int = 20000, seed: int = 0) -> ak.Array:
+    rng = np.random.default_rng(seed)
+    n_jets = rng.poisson(5, n_events)
+    return ak.Array({
+        "run": np.full(n_events, 1, dtype=np.uint32),
+        "luminosityBlock": (np.arange(n_events) // 500).astype(np.uint32),
+        "event": (np.arange(n_events) * 3 + 11).astype(np.uint64),
+        "Jet": ak.zip({
+            "pt": ak.unflatten(rng.exponential(30.0, n_jets.sum()).astype(np.float32), n_jets),
+        }),
+    })
+
+
+def smear_flat(events: ak.Array) -> np.ndarray:
+    return ak.to_numpy(ak.flatten(jer_smearing(events, seed=2015), axis=1))
+
+
+class UtilTest(unittest.TestCase):
+
+    def test_counter_hash(self):
+        keys = np.arange(1000, dtype=np.uint64)
+        h = counter_hash(keys, 7, seed=1)
+
+        # deterministic, position independent and sensitive to keys and seed
+        self.assertTrue(np.array_equal(h, counter_hash(keys, 7, seed=1)))
+        self.assertTrue(np.array_equal(h[::-1], counter_hash(keys[::-1], 7, seed=1)))
+        self.assertEqual(len(np.unique(h)), len(keys))
+        self.assertFalse(np.any(h == counter_hash(keys, 8, seed=1)))
+        self.assertFalse(np.any(h == counter_hash(keys, 7, seed=2)))
+
+    def test_counter_distributions(self):
+        keys = np.arange(200000, dtype=np.uint64)
+
+        u = counter_uniform(keys, seed=3)
+        self.assertTrue(np.all((u >= 0.0) & (u < 1.0)))
+        self.assertAlmostEqual(u.mean(), 0.5, delta=0.005)
+
+        g = counter_normal(keys, seed=3)
+        self.assertTrue(np.all(np.isfinite(g)))
+        self.assertAlmostEqual(g.mean(), 0.0, delta=0.01)
+        self.assertAlmostEqual(g.std(), 1.0, delta=0.01)
+
+    def test_jer_smearing_chunking(self):
+        events = create_events()
+        full = smear_flat(events)
+
+        # identical for different chunk sizes
+        for chunk_size in [17, 999, 7919, len(events)]:
+            chunked = np.concatenate([
+                smear_flat(events[start:start + chunk_size])
+                for start in range(0, len(events), chunk_size)
+            ])
+            self.assertTrue(np.array_equal(chunked, full), f"chunk size {chunk_size}")
+
+        # identical for a different order of events
+        perm = np.random.default_rng(1).permutation(len(events))
+        smeared = jer_smearing(events[perm], seed=2015)
+        self.assertTrue(ak.all(smeared == jer_smearing(events, seed=2015)[perm]))
+
+        # different for another seed
+        other = ak.to_numpy(ak.flatten(jer_smearing(events, seed=2016), axis=1))
+        self.assertFalse(np.any(other == full))
+
+    def test_jer_smearing_workers(self):
+        events = create_events()
+        full = smear_flat(events)
+
+        # identical for different numbers of worker processes, each smearing separate chunks
+        ctx = multiprocessing.get_context("fork")
+        for n_workers, chunk_size in [(1, 5000), (2, 3000), (4, 1234)]:
+            chunks = [events[start:start + chunk_size] for start in range(0, len(events), chunk_size)]
+            with ctx.Pool(n_workers) as pool:
+                smeared = np.concatenate(pool.map(smear_flat, chunks))
+            self.assertTrue(np.array_equal(smeared, full), f"{n_workers} workers")